@@ -0,0 +1,115 @@
+"""Copy order benchmark.
+
+Measures how long copying the DICOM images of a session takes when copied in
+random order (as the headers are read, which is what archiving used to do),
+by file name, by inode number and by physical position on disk (FIEMAP).
+The differences only show on spinning disks and tape-backed storage; place
+the source there with --source.
+
+Before each run, the source files are evicted from the page cache (with
+posix_fadvise, or by dropping all caches with --drop-caches, which needs
+root privileges), so that they are actually read from disk.
+
+Usage:
+    python benchmarks/copy_order.py [--source FOLDER] [-n REPETITIONS]
+
+"""
+
+
+import os
+import sys
+import time
+import glob
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.split(__file__)[0],
+                                                os.pardir)))
+sys.path.insert(0, os.path.split(os.path.abspath(__file__))[0])
+
+from scansessiontool.utilities import copy_file
+from scansessiontool.scheduler import order_operations
+from synthetic_session import make_session
+
+
+def evict(filenames, drop_caches=False):
+    if drop_caches:
+        os.sync()
+        with open("/proc/sys/vm/drop_caches", 'w') as f:
+            f.write("3\n")
+        return
+    for filename in filenames:
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--source", metavar="FOLDER",
+                        help="the folder with the DICOM images; a synthetic "
+                             "session is generated in it if it is empty "
+                             "(default: a temporary folder)")
+    parser.add_argument("--target", metavar="FOLDER",
+                        help="the folder to copy to (default: a temporary "
+                             "folder)")
+    parser.add_argument("-v", "--vols", type=int, default=300,
+                        help="the number of volumes of each of the three "
+                             "measurements of a synthetic session "
+                             "(default: 300)")
+    parser.add_argument("-n", type=int, default=3,
+                        help="number of repetitions (default: 3)")
+    parser.add_argument("--drop-caches", action="store_true",
+                        help="drop all caches before each run (needs root)")
+    args = parser.parse_args()
+
+    if not hasattr(os, "posix_fadvise") and not args.drop_caches:
+        sys.exit("Evicting files from the page cache is not supported on "
+                 "this platform")
+
+    temporary = tempfile.TemporaryDirectory()
+    source = args.source or os.path.join(temporary.name, "source")
+    if not glob.glob(os.path.join(source, "*.IMA")):
+        print("Generating synthetic session...")
+        make_session(source, (("anat", "t1", args.vols),
+                              ("func", "run1", args.vols),
+                              ("func", "run2", args.vols)), seed=0)
+    target = os.path.join(args.target or temporary.name, "target")
+    filenames = glob.glob(os.path.join(source, "*.IMA"))
+    operations = [(x, os.path.join(target, os.path.split(x)[-1]))
+                  for x in filenames]
+
+    orders = {"random": None, "name": "name", "inode": "inode",
+              "locality": "locality"}
+    durations = {x: [] for x in orders}
+    for repetition in range(args.n):
+        for name, order in orders.items():
+            if order is None:
+                ordered = list(operations)
+                random.shuffle(ordered)
+            else:
+                ordered = order_operations(operations, order)
+            shutil.rmtree(target, ignore_errors=True)
+            os.makedirs(target)
+            evict(filenames, args.drop_caches)
+            start = time.perf_counter()
+            for src, dst in ordered:
+                copy_file(src, dst)
+            durations[name].append(time.perf_counter() - start)
+
+    nbytes = sum(os.path.getsize(x) for x in filenames)
+    print("Copying {0} files ({1:.1f} MB):".format(len(filenames),
+                                                   nbytes / 1e6))
+    for name, values in durations.items():
+        median = sorted(values)[len(values) // 2]
+        print("    {0:<8}  median {1:.3f} s ({2:.1f} MB/s)".format(
+            name, median, nbytes / median / 1e6))
+    temporary.cleanup()
+
+
+if __name__ == "__main__":
+    main()
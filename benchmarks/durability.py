@@ -0,0 +1,80 @@
+"""Durability benchmark.
+
+Archives a synthetic session with each durability mode (see
+`scansessiontool.durability`) and compares how long archiving takes, and how
+much of that is spent syncing to disk. The cost of syncing only shows on a
+real disk (on a tmpfs, syncing is free), so the target defaults to a folder
+in the current directory.
+
+Usage:
+    python benchmarks/durability.py [--target FOLDER] [-n REPETITIONS]
+
+"""
+
+
+import os
+import sys
+import time
+import argparse
+import statistics
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.split(__file__)[0],
+                                                os.pardir)))
+sys.path.insert(0, os.path.split(os.path.abspath(__file__))[0])
+
+from scansessiontool.archiving import SessionArchiver
+from scansessiontool.durability import MODES
+from synthetic_session import make_session
+
+
+def archive(protocol, source, target, mode):
+    settings = {"Catalog": False, "Durability": mode}
+    archiver = SessionArchiver(protocol, source, target, settings=settings)
+    if hasattr(os, "sync"):
+        os.sync()  # do not pay for the writeback of earlier runs
+    start = time.perf_counter()
+    archiver.run()
+    seconds = time.perf_counter() - start
+    durability = archiver.report.durability
+    return durability["files"], durability["seconds"], seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--target", metavar="FOLDER", default=os.curdir,
+                        help="the folder to archive to (default: a "
+                             "temporary folder in the current directory)")
+    parser.add_argument("-n", "--repetitions", type=int, default=3,
+                        help="the number of runs per mode (default: 3)")
+    parser.add_argument("-v", "--vols", type=int, default=300,
+                        help="the number of volumes of each of the two "
+                             "measurements of the synthetic session "
+                             "(default: 300)")
+    args = parser.parse_args()
+
+    source = tempfile.TemporaryDirectory()
+    target = tempfile.TemporaryDirectory(dir=args.target)
+    print("Generating synthetic session...")
+    protocol = make_session(source.name, (("anat", "t1", args.vols),
+                                          ("func", "run1", args.vols)),
+                            seed=0)
+
+    print("{0:<10} {1:>10} {2:>10} {3:>10}".format(
+        "Mode", "Total (s)", "Sync (s)", "Synced"))
+    for mode in MODES:
+        runs = []
+        for repetition in range(args.repetitions):
+            folder = os.path.join(target.name,
+                                  "{0}-{1}".format(mode, repetition))
+            os.makedirs(folder)
+            runs.append(archive(protocol, source.name, folder, mode))
+        print("{0:<10} {1:>10.2f} {2:>10.2f} {3:>10}".format(
+            mode, statistics.median(x[2] for x in runs),
+            statistics.median(x[1] for x in runs), runs[-1][0]))
+    source.cleanup()
+    target.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""GUI typing benchmark.
+
+Measures the cost of a single keystroke in a session with many measurements:
+typing into measurement names (Tkinter variable traces) and into logfile and
+comment text widgets (key release events), including processing all pending
+Tk events after each keystroke. Also measures the cost of scrolling through
+the measurements (which recycles the rows of the measurement list).
+
+Usage:
+    python benchmarks/gui_typing.py [-m MEASUREMENTS] [-k KEYSTROKES]
+
+Requires a display.
+
+"""
+
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.split(__file__)[0],
+                                                os.pardir)))
+
+from tkinter import Tk, END
+
+from scansessiontool.scansessiontool import ScanSessionTool
+
+
+def measure(root, keystrokes, type_key):
+    durations = []
+    for counter in range(keystrokes):
+        start = time.perf_counter()
+        type_key(counter)
+        root.update()
+        durations.append(time.perf_counter() - start)
+    durations.sort()
+    return durations
+
+
+def report(name, durations):
+    print("    {0:<24} median {1:7.3f} ms   95% {2:7.3f} ms   "
+          "max {3:7.3f} ms".format(
+              name, durations[len(durations) // 2] * 1000,
+              durations[int(len(durations) * 0.95)] * 1000,
+              durations[-1] * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-m", type=int, default=200,
+                        help="number of measurements (default: 200)")
+    parser.add_argument("-k", type=int, default=200,
+                        help="number of keystrokes per field (default: 200)")
+    args = parser.parse_args()
+
+    root = Tk()
+    app = ScanSessionTool(root)
+    app.general_vars[0].set("Project 1")
+    start = time.perf_counter()
+    for _ in range(args.m - 1):
+        app.new_measurement()
+    root.update()
+    print("Created {0} measurements in {1:.3f} s".format(
+        args.m, time.perf_counter() - start))
+
+    print("Measurement rows created: {0}".format(
+        len(app.measurements_frame.rows) +
+        len(app.measurements_frame.free_rows)))
+
+    print("Keystroke latency:")
+    for name, index in (("middle", args.m // 2), ("last", args.m - 1)):
+        app.measurements_frame.see(index)
+        root.update()
+        row = app.measurements_frame.get_row(index)
+        var = row.vars["name"]
+        report("name ({0})".format(name), measure(
+            root, args.k,
+            lambda c: var.set(var.get() + "abcdefghij"[c % 10])))
+
+        def type_text(c, widget):
+            widget.insert(END, "abcdefghij"[c % 10])
+            widget.event_generate("<KeyRelease>")
+
+        report("logfiles ({0})".format(name), measure(
+            root, args.k, lambda c: type_text(c, row.texts["logfiles"])))
+        report("comments ({0})".format(name), measure(
+            root, args.k, lambda c: type_text(c, row.texts["comments"])))
+
+    print("Scrolling latency:")
+    canvas = app.measurements_frame.canvas
+    canvas.yview_moveto(0)
+    report("scroll (2 units)", measure(
+        root, args.k, lambda c: canvas.yview_scroll(2, "units")))
+
+    # Let debounced handlers fire before quitting
+    root.after(app.text_debounce * 2, root.quit)
+    root.mainloop()
+    root.destroy()
+
+
+if __name__ == "__main__":
+    main()
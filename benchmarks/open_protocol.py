@@ -0,0 +1,89 @@
+"""Protocol loading benchmark.
+
+Measures the cost of opening a scan protocol with many measurements: parsing
+the protocol file, and loading the parsed protocol into the form (which
+requires a display).
+
+Usage:
+    python benchmarks/open_protocol.py [-m MEASUREMENTS] [-n REPETITIONS]
+
+"""
+
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.split(__file__)[0],
+                                                os.pardir)))
+
+from scansessiontool.protocol import ScanProtocol
+
+
+def make_protocol(measurements):
+    lines = ["General Information", "===================", "",
+             "Project:                TestData",
+             "Subject:                001",
+             "Session:                001 Transfer",
+             "Date:                   2021-12-03",
+             "Time A:", "Time B:", "User 1:", "User 2:", "",
+             "Notes:                  A note", "", "",
+             "Documents", "=========", "",
+             "Files:", "",
+             "Checklist:              [x] MR Safety Screening Form",
+             "                        [ ] Participation Informed Consent Form",
+             "", "", "Measurements", "============"]
+    for number in range(1, measurements + 1):
+        lines += ["", "No. {0}".format(number), "-----", "",
+                  "Type:                   func",
+                  "Vols:                   300",
+                  "Name:                   run{0}".format(number),
+                  "Logfiles:               run{0}.log".format(number),
+                  "                        run{0}.prt".format(number),
+                  "", "Comments:               First line",
+                  "                        Second line", ""]
+    return [x + "\n" for x in lines]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-m", type=int, default=100,
+                        help="number of measurements (default: 100)")
+    parser.add_argument("-n", type=int, default=10,
+                        help="number of repetitions (default: 10)")
+    args = parser.parse_args()
+
+    lines = make_protocol(args.m)
+    durations = []
+    for _ in range(args.n):
+        start = time.perf_counter()
+        protocol = ScanProtocol.parse(lines)
+        durations.append(time.perf_counter() - start)
+    print("Parse {0} measurements: median {1:.3f} ms".format(
+        args.m, sorted(durations)[len(durations) // 2] * 1000))
+
+    try:
+        from tkinter import Tk, TclError
+        root = Tk()
+    except TclError as e:
+        print("Load into form: skipped ({0})".format(e))
+        return
+
+    from scansessiontool.scansessiontool import ScanSessionTool
+
+    app = ScanSessionTool(root)
+    durations = []
+    for _ in range(args.n):
+        protocol = ScanProtocol.parse(lines)
+        start = time.perf_counter()
+        app.load_protocol(protocol)
+        root.update()
+        durations.append(time.perf_counter() - start)
+    print("Load {0} measurements: median {1:.3f} ms".format(
+        args.m, sorted(durations)[len(durations) // 2] * 1000))
+    root.destroy()
+
+
+if __name__ == "__main__":
+    main()
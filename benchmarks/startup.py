@@ -0,0 +1,116 @@
+"""Startup benchmark.
+
+Measures the import cost of Scan Session Tool and its time-to-first-paint
+(i.e. the time from starting the interpreter until the main window is first
+exposed), each in a fresh Python process, and checks that none of the heavy
+modules (`HEAVY_MODULES`, imported on first use) is loaded before the first
+paint (exits with status 1 otherwise).
+
+Usage:
+    python benchmarks/startup.py [-n REPETITIONS]
+
+"""
+
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+ROOT = os.path.abspath(os.path.join(os.path.split(__file__)[0], os.pardir))
+
+HEAVY_MODULES = ("pydicom", "yaml", "multiprocessing", "json", "glob")
+
+# The heavy modules loaded are recorded before json is imported for the output
+IMPORT_ONLY = """
+import sys, time
+start = time.perf_counter()
+import scansessiontool.scansessiontool
+imported = time.perf_counter()
+loaded = [m for m in {heavy!r} if m in sys.modules]
+import json
+print(json.dumps({{"import": imported - start, "loaded": loaded}}))
+"""
+
+FIRST_PAINT = """
+import sys, time
+start = time.perf_counter()
+import scansessiontool.scansessiontool
+imported = time.perf_counter()
+from tkinter import Tk
+root = Tk()
+painted = []
+
+def expose(event):
+    if not painted:
+        painted.append((time.perf_counter(),
+                        [m for m in {heavy!r} if m in sys.modules]))
+
+root.bind("<Expose>", expose)
+app = scansessiontool.scansessiontool.ScanSessionTool(root)
+ready = time.perf_counter()
+root.update()
+if not painted:  # not exposed (e.g. on a virtual display)
+    painted.append((ready, [m for m in {heavy!r} if m in sys.modules]))
+import json
+print(json.dumps({{"import": imported - start,
+                  "first_paint": painted[0][0] - start,
+                  "ready": ready - start, "loaded": painted[0][1]}}))
+root.destroy()
+"""
+
+
+def run(code):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = ROOT + os.pathsep + env.get("PYTHONPATH", "")
+    output = subprocess.check_output([sys.executable, "-c", code], env=env,
+                                     stderr=subprocess.PIPE)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def summarize(name, values):
+    values = sorted(values)
+    print("    {0:<12} min {1:7.1f} ms   median {2:7.1f} ms".format(
+        name, values[0] * 1000, values[len(values) // 2] * 1000))
+
+
+def report_loaded(results, when):
+    loaded = {m for r in results for m in r["loaded"]}
+    print("    heavy modules loaded {0}: {1}".format(
+        when, ", ".join(sorted(loaded)) or "none"))
+    return loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-n", type=int, default=10,
+                        help="number of repetitions (default: 10)")
+    args = parser.parse_args()
+
+    print("Import only:")
+    results = [run(IMPORT_ONLY.format(heavy=HEAVY_MODULES))
+               for _ in range(args.n)]
+    summarize("import", [r["import"] for r in results])
+    loaded = report_loaded(results, "after import")
+
+    print("Time-to-first-paint:")
+    try:
+        results = [run(FIRST_PAINT.format(heavy=HEAVY_MODULES))
+                   for _ in range(args.n)]
+    except subprocess.CalledProcessError as e:
+        print("    skipped ({0})".format(
+            e.stderr.decode().strip().splitlines()[-1]))
+    else:
+        summarize("import", [r["import"] for r in results])
+        summarize("first paint", [r["first_paint"] for r in results])
+        summarize("ready", [r["ready"] for r in results])
+        loaded |= report_loaded(results, "before first paint")
+    if loaded:
+        sys.exit("Heavy modules loaded at startup: {0}".format(
+            ", ".join(sorted(loaded))))
+
+
+if __name__ == "__main__":
+    main()
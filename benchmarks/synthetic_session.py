@@ -0,0 +1,152 @@
+"""Synthetic session generator.
+
+Generates the data of a synthetic scan session (DICOM images of several
+measurements, a logfile per functional measurement and a scan protocol), to
+benchmark archiving without real data. The DICOM images are written in a
+random order, so that their order on disk differs from their names (as it
+does for real scanner exports).
+
+Usage:
+    python benchmarks/synthetic_session.py FOLDER [-m TYPE:NAME:VOLS ...]
+                                                  [--matrix N]
+
+"""
+
+
+import os
+import sys
+import random
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.split(__file__)[0],
+                                                os.pardir)))
+
+from scansessiontool.protocol import Measurement, ScanProtocol
+
+
+DEFAULT_MEASUREMENTS = (("anat", "t1_mprage", 176),
+                        ("func", "run1", 300),
+                        ("func", "run2", 300))
+
+
+def make_dicom(filename, series, instance, protocol_name, matrix=128,
+               echo=1):
+    """Write a (minimal) MR DICOM image."""
+
+    import pydicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = "1.2.840.10008.5.1.4.1.1.4"
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = Dataset()
+    ds.file_meta = meta
+    ds.SOPClassUID = meta.MediaStorageSOPClassUID
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    ds.Modality = "MR"
+    ds.PatientName = "Synthetic^Subject"
+    ds.PatientID = "SYNTH001"
+    ds.PatientBirthDate = "19700101"
+    ds.SeriesNumber = series
+    ds.AcquisitionNumber = 1
+    ds.InstanceNumber = instance
+    ds.EchoNumbers = echo
+    ds.ProtocolName = protocol_name
+    ds.Rows = matrix
+    ds.Columns = matrix
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = "MONOCHROME2"
+    ds.BitsAllocated = 16
+    ds.BitsStored = 12
+    ds.HighBit = 11
+    ds.PixelRepresentation = 0
+    ds.PixelData = os.urandom(matrix * matrix * 2)
+    ds.preamble = b"\0" * 128
+    if int(pydicom.__version__.split(".")[0]) < 3:
+        ds.is_little_endian = True
+        ds.is_implicit_VR = False
+        ds.save_as(filename, write_like_original=False)
+    else:
+        ds.save_as(filename, enforce_file_format=True)
+
+
+def make_session(folder, measurements=DEFAULT_MEASUREMENTS, matrix=128,
+                 project="Synthetic", seed=None):
+    """Generate the data of a synthetic scan session.
+
+    Parameters
+    ----------
+    folder : str
+        the folder to write the data to (created if necessary)
+    measurements : list of (str, str, int), optional
+        the type, name and number of volumes of each measurement
+    matrix : int, optional
+        the number of rows and columns of each image (default=128)
+    project : str, optional
+        the project of the scan protocol (default="Synthetic")
+    seed : int, optional
+        the seed for the order the images are written in (default=None)
+
+    Returns
+    -------
+    protocol : ScanProtocol
+        the scan protocol of the session (also written into the folder)
+
+    """
+
+    os.makedirs(folder, exist_ok=True)
+    protocol = ScanProtocol()
+    protocol.project = project
+    protocol.date = "2021-12-03"
+    images = []
+    for number, (type, name, vols) in enumerate(measurements, 1):
+        measurement = Measurement("{0:03d}".format(number), type, str(vols),
+                                  name)
+        if type == "func":
+            measurement.logfiles = "{0}.log".format(name)
+            with open(os.path.join(folder, measurement.logfiles), 'w') as f:
+                f.write("Synthetic logfile of {0}\n".format(name))
+        protocol.measurements.append(measurement)
+        for instance in range(1, vols + 1):
+            images.append((number, instance, name))
+
+    random.Random(seed).shuffle(images)
+    for number, instance, name in images:
+        make_dicom(os.path.join(folder, "MR.{0:04d}.{1:05d}.IMA".format(
+            number, instance)), number, instance, name, matrix)
+
+    with open(os.path.join(folder, protocol.get_filename() + ".txt"),
+              'w') as f:
+        f.write(protocol.format())
+    return protocol
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("folder", metavar="FOLDER",
+                        help="the folder to write the session to")
+    parser.add_argument("-m", "--measurement", action="append",
+                        metavar="TYPE:NAME:VOLS",
+                        help="a measurement (default: {0})".format(" ".join(
+                            ":".join(str(y) for y in x)
+                            for x in DEFAULT_MEASUREMENTS)))
+    parser.add_argument("--matrix", type=int, default=128,
+                        help="the number of rows and columns of each image "
+                             "(default: 128)")
+    parser.add_argument("--seed", type=int, help="the random seed")
+    args = parser.parse_args()
+
+    measurements = DEFAULT_MEASUREMENTS
+    if args.measurement:
+        measurements = [(t, n, int(v)) for t, n, v in
+                        (x.split(":") for x in args.measurement)]
+    protocol = make_session(args.folder, measurements, args.matrix,
+                            seed=args.seed)
+    print("Written {0} measurements to {1}".format(
+        len(protocol.measurements), args.folder))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Throttling benchmark.
+
+Archives a synthetic session with bandwidth limits (see
+`scansessiontool.throttling`) and compares the achieved throughput to the
+limits. The target should be fast enough not to limit the throughput itself,
+so it defaults to a folder on a tmpfs (/dev/shm, where available).
+
+Usage:
+    python benchmarks/throttling.py [--max-bytes MB] [--max-files N]
+                                    [--target FOLDER]
+
+"""
+
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.split(__file__)[0],
+                                                os.pardir)))
+sys.path.insert(0, os.path.split(os.path.abspath(__file__))[0])
+
+from scansessiontool.archiving import SessionArchiver
+from synthetic_session import make_session
+
+
+def archive(protocol, source, target, throttle):
+    settings = {"Catalog": False, "IO": {"Default": 8}}
+    if throttle:
+        settings["Throttle"] = throttle
+    archiver = SessionArchiver(protocol, source, target, settings=settings)
+    start = time.perf_counter()
+    archiver.run()
+    seconds = time.perf_counter() - start
+    phase = archiver.report.phases["Copying DICOM files"]
+    return phase["files"], phase["bytes"], phase["seconds"], seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--max-bytes", type=float, default=10, metavar="MB",
+                        help="the maximal throughput in MB/s (default: 10)")
+    parser.add_argument("--max-files", type=float, metavar="N",
+                        help="the maximal number of files per second "
+                             "(default: no limit)")
+    parser.add_argument("--burst", type=float, default=0.1,
+                        help="the burst in seconds (default: 0.1)")
+    parser.add_argument("--target", metavar="FOLDER",
+                        help="the folder to archive to (default: a "
+                             "temporary folder on /dev/shm, if available)")
+    parser.add_argument("-v", "--vols", type=int, default=300,
+                        help="the number of volumes of each of the two "
+                             "measurements of the synthetic session "
+                             "(default: 300)")
+    args = parser.parse_args()
+
+    source = tempfile.TemporaryDirectory()
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else None
+    target = tempfile.TemporaryDirectory(dir=args.target or base)
+    print("Generating synthetic session...")
+    protocol = make_session(source.name, (("anat", "t1", args.vols),
+                                          ("func", "run1", args.vols)),
+                            seed=0)
+
+    throttle = {"Bytes": args.max_bytes, "Files": args.max_files,
+                "Burst": args.burst}
+    for name, limits in (("unlimited", None), ("throttled", throttle)):
+        folder = os.path.join(target.name, name)
+        os.makedirs(folder)
+        files, nbytes, seconds, total = archive(protocol, source.name,
+                                                folder, limits)
+        print("{0:<10} {1} files, {2:.1f} MB in {3:.2f} s: {4:.1f} MB/s, "
+              "{5:.0f} files/s".format(name, files, nbytes / 1e6, seconds,
+                                       nbytes / seconds / 1e6,
+                                       files / seconds))
+    print("Limits:    {0} MB/s, {1} files/s (burst {2} s)".format(
+        args.max_bytes or "no limit", args.max_files or "no limit",
+        args.burst))
+    source.cleanup()
+    target.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,5 @@
 import platform
+import argparse
 from tkinter import *
 from tkinter.ttk import *
 
@@ -6,8 +7,18 @@ from .scansessiontool import ScanSessionTool
 
 
 def run():
+    parser = argparse.ArgumentParser(
+        prog="scansessiontool",
+        description="A tool for MR scan session documentation and data "
+                    "archiving")
+    parser.add_argument("--profile", nargs="?", const="", metavar="DIR",
+                        help="profile archiving and GUI hot paths and write "
+                             "a profiling bundle into DIR (default: home "
+                             "directory) when quitting")
+    args = parser.parse_args()
+
     root = Tk()
-    app = ScanSessionTool(root)
+    app = ScanSessionTool(root, profile=args.profile)
     app.mainloop()
 
 if __name__ == "__main__":
@@ -0,0 +1,1453 @@
+"""Archiving.
+
+The archiving procedure of Scan Session Tool, independent of the GUI: the
+DICOM images, logfiles and documents of a scan session are copied into the
+archive, in the folder structure
+
+    <Project>/sub-<NNN>[-<Type>]/ses-<NNN>[-<Type>]/<Type>/<NNN>-<Name>/DICOM/
+
+together with optional (Turbo-)BrainVoyager links, the scan protocol and an
+archive report. Instead of the folder "DICOM", the images of a measurement
+can be archived into a single container file (e.g. "DICOM.tar.gz"), by
+setting "OutputFormat" in the "Settings" section of the config file (see
+`containers.OUTPUT_FORMATS`).
+
+The source of a session is a folder, or a scanner export (a zip or tar file,
+see `exports`) that is archived from without being extracted.
+
+The session is written into a hidden folder first, and only published into
+the archive once it is complete (see `publishing`).
+
+"""
+
+
+import os
+import glob
+import json
+import time
+import shutil
+import hashlib
+import functools
+import threading
+import multiprocessing
+
+from .utilities import (replace,
+                        readdicom_timed,
+                        copy_file,
+                        copy_fileobj,
+                        hash_file,
+                        copy_logfiles)
+from .scheduler import IOScheduler
+from .exports import ExportArchive, is_export
+from .exports import readdicom_timed as export_readdicom_timed
+from .transcoding import TRANSFER_SYNTAXES, FAILED, encode
+from .deidentification import Deidentifier
+from .tee import Tee
+from .staging import FlushQueue, get_spool
+from .publishing import (create_work_folder, publish, move_to_trash,
+                         empty_trash)
+from .retrying import RetryPolicy, describe
+from .durability import MODES as DURABILITY_MODES
+from .durability import DEFAULT_MODE as DURABILITY_DEFAULT
+from .containers import (OUTPUT_FORMATS,
+                         INDEX_SUFFIX,
+                         ContainerWriter,
+                         get_container_filename,
+                         zstd_available)
+
+
+# The maximal number of failed files listed in a warning (all are listed in
+# the archive report)
+MAX_LISTED = 10
+
+
+def _read_header(retry, read, item):
+    """Read the header of a DICOM image (in a worker process), retrying
+    transient errors, and catch all others."""
+
+    retries = []
+    try:
+        dicom, latency = retry.call(read, item,
+                                    on_retry=lambda *x: retries.append(x))
+    except Exception as e:
+        return item, None, None, describe(e), len(retries)
+    return item, dicom, latency, None, len(retries)
+
+def format_failures(failures):
+    """Format failed files as lines of a warning (see
+    `SessionArchiver.fail`)."""
+
+    lines = ["    {0} ({1})\n".format(x["file"], x["error"])
+             for x in failures[:MAX_LISTED]]
+    if len(failures) > MAX_LISTED:
+        lines.append("    ... and {0} more (see archive report)\n".format(
+            len(failures) - MAX_LISTED))
+    return "".join(lines)
+
+def _copy(source, target, export=None, open_target=None):
+    """Copy a file (from a folder or an export) and measure how long that
+    took."""
+
+    start = time.perf_counter()
+    if export is None and open_target is None:
+        size, sha256 = copy_file(source, target)
+    else:
+        with open(source, 'rb') if export is None else \
+                export.open(source) as f:
+            size, sha256 = copy_fileobj(f, target, open_target=open_target)
+    return size, sha256, time.perf_counter() - start
+
+def _read(source, export=None):
+    """Read a file (from a folder or an export) and its modification time."""
+
+    if export is None:
+        with open(source, 'rb') as f:
+            return f.read(), os.fstat(f.fileno()).st_mtime
+    with export.open(source) as f:
+        return f.read(), export.getmtime(source)
+
+def _transform(transform, source, target, export=None, open_target=None):
+    """Read a file (from a folder or an export), transform it (e.g. re-encode
+    it) and write it, and measure how long that took."""
+
+    start = time.perf_counter()
+    data = transform(_read(source, export)[0])
+    with open(target, 'wb') if open_target is None else \
+            open_target(target) as f:
+        f.write(data)
+    sha256 = hashlib.sha256(data).hexdigest()
+    return len(data), sha256, time.perf_counter() - start
+
+def _deidentify(deidentifier, source, target, export=None,
+                open_target=None):
+    """Copy a DICOM file (from a folder or an export), de-identified, and
+    measure how long that took."""
+
+    start = time.perf_counter()
+    with open(source, 'rb') if export is None else export.open(source) as f:
+        size, sha256 = deidentifier.copy(f, target, open_target=open_target)
+    return size, sha256, time.perf_counter() - start
+
+def _pack(writer, source, target, export=None, transform=None):
+    """Read a file (from a folder or an export), optionally transform it
+    (e.g. re-encode it), and pack it for a container, and measure how long
+    that took."""
+
+    start = time.perf_counter()
+    data, mtime = _read(source, export)
+    if transform is not None:
+        data = transform(data)
+    sha256 = hashlib.sha256(data).hexdigest()
+    packed = writer.pack(os.path.split(source)[-1], data, mtime)
+    return len(data), sha256, time.perf_counter() - start, packed
+
+def _link(source, target):
+    """Create a hard link and measure how long that took."""
+
+    start = time.perf_counter()
+    os.link(source, target)
+    return 0, time.perf_counter() - start
+
+
+def get_session_folder(folder, protocol):
+    """Get the folder a scan session is archived to.
+
+    Parameters
+    ----------
+    folder : str
+        the root folder of the archive
+    protocol : ScanProtocol
+        the scan protocol of the session
+
+    Returns
+    -------
+    session_folder : str
+        the session folder
+
+    """
+
+    subject_no = int(protocol.subject[0])
+    subject_type = protocol.subject[1]
+    session_no = int(protocol.session[0])
+    session_type = protocol.session[1]
+
+    project_folder = os.path.join(folder, protocol.project)
+    if subject_type == "":
+        subject_folder = os.path.join(project_folder,
+                                      "sub-" + repr(subject_no).zfill(3))
+    else:
+        subject_folder = os.path.join(
+            project_folder, "sub-" + repr(
+                subject_no).zfill(3) + "-" + subject_type)
+
+    if session_type == "":
+        session_folder = os.path.join(
+            subject_folder, "ses-" + repr(session_no).zfill(3))
+    else:
+        session_folder = os.path.join(
+            subject_folder,
+            "ses-" + repr(session_no).zfill(3) + "-" + session_type)
+    return session_folder
+
+
+class SessionArchiver:
+    """Archive the data of a single scan session.
+
+    Parameters
+    ----------
+    protocol : ScanProtocol
+        the scan protocol of the session; the logfiles of its measurements
+        and its files are updated with the names of the files matched by
+        wildcard patterns
+    source : str
+        the folder with the data of the session, or a scanner export (a zip
+        or tar file with the DICOM images; logfiles and documents are then
+        taken from the folder the export is in)
+    folder : str
+        the root folder of the archive
+    bv_links : bool, optional
+        whether to create BrainVoyager links (default=False)
+    tbv_links : bool, optional
+        whether to copy Turbo-BrainVoyager files and create links for them
+        (default=False)
+    tbv_files : str, optional
+        the folder with the Turbo-BrainVoyager files, relative to the source
+        (default="TBVFiles")
+    tbv_prefix : str, optional
+        the name prefix of measurements used in Turbo-BrainVoyager
+        (default="TBV_")
+    settings : dict, optional
+        the site-wide settings (default=None)
+    workers : int, optional
+        the number of processes to read DICOM images in (default=None,
+        meaning the number of CPUs)
+    progress : callable, optional
+        a function called with the current status (a pair of strings, or
+        None) and whether a new step started (`flush`) (default=None)
+    profiler : Profiler, optional
+        a profiler to measure the memory of the scan index with
+        (default=None)
+    output_format : str, optional
+        the output format of the DICOM images of each measurement (see
+        `containers.OUTPUT_FORMATS`) (default=None, meaning "OutputFormat"
+        of the settings, or "folder")
+    dicom_compression : str, optional
+        the transfer syntax to re-encode DICOM images in losslessly (see
+        `transcoding.TRANSFER_SYNTAXES`) (default=None, meaning
+        "DicomCompression" of the settings, or no re-encoding)
+    deidentification : dict or bool, optional
+        the de-identification profile of the project, or True for the
+        default profile (see `deidentification`) (default=None, meaning no
+        de-identification)
+    mirrors : list of str, optional
+        the root folders of further archives to archive the session to at
+        the same time (see `tee`) (default=None, meaning "Targets" of
+        "Mirrors" of the settings, if any)
+    throttle : dict, optional
+        the bandwidth limits ("Bytes" in MB/s and/or "Files" per second),
+        overriding those of "Throttle" of the settings (see `throttling`)
+        (default=None)
+    staging : str or bool, optional
+        the spool to archive the session into first, to be flushed to the
+        archive in the background (see `staging`), or False to archive
+        directly (default=None, meaning "Staging" of the settings, if any)
+    durability : str, optional
+        how the archived files are synced to disk (see
+        `durability.MODES`) (default=None, meaning "Durability" of the
+        settings, or "directory")
+
+    Attributes
+    ----------
+    session_folder : str
+        the folder the session is archived to (in the spool, if staging)
+    target_folder : str
+        the session folder in the archive
+    spool : str
+        the spool (None if not staging)
+    root : str
+        the root folder of `session_folder` (the spool, if staging)
+    work_folder : str
+        the hidden folder the session is written to, until it is published
+        (complete) to `session_folder` (see `publishing`) (None before
+        archiving started)
+    report : ArchiveReport
+        the report of the archiving procedure (None before it started)
+    scheduler : IOScheduler
+        the scheduler running all copy and link operations (None before
+        archiving started)
+    export : ExportArchive
+        the scanner export archived from (None if the source is a folder)
+    data_folder : str
+        the folder with the logfiles and documents of the session
+    compression : dict
+        the number of re-encoded, unchanged and failed DICOM images and
+        their size before and after (None if not re-encoding)
+    deidentifier : Deidentifier
+        the de-identifier of the DICOM images (None if not de-identifying)
+    tee : Tee
+        the tee writing to the mirrors (None if there are none, or before
+        archiving started)
+    archived : list of dict
+        the catalog records of all archived files
+    failed : list of dict
+        the files that could not be archived ("phase", "file", "error" and
+        "measurement")
+    success : bool
+        whether the session folder could be created (and the session was
+        hence archived, possibly with warnings)
+
+    """
+
+    def __init__(self, protocol, source, folder, bv_links=False,
+                 tbv_links=False, tbv_files="TBVFiles", tbv_prefix="TBV_",
+                 settings=None, workers=None, progress=None, profiler=None,
+                 output_format=None, dicom_compression=None,
+                 deidentification=None, mirrors=None, throttle=None,
+                 staging=None, durability=None):
+        self.protocol = protocol
+        self.source = source
+        self.folder = folder
+        self.bv_links = bv_links
+        self.tbv_links = tbv_links
+        self.tbv_files = tbv_files
+        self.tbv_prefix = tbv_prefix
+        self.settings = settings or {}
+        if throttle:
+            self.settings = dict(self.settings)
+            self.settings["Throttle"] = dict(
+                self.settings.get("Throttle") or {}, **throttle)
+        if durability is not None:
+            self.settings = dict(self.settings, Durability=durability)
+        if self.settings.get("Durability", DURABILITY_DEFAULT) not in \
+                DURABILITY_MODES + (False, None):
+            raise ValueError("Unknown durability mode: {0}".format(
+                self.settings["Durability"]))
+        self.workers = workers
+        self._progress = progress
+        self.profiler = profiler
+        if output_format is None:
+            output_format = self.settings.get("OutputFormat") or "folder"
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("Unknown output format: {0}".format(
+                output_format))
+        self.output_format = output_format
+        if dicom_compression is None:
+            dicom_compression = self.settings.get("DicomCompression")
+        if dicom_compression in (False, "no", "none"):
+            dicom_compression = None
+        if dicom_compression is not None and \
+                dicom_compression not in TRANSFER_SYNTAXES:
+            raise ValueError("Unknown DICOM compression: {0}".format(
+                dicom_compression))
+        self.dicom_compression = dicom_compression
+        self.compression = None
+        self.encoder = None
+        if mirrors is None:
+            mirrors = (self.settings.get("Mirrors") or {}).get("Targets")
+        self.mirrors = [os.path.expanduser(str(x)) for x in mirrors or []]
+        self.tee = None
+        self.deidentifier = None
+        if deidentification:
+            self.deidentifier = Deidentifier(deidentification, protocol)
+        self._lock = threading.Lock()
+        if staging is None:
+            self.spool = get_spool(self.settings)
+        else:
+            self.spool = os.path.abspath(staging) if staging else None
+        self.target_folder = get_session_folder(folder, protocol)
+        self.root = self.spool or folder
+        self.session_folder = get_session_folder(self.root, protocol)
+        self.work_folder = None
+        self.report = None
+        self.scheduler = None
+        self.export = None
+        self.data_folder = source
+        self.archived = []
+        self.failed = []
+        self.success = False
+
+    def progress(self, status=None, flush=False):
+        if self._progress is not None:
+            self._progress(status, flush)
+
+    def run(self):
+        """Archive the session.
+
+        Returns
+        -------
+        message : str
+            the outcome, including all warnings and a throughput summary
+
+        """
+
+        from .report import ArchiveReport
+        from .metrics import MetricsSink
+
+        session_folder = self.session_folder
+        data_folder = self.source
+        if is_export(self.source):
+            try:
+                self.export = ExportArchive(self.source)
+            except Exception as e:
+                return "Archiving failed: {0}".format(e)
+            data_folder = os.path.split(self.export.filename)[0]
+        self.data_folder = data_folder
+        if self.spool is not None and (
+                os.path.exists(self.target_folder) or
+                os.path.abspath(self.target_folder) in
+                FlushQueue(self.spool).get_targets()):
+            return "Archiving failed: {0} already exists!".format(
+                self.target_folder)
+        if os.path.exists(session_folder):
+            return "Archiving failed: {0} already exists!".format(
+                session_folder)
+        else:
+            try:
+                self.work_folder = create_work_folder(self.root,
+                                                      session_folder)
+            except:
+                return "Archiving failed: Could not create target directory!"
+        empty_trash(self.root)  # left over from earlier rollbacks
+        self.success = True
+
+        warnings = "\n\n\n"
+        if self.mirrors:
+            self.tee = Tee.from_config(
+                self.settings, self.work_folder,
+                [(x, get_session_folder(x, self.protocol))
+                 for x in self.mirrors])
+            self.tee.start()
+        try:
+            metrics = MetricsSink.from_config(self.settings)
+            metrics.start(session_folder)
+        except:
+            warnings += "\nError initializing metrics; metrics disabled\n"
+            metrics = None
+        self.report = report = ArchiveReport(metrics=metrics)
+        report.failed = self.failed
+        self.scheduler = IOScheduler.from_config(self.settings)
+        if self.output_format == "tar.zst" and not zstd_available():
+            warnings += "\nzstandard not installed; using tar.gz instead\n"
+            self.output_format = "tar.gz"
+        if self.output_format != "folder" and self.bv_links == True:
+            warnings += "\nBrainVoyager links are not supported with " \
+                        "container output\n"
+        if self.dicom_compression is not None:
+            self.compression = {
+                "transfer_syntax": TRANSFER_SYNTAXES[self.dicom_compression],
+                "encoded": 0, "unchanged": 0, "failed": 0,
+                "bytes_before": 0, "bytes_after": 0}
+            self.encoder = multiprocessing.Pool(self.workers)
+
+        try:
+            scans = self.read_headers()
+            failures = self.get_failures("Reading DICOM images")
+            if failures:
+                warnings += "\nError reading {0} DICOM images; not " \
+                            "archived:\n".format(len(failures))
+                warnings += format_failures(failures)
+            warnings += self.archive_measurements(scans)
+            if self.tbv_links == True:
+                warnings += self.copy_tbv_files()
+            warnings += self.copy_session_files()
+        except:
+            self.rollback()
+            raise
+        finally:
+            self.scheduler.shutdown()
+            report.devices = self.scheduler.stats()
+            report.retries += self.scheduler.retries
+            if self.scheduler.throttle is not None:
+                report.throttle = self.scheduler.throttle.stats()
+            if self.export is not None:
+                self.export.close()
+            if self.encoder is not None:
+                self.encoder.close()
+                self.encoder.join()
+                report.compression = self.compression
+                if self.compression[FAILED]:
+                    warnings += "\nError compressing {0} DICOM files; " \
+                                "archived uncompressed\n".format(
+                                    self.compression[FAILED])
+        warnings += self.save_protocol()
+        if self.deidentifier is not None:
+            try:
+                self.deidentifier.log(session_folder)
+            except:
+                warnings += "\nError writing de-identification log\n"
+        if self.tee is not None:
+            warnings += self.finish_mirrors()
+        warnings += self.sync()
+
+        # Save archive report
+        try:
+            report.finish()
+        except:
+            warnings += "\nError exporting metrics\n"
+        try:
+            filename = os.path.join(self.work_folder, "archive_report.json")
+            report.save(filename)
+            self.scheduler.durability.sync_file(filename)
+        except:
+            warnings += "\nError saving archive report\n"
+        else:
+            if self.tee is not None:
+                self.tee.replicate_file("archive_report.json")
+                for mirror in self.tee.mirrors:
+                    if mirror.error is None:
+                        try:
+                            self.scheduler.durability.sync_file(
+                                os.path.join(mirror.session_folder,
+                                             "archive_report.json"))
+                        except Exception as e:
+                            mirror.fail(e)
+
+        # Publish the complete session at once
+        try:
+            publish(self.work_folder, session_folder)
+        except Exception as e:
+            self.rollback()
+            return "Archiving failed: Could not publish session " \
+                   "({0})".format(e)
+        if self.tee is not None:
+            warnings += self.publish_mirrors()
+        try:
+            self.scheduler.durability.sync_parents(session_folder, self.root)
+        except:
+            warnings += "\nError syncing session folder to disk\n"
+
+        # Queue for flushing to the archive, and record in the catalog once
+        # flushed and verified
+        if self.spool is not None:
+            try:
+                catalog = self.get_catalog_update()
+            except:
+                warnings += "\nError updating archive catalog\n"
+                catalog = None
+            try:
+                FlushQueue(self.spool).put(session_folder, self.target_folder,
+                                           self.folder, catalog)
+            except:
+                warnings += "\nError queuing session for flushing; " \
+                            "session remains in {0}\n".format(session_folder)
+        else:
+            warnings += self.update_catalog()
+
+        if self.spool is not None:
+            message = "Staged in: {0}\nFlushing to: {1} (in the " \
+                      "background)".format(self.spool,
+                                           os.path.abspath(self.folder))
+        else:
+            message = "Archived to: {0}".format(os.path.abspath(self.folder))
+        if self.tee is not None:
+            for mirror in self.tee.mirrors:
+                if mirror.error is None:
+                    message += "\nMirrored to: {0}".format(
+                        os.path.abspath(mirror.root))
+        message += warnings
+        message += report.summary()
+        return message
+
+    def rollback(self):
+        """Roll back the (incomplete) session, by moving it (and its
+        mirrors) into the trash (see `publishing`)."""
+
+        self.success = False
+        if self.tee is not None:
+            self.tee.rollback()
+        if self.work_folder is not None and os.path.exists(self.work_folder):
+            move_to_trash(self.work_folder, self.root)
+
+    def finish_mirrors(self):
+        """Complete the mirrors of the session folder.
+
+        Returns
+        -------
+        warnings : str
+            warnings about mirrors that failed
+
+        """
+
+        self.progress(["Finalization", "Mirroring..."], True)
+        self.tee.finish(exclude=["archive_report.json"])
+        self.report.mirrors = self.tee.stats()
+        warnings = ""
+        for mirror in self.tee.mirrors:
+            if mirror.error is not None:
+                warnings += "\nError mirroring to {0}:\n    {1}\n".format(
+                    mirror.root, mirror.error)
+        return warnings
+
+    def publish_mirrors(self):
+        """Publish the mirrors of the (published) session folder.
+
+        Returns
+        -------
+        warnings : str
+            warnings about mirrors that could not be published
+
+        """
+
+        failed = [x for x in self.tee.mirrors if x.error is not None]
+        self.tee.publish()
+        self.report.mirrors = self.tee.stats()
+        warnings = ""
+        for mirror in self.tee.mirrors:
+            if mirror.error is None:
+                try:
+                    self.scheduler.durability.sync_parents(mirror.target,
+                                                           mirror.root)
+                except:
+                    warnings += "\nError syncing mirror in {0} to " \
+                                "disk\n".format(mirror.root)
+            elif mirror not in failed:
+                warnings += "\nError publishing mirror in {0}:\n    " \
+                            "{1}\n".format(mirror.root, mirror.error)
+        return warnings
+
+    def sync(self):
+        """Sync the session folder (and its mirrors) to disk (see
+        `durability`).
+
+        Returns
+        -------
+        warnings : str
+            the warnings
+
+        """
+
+        durability = self.scheduler.durability
+        warnings = ""
+        if durability.mode != "none":
+            self.progress(["Finalization", "Syncing to disk..."], True)
+        try:
+            durability.finish(self.work_folder, self.root)
+        except:
+            warnings += "\nError syncing session folder to disk\n"
+        mirrors = []
+        if self.tee is not None and durability.mode != "none":
+            for mirror in self.tee.mirrors:
+                if mirror.error is not None:
+                    continue
+                try:
+                    durability.finish_mirror(mirror.session_folder,
+                                             mirror.root)
+                    mirrors.append(mirror.root)
+                except Exception as e:
+                    mirror.fail(e)
+                    warnings += "\nError mirroring to {0}:\n    {1}\n" \
+                                "".format(mirror.root, mirror.error)
+        self.report.durability = durability.stats()
+        self.report.durability["mirrors"] = mirrors
+        return warnings
+
+    def transform(self, data):
+        """De-identify and/or re-encode a DICOM file.
+
+        Parameters
+        ----------
+        data : bytes
+            the content of the DICOM file
+
+        Returns
+        -------
+        data : bytes
+            the content of the transformed DICOM file
+
+        """
+
+        if self.deidentifier is not None:
+            data = self.deidentifier.apply(data)
+        if self.encoder is not None:
+            data = self.encode(data)
+        return data
+
+    def encode(self, data):
+        """Re-encode a DICOM file in the process pool (see
+        `transcoding.encode`).
+
+        Parameters
+        ----------
+        data : bytes
+            the content of the DICOM file
+
+        Returns
+        -------
+        data : bytes
+            the content of the re-encoded DICOM file (or the original
+            content)
+
+        """
+
+        encoded, outcome = self.encoder.apply(
+            encode, (data, self.dicom_compression))
+        with self._lock:
+            self.compression[outcome] += 1
+            self.compression["bytes_before"] += len(data)
+            self.compression["bytes_after"] += len(encoded)
+        return encoded
+
+    def read_headers(self):
+        """Read the headers of all DICOM images in the source folder.
+
+        Returns
+        -------
+        scans : dict
+            the DICOM images, as scans[series][instance][echo] with
+            "protocolname", "acquisition_nr" and "filename"
+
+        """
+
+        report = self.report
+        report.start("Reading DICOM images")
+        self.progress(["Preparation", "Reading DICOM images..."], True)
+
+        all_dicoms = []
+        if self.export is None:
+            for root, _, files in os.walk(self.source):
+                for f in files:
+                    if os.path.splitext(f)[-1] in (".dcm", ".IMA"):
+                        all_dicoms.append(os.path.join(root, f))
+            getsize = os.path.getsize
+        else:
+            all_dicoms = [x for x in self.export.paths()
+                          if os.path.splitext(x)[-1] in (".dcm", ".IMA")]
+            getsize = self.export.getsize
+
+        # A file that cannot be read does not abort the scan
+        retry = RetryPolicy.from_config(self.settings)
+        pool = multiprocessing.Pool(self.workers)
+        if self.export is None:
+            headers = pool.imap_unordered(
+                functools.partial(_read_header, retry, readdicom_timed),
+                all_dicoms)
+        else:
+            # Read the headers straight from the export
+            headers = pool.imap_unordered(
+                functools.partial(_read_header, retry,
+                                  export_readdicom_timed),
+                [(self.export.filename, x) for x in all_dicoms])
+
+        if self.profiler is not None:
+            self.profiler.mark("scan index")
+        scans = {}
+        for counter, (item, dicom, latency, error, retries) in enumerate(
+                headers):
+            report.queue("Reading DICOM images",
+                         len(all_dicoms) - counter - 1)
+            percentage = int(
+                round((float(counter) + 1) / len(all_dicoms) * 100))
+            self.progress(["Preparation",
+                           "Reading DICOM images...{0}%".format(percentage)])
+            report.retries += retries
+            if error is not None:
+                self.fail("Reading DICOM images",
+                          item if self.export is None else item[1], error)
+                continue
+            report.add("Reading DICOM images", files=1,
+                       nbytes=getsize(dicom[0]), latency=latency)
+
+            try:
+                scans[dicom[1]]
+            except KeyError:
+                scans[dicom[1]] = {}
+
+            try:
+                scans[dicom[1]][dicom[3]]
+            except KeyError:
+                scans[dicom[1]][dicom[3]] = {}
+
+            scans[dicom[1]][dicom[3]][dicom[5]] = \
+                {"protocolname": dicom[4],
+                    "acquisition_nr": dicom[2],
+                    "filename": dicom[0]}
+        pool.close()
+        if self.profiler is not None:
+            self.profiler.measure("scan index", scans)
+        report.stop("Reading DICOM images")
+        return scans
+
+    def fail(self, phase, filename, error, measurement=None):
+        """Record a file that could not be archived.
+
+        Parameters
+        ----------
+        phase : str
+            the phase of the report
+        filename : str
+            the file
+        error : Exception or str
+            the error (see `retrying.describe`)
+        measurement : int, optional
+            the measurement (default=None)
+
+        Returns
+        -------
+        failure : dict
+            the failed file ("phase", "file", "error" and "measurement")
+
+        """
+
+        if isinstance(error, Exception):
+            error = describe(error)
+        failure = {"phase": phase, "file": filename, "error": error,
+                   "measurement": measurement}
+        with self._lock:
+            self.failed.append(failure)
+        self.report.error(phase)
+        return failure
+
+    def get_failures(self, phase, measurement=None):
+        """Get the files that could not be archived in a phase (see
+        `fail`)."""
+
+        return [x for x in self.failed if x["phase"] == phase and
+                (measurement is None or x["measurement"] == measurement)]
+
+    def archive_measurements(self, scans):
+        """Copy DICOM images and logfiles of all measurements.
+
+        Parameters
+        ----------
+        scans : dict
+            the DICOM images (as returned by `read_headers`)
+
+        Returns
+        -------
+        warnings : str
+            the warnings
+
+        """
+
+        report = self.report
+        measurements = self.protocol.measurements
+        session_folder = self.work_folder
+        warnings = ""
+        for meas_counter, measurement in enumerate(measurements):
+            number = int(measurement.number)
+            type = measurement.type
+            try:
+                vols = int(measurement.vols)
+            except:
+                vols = 0
+            name = measurement.name
+            step = "Measurement {0} ({1} of {2})".format(
+                number, meas_counter + 1, len(measurements))
+            name_folder = None
+
+            if name == "":
+                warnings += "\nError copying images for measurement {0}:\n" \
+                           "    'Name' not specified\n".format(number)
+            elif vols == 0:
+                warnings += "\nError copying images for measurement {0}:\n" \
+                           "    'Vols' not specified\n".format(number)
+            elif scans == {}:
+                warnings += "\nError copying images for measurement {0}:\n" \
+                            "    No images found\n".format(number)
+            else:
+                try:
+                    type_folder = os.path.join(session_folder, type)
+                    if not os.path.exists(type_folder):
+                        os.makedirs(type_folder)
+                    name_folder = os.path.join(
+                        type_folder, repr(number).zfill(3) + "-" + name)
+                    if not os.path.exists(name_folder):
+                        os.makedirs(name_folder)
+                except:
+                    warnings += "\nError creating directory structure for " \
+                                "measurement {0}\n".format(number)
+                    continue
+
+                # DICOMs
+                warnings += self.copy_dicoms(scans, number, name_folder, step)
+
+                # BV Files
+                if self.bv_links == True and self.output_format == "folder":
+                    warnings += self.create_bv_links(
+                        scans, number, name,
+                        os.path.join(name_folder, "DICOM"), step)
+
+            # Logfiles
+            if type != "anat":
+                self.progress([step, "Copying logfiles..."], True)
+                report.start("Copying logfiles", number)
+                try:
+                    warning, measurement.logfiles = copy_logfiles(
+                        measurement.logfiles, self.data_folder, name_folder,
+                        report=report, measurement=number,
+                        archived=self.archived, scheduler=self.scheduler)
+                    if warning != None:
+                        warnings += warning
+
+                except:
+                    warnings += "\nError copying logfiles " \
+                        "for measurement {0}\n".format(number)
+                    report.error("Copying logfiles")
+                report.stop("Copying logfiles", number)
+
+            if name_folder is not None:
+                try:
+                    self.scheduler.durability.folder_complete(name_folder)
+                except:
+                    warnings += "\nError syncing measurement {0} to " \
+                                "disk\n".format(number)
+        return warnings
+
+    def copy_dicoms(self, scans, number, name_folder, step):
+        """Copy the DICOM images of a measurement.
+
+        The images are copied into the folder "DICOM", or into a container
+        file, depending on the output format.
+
+        Returns
+        -------
+        warnings : str
+            the warnings
+
+        """
+
+        report = self.report
+        warnings = ""
+        self.progress([step, "Copying DICOM files..."], True)
+        report.start("Copying DICOM files", number)
+        writer = None
+        dicom_folder = None
+        # Write to the mirrors as well
+        open_target = None if self.tee is None else self.tee.open
+        try:
+            if self.output_format == "folder":
+                dicom_folder = os.path.join(name_folder, "DICOM")
+                if not os.path.exists(dicom_folder):
+                    os.makedirs(dicom_folder)
+                if self.encoder is not None:
+                    operation = functools.partial(_transform, self.transform,
+                                                  export=self.export,
+                                                  open_target=open_target)
+                elif self.deidentifier is not None:
+                    # Rewrite only the header, stream the pixel data
+                    operation = functools.partial(_deidentify,
+                                                  self.deidentifier,
+                                                  export=self.export,
+                                                  open_target=open_target)
+                else:
+                    operation = functools.partial(_copy, export=self.export,
+                                                  open_target=open_target)
+            else:
+                dicom_folder = get_container_filename(name_folder,
+                                                      self.output_format)
+                writer = ContainerWriter(dicom_folder, self.output_format,
+                                         open_target=open_target)
+                # Synced once complete, not after every member
+                self.scheduler.durability.exclude.add(dicom_folder)
+                transform = None
+                if self.encoder is not None or \
+                        self.deidentifier is not None:
+                    transform = self.transform
+                operation = functools.partial(_pack, writer,
+                                              export=self.export,
+                                              transform=transform)
+
+            operations = []
+            for image in scans[number]:
+                for echo in scans[number][image]:
+                    scan = scans[number][image][echo]
+                    if writer is None:
+                        target = os.path.join(dicom_folder, os.path.split(
+                            scan["filename"])[-1])
+                    else:
+                        target = dicom_folder
+                    operations.append((scan["filename"], target, image, echo))
+
+            if self.export is None:
+                operations = self.scheduler.sort(operations)
+            else:
+                operations = self.export.sort(operations)
+            for counter, (operation, result, error) in enumerate(
+                    self.scheduler.map(operation, operations)):
+                src, target, image, echo = operation
+                percentage = int(round(
+                    (float(counter) + 1) / len(operations) * 100))
+                status = "Copying DICOM files...{0}%".format(percentage)
+                if self.tee is not None:
+                    status += self.tee.status()
+                self.progress([step, status])
+                report.queue("Copying DICOM files",
+                             len(operations) - counter - 1)
+                if error is not None:
+                    # Only this image is missing
+                    if writer is None and os.path.exists(target):
+                        os.remove(target)  # partially written
+                    self.fail("Copying DICOM files", src, error, number)
+                    continue
+                scan = scans[number][image][echo]
+                size, sha256, latency = result[:3]
+                record = {"phase": "Copying DICOM files",
+                          "measurement": number, "series": number,
+                          "instance": image, "echo": echo,
+                          "acquisition": scan["acquisition_nr"],
+                          "protocol_name": scan["protocolname"],
+                          "source": os.path.abspath(src),
+                          "target": os.path.abspath(target),
+                          "size": size, "sha256": sha256}
+                if writer is not None:
+                    writer.write(result[3], sha256)
+                    record["member"] = result[3][0]
+                report.add("Copying DICOM files", files=1, nbytes=size,
+                           measurement=number, latency=latency)
+                self.archived.append(record)
+            if writer is not None:
+                writer.close()
+                self.scheduler.durability.exclude.discard(dicom_folder)
+                for filename in (dicom_folder,
+                                 dicom_folder + INDEX_SUFFIX):
+                    self.scheduler.durability.written(filename)
+            failures = self.get_failures("Copying DICOM files", number)
+            if failures:
+                warnings += "\nError copying {0} of {1} images for " \
+                            "measurement {2}:\n".format(
+                                len(failures), len(operations), number)
+                warnings += format_failures(failures)
+        except:
+            warnings += "\nError copying images for measurement " \
+                        "{0}:\n    Filesystem error\n".format(number)
+            report.error("Copying DICOM files")
+            try:
+                if writer is not None:
+                    writer.abort()
+                elif dicom_folder is not None and \
+                        os.path.exists(dicom_folder):
+                    move_to_trash(dicom_folder, self.root)
+            except OSError:
+                pass  # left in the session folder
+            self.archived = [x for x in self.archived
+                             if x.get("measurement") != number or
+                             x["phase"] != "Copying DICOM files"]
+        report.stop("Copying DICOM files", number)
+        return warnings
+
+    def create_bv_links(self, scans, number, name, dicom_folder, step):
+        """Create BrainVoyager links to the DICOM images of a measurement.
+
+        Returns
+        -------
+        warnings : str
+            the warnings
+
+        """
+
+        report = self.report
+        warnings = ""
+        self.progress([step, "Creating BrainVoyager links..."], True)
+        report.start("Creating BrainVoyager links", number)
+        try:
+            bv_folder = os.path.join(self.work_folder, "BV")
+            if not os.path.exists(bv_folder):
+                os.makedirs(bv_folder)
+
+            session_prefix = "_".join(self.protocol.get_filename().split(
+                "_")[1:-1]).replace("-", "")
+            failed = {x["file"] for x in self.get_failures(
+                "Copying DICOM files", number)}
+            links = []
+            for image in scans[number]:
+                for echo in scans[number][image]:
+                    prefix = "{}_{:03d}{}".format(session_prefix, number, name)
+                    if len(scans[number][image]) > 1:
+                        prefix += "_{}".format(echo)
+                    target_name = "{}-{:04d}-{:04d}-{:05d}.dcm".format(
+                        prefix, number,
+                        scans[number][image][echo]["acquisition_nr"],
+                        image)
+                    if self.tbv_files not in \
+                            scans[number][image][echo]["filename"] and \
+                            scans[number][image][echo]["filename"] \
+                            not in failed:
+                        links.append((os.path.join(
+                            dicom_folder,
+                            os.path.split(
+                                scans[number][image][echo]["filename"])[-1]),
+                                      os.path.join(bv_folder, target_name)))
+
+            for counter, (link, result, error) in enumerate(
+                    self.scheduler.map(_link, links)):
+                percentage = int(round((float(counter) + 1) / len(
+                    links) * 100))
+                self.progress(
+                    [step, "Creating BrainVoyager links...{0}%".format(
+                        percentage)])
+                if error is not None:
+                    self.fail("Creating BrainVoyager links", link[1], error,
+                              number)
+                    continue
+                report.add("Creating BrainVoyager links", files=1,
+                           measurement=number, latency=result[1])
+            failures = self.get_failures("Creating BrainVoyager links",
+                                         number)
+            if failures:
+                warnings += "\nError creating {0} BrainVoyager links for " \
+                            "measurement {1}:\n".format(len(failures),
+                                                         number)
+                warnings += format_failures(failures)
+
+        except:
+            warnings += "\nError creating Brain Voyager links "
+            report.error("Creating BrainVoyager links")
+        report.stop("Creating BrainVoyager links", number)
+        return warnings
+
+    def copy_tbv_files(self):
+        """Copy Turbo-BrainVoyager files and create links for them.
+
+        Returns
+        -------
+        warnings : str
+            the warnings
+
+        """
+
+        report = self.report
+        d = self.data_folder
+        tbv_files = self.tbv_files
+        session_folder = self.work_folder
+        warnings = ""
+        self.progress(["Finalization", "Copying Turbo-BrainVoyager files..."],
+                      True)
+        report.start("Copying Turbo-BrainVoyager files")
+        try:
+            tbv_folder = os.path.join(session_folder, "TBV")
+
+            tbv_file_list = []
+            for path, dirs, files in os.walk(os.path.abspath(
+                    os.path.join(d, tbv_files))):
+                for name in files:
+                    tbv_file_list.append(os.path.join(path, name))
+
+            operations = []
+            for src in tbv_file_list:
+                rel_dst = os.path.relpath(src, (os.path.abspath(d)))
+                dst = os.path.abspath(os.path.join(tbv_folder, rel_dst))
+
+                if not os.path.exists(os.path.split(dst)[0]):
+                    os.makedirs(os.path.split(dst)[0])
+                operations.append((src, dst))
+
+            operations = self.scheduler.sort(operations)
+            for counter, ((src, dst), result, error) in enumerate(
+                    self.scheduler.map(_copy, operations)):
+                percentage = int(round(
+                        (float(counter) + 1) / len(tbv_file_list) * 100))
+                self.progress(
+                    ["Finalization",
+                     "Copying Turbo-BrainVoyager files...{0}%".format(
+                         percentage)])
+                report.queue("Copying Turbo-BrainVoyager files",
+                             len(tbv_file_list) - counter - 1)
+                if error is not None:
+                    if os.path.exists(dst):
+                        os.remove(dst)  # partially written
+                    self.fail("Copying Turbo-BrainVoyager files", src, error)
+                    continue
+                size, sha256, latency = result
+                report.add("Copying Turbo-BrainVoyager files", files=1,
+                           nbytes=size, latency=latency)
+                self.archived.append(
+                    {"phase": "Copying Turbo-BrainVoyager files",
+                     "source": os.path.abspath(src), "target": dst,
+                     "size": size, "sha256": sha256})
+            failures = self.get_failures("Copying Turbo-BrainVoyager files")
+            if failures:
+                warnings += "\nError copying {0} Turbo-BrainVoyager " \
+                            "files:\n".format(len(failures))
+                warnings += format_failures(failures)
+
+        except:
+            warnings += "\nError copying Turbo Brain Voyager files "
+            report.error("Copying Turbo-BrainVoyager files")
+        report.stop("Copying Turbo-BrainVoyager files")
+        if self.output_format != "folder":
+            warnings += "\nTurbo-BrainVoyager links are not supported with " \
+                        "container output\n"
+            return warnings
+
+        # Create dcm links
+        self.progress(["Finalization", "Creating Turbo-BrainVoyager links..."],
+                      True)
+        report.start("Creating Turbo-BrainVoyager links")
+        try:
+            tbv_runs = []
+            files = glob.glob(os.path.join(tbv_folder, tbv_files, "*.tbv"))
+            tbvj = False
+            if files == []:
+                files = glob.glob(os.path.join(tbv_folder, tbv_files,
+                                               "*.tbvj"))
+                tbvj = True
+
+            for filename in files:
+                with open(filename) as f:
+                    if tbvj:
+                        data = json.loads(f.read())
+                        run_nr = int(
+                            data["DataFormatInfo"]["DicomFirstVolumeNr"])
+                        run_folder_name = data["Title"]
+                    else:
+                        for line in f.readlines():
+                            if "DicomFirstVolumeNr" in line:
+                                run_nr = int(line.split()[-1].strip(','))
+                            if "Title" in line:
+                                run_folder_name = line.split()[-1].strip(
+                                    ',').replace('"', '')
+
+                    tbv_runs.append([run_folder_name, run_nr])
+
+            tbv_runs.sort(key = lambda x: x[1])
+            session_func = os.path.join(session_folder, "func")
+
+            links = []
+            for run_nr, run in enumerate(tbv_runs):
+                run_folder = glob.glob(os.path.join(
+                    session_func, '{:03d}-{}*'.format(run[1],
+                                                      self.tbv_prefix)))
+                if run_folder != []:
+                    run_folder = run_folder[0]
+                    source_folder = os.path.abspath(os.path.join(
+                                    run_folder, "DICOM"))
+
+                    for volume, image in enumerate(sorted(os.listdir(
+                            source_folder))):
+                        target_name = "001_{:06d}_{:06d}.dcm".format(
+                            run[1], volume + 1)
+                        links.append(
+                            [os.path.join(source_folder, image),
+                             os.path.join(tbv_folder, target_name)])
+
+                    # Change absolute path for prt file to relative path in fmr file
+                try:
+                    if run[0] in os.listdir(os.path.join(tbv_folder,
+                                                         tbv_files)):
+                        fmr_file = os.path.abspath(
+                            os.path.join(tbv_folder, tbv_files, run[0],
+                                         "{}.fmr").format(
+                                             run[0]))
+                        with open(fmr_file) as f:
+                            for line in f.readlines():
+                                if line.startswith("ProtocolFile"):
+                                    prt_path = line.split()[-1]
+
+                        replace(fmr_file, prt_path,
+                                '"./../{}.prt"'.format(run[0]))
+                except:
+                    warnings += "\nError adjusting the protocol path in fmr file for Turbo Brain Voyager "
+                    report.error("Creating Turbo-BrainVoyager links")
+
+            for counter, (link, result, error) in enumerate(
+                    self.scheduler.map(_link, links)):
+                percentage = int(round((float(counter)) / len(links) * 100))
+                self.progress(
+                    ["Finalization",
+                     "Creating Turbo-BrainVoyager links...{0}%".format(
+                         percentage)])
+                report.queue("Creating Turbo-BrainVoyager links",
+                             len(links) - counter - 1)
+                if error is not None:
+                    self.fail("Creating Turbo-BrainVoyager links", link[1],
+                              error)
+                    continue
+                report.add("Creating Turbo-BrainVoyager links", files=1,
+                           latency=result[1])
+            failures = self.get_failures("Creating Turbo-BrainVoyager links")
+            if failures:
+                warnings += "\nError creating {0} Turbo-BrainVoyager " \
+                            "links:\n".format(len(failures))
+                warnings += format_failures(failures)
+
+        except:
+            warnings += "\nError creating dcm links for Turbo Brain Voyager "
+            report.error("Creating Turbo-BrainVoyager links")
+        report.stop("Creating Turbo-BrainVoyager links")
+        return warnings
+
+    def copy_session_files(self):
+        """Copy the files of the session and general documents.
+
+        Returns
+        -------
+        warnings : str
+            the warnings
+
+        """
+
+        report = self.report
+        d = self.data_folder
+        session_folder = self.work_folder
+        warnings = ""
+
+        # Session Files
+        self.progress(["Finalization", "Copying files..."], True)
+        report.start("Copying files")
+        try:
+            warning, self.protocol.files = copy_logfiles(
+                self.protocol.files, d, session_folder, report=report,
+                phase="Copying files", archived=self.archived,
+                scheduler=self.scheduler)
+            if warning != None:
+                warnings += warning
+        except:
+            warnings += "\nError copying Files "
+            report.error("Copying files")
+        report.stop("Copying files")
+
+        # Try general documents
+        report.start("Copying general documents")
+        try:
+            all_documents = 0
+            total_logs = []
+
+            for measurement in self.protocol.measurements:
+                logfiles = measurement.logfiles.split("\n")
+                logfiles = [x.strip() for x in logfiles if x != ""]
+                total_logs.extend(logfiles)
+            for file in glob.glob(os.path.join(d, "*")):
+                if os.path.split(file)[-1] not in total_logs and \
+                    os.path.splitext(file)[-1] in (".txt",
+                                                   ".pdf",
+                                                   ".odt"
+                                                   ".doc",
+                                                   ".docx"):
+                    self.progress(None, True)
+
+                    all_documents += 1
+                    target = os.path.join(os.path.abspath(session_folder),
+                                          os.path.split(file)[-1])
+                    try:
+                        size, sha256 = self.scheduler.call(copy_file, file,
+                                                           target)
+                        shutil.copymode(file, target)
+                    except Exception as e:
+                        if os.path.exists(target):
+                            os.remove(target)  # partially written
+                        self.fail("Copying general documents", file, e)
+                        continue
+                    report.add("Copying general documents", files=1,
+                               nbytes=size)
+                    self.archived.append(
+                        {"phase": "Copying general documents",
+                         "source": os.path.abspath(file), "target": target,
+                         "size": size, "sha256": sha256})
+
+            if all_documents == 0:
+                warnings += "\nNo general documents found\n"
+            failures = self.get_failures("Copying general documents")
+            if failures:
+                warnings += "\nError copying {0} general documents:\n".format(
+                    len(failures))
+                warnings += format_failures(failures)
+        except:
+            warnings += "\nError copying general documents\n"
+            report.error("Copying general documents")
+        report.stop("Copying general documents")
+        return warnings
+
+    def save_protocol(self):
+        """Save the scan protocol into the session folder.
+
+        Returns
+        -------
+        warnings : str
+            the warnings
+
+        """
+
+        report = self.report
+        warnings = ""
+        report.start("Saving scan protocol")
+        try:
+            path = os.path.join(self.work_folder,
+                                self.protocol.get_filename() + ".txt")
+            with open(path, 'w') as f:
+                f.write(self.protocol.format())
+            filenames = [path]
+            if self.settings.get("ProtocolSidecar"):
+                filenames.append(os.path.splitext(path)[0] + ".json")
+                self.protocol.write_json(filenames[-1])
+            for filename in filenames:
+                self.scheduler.durability.written(filename)
+                size, sha256 = hash_file(filename)
+                report.add("Saving scan protocol", files=1, nbytes=size)
+                self.archived.append(
+                    {"phase": "Saving scan protocol",
+                     "target": os.path.abspath(filename), "size": size,
+                     "sha256": sha256})
+        except:
+            warnings += "\nError saving scan protocol\n"
+            report.error("Saving scan protocol")
+        report.stop("Saving scan protocol")
+        return warnings
+
+    def get_records(self):
+        """Get the catalog records of all archived files, with their targets
+        in the archive (rather than in the hidden folder they were written
+        to, or in the spool, if staging).
+
+        Returns
+        -------
+        records : list of dict
+            the catalog records
+
+        """
+
+        records = []
+        for record in self.archived:
+            record = dict(record)
+            record["target"] = os.path.join(
+                os.path.abspath(self.target_folder),
+                os.path.relpath(os.path.abspath(record["target"]),
+                                os.path.abspath(self.work_folder)))
+            records.append(record)
+        return records
+
+    def get_catalog_update(self):
+        """Get the update of the archive catalog recording all archived
+        files (see `catalog.apply_update`).
+
+        Returns
+        -------
+        update : dict
+            the update (None if the catalog is disabled)
+
+        """
+
+        from .catalog import get_catalog_filename
+
+        catalog_file = get_catalog_filename(self.settings)
+        if catalog_file is None:
+            return None
+        protocol = self.protocol
+        return {"filename": os.path.abspath(catalog_file),
+                "path": os.path.abspath(self.target_folder),
+                "source": os.path.abspath(self.source),
+                "protocol": {"project": protocol.project,
+                             "subject": list(protocol.subject),
+                             "session": list(protocol.session),
+                             "date": protocol.date},
+                "files": self.get_records()}
+
+    def update_catalog(self):
+        """Record all archived files in the archive catalog (once the
+        session is published).
+
+        Returns
+        -------
+        warnings : str
+            the warnings
+
+        """
+
+        from .catalog import apply_update
+
+        try:
+            update = self.get_catalog_update()
+            if update is not None:
+                apply_update(update)
+        except:
+            return "\nError updating archive catalog\n"
+        return ""
@@ -0,0 +1,467 @@
+"""Batch.
+
+Archive several scan sessions at once (e.g. at the end of a scan day),
+without the GUI. Each session is given as a pair of a scan protocol file
+and the folder with the data of the session (or a scanner export, see
+`exports`), or is discovered as a folder containing exactly one scan
+protocol file ("ScanProtocol_*.txt").
+
+Sessions are archived concurrently, each in its own process, exactly as
+archiving from the GUI would (see `SessionArchiver`). The number of
+sessions archived at once is limited globally, as well as per device: a
+session occupies both the device of its source folder and the device of the
+archive (and of each mirror, see `tee`), so that sessions read from the same
+(e.g. spinning) disk are not archived all at once. The processes reading
+DICOM images share a global number of CPU workers, and the sessions archived
+at once share the bandwidth limits (see `throttling`).
+
+Usage:
+    scansessiontool-batch TARGET --session PROTOCOL SOURCE [--session ...]
+    scansessiontool-batch TARGET --discover FOLDER [--discover ...]
+
+"""
+
+
+import os
+import sys
+import time
+import json
+import fnmatch
+import argparse
+
+from .protocolindex import PROTOCOL_PATTERN
+from .report import format_bytes
+from .containers import OUTPUT_FORMATS
+from .transcoding import TRANSFER_SYNTAXES
+from .throttling import share_config
+from .staging import Flusher, get_spool
+from .durability import MODES as DURABILITY_MODES
+
+
+def find_sessions(folder):
+    """Find all sessions (folders with a single scan protocol) in a folder.
+
+    Folders of found sessions are not searched any further.
+
+    Parameters
+    ----------
+    folder : str
+        the folder to search (recursively)
+
+    Returns
+    -------
+    sessions : list of (str, str)
+        the scan protocol file and the source folder of each session
+
+    """
+
+    sessions = []
+    for root, dirs, files in os.walk(folder):
+        protocols = fnmatch.filter(files, PROTOCOL_PATTERN)
+        if len(protocols) == 1:
+            sessions.append((os.path.join(root, protocols[0]), root))
+            dirs[:] = []
+        else:
+            dirs.sort()
+    return sorted(sessions)
+
+
+def get_device(path):
+    """Get the device a path is on (or would be on, if it does not exist)."""
+
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return os.stat(path).st_dev
+
+
+def _archive_session(index, protocol_file, source, target, options, settings,
+                     workers, deidentification, results):
+    """Archive a single session (in a worker process)."""
+
+    from .protocol import ScanProtocol
+    from .archiving import SessionArchiver
+
+    result = {"protocol": os.path.abspath(protocol_file),
+              "source": os.path.abspath(source),
+              "session_folder": None,
+              "status": "error",
+              "message": "",
+              "report": None}
+    try:
+        with open(protocol_file) as f:
+            protocol = ScanProtocol.parse(f)
+        archiver = SessionArchiver(
+            protocol, source, target, settings=settings, workers=workers,
+            deidentification=deidentification.get(protocol.project),
+            **options)
+        result["session_folder"] = archiver.session_folder
+        result["message"] = archiver.run()
+        result["status"] = "archived" if archiver.success else "failed"
+        if archiver.report is not None:
+            result["report"] = archiver.report.to_dict()
+    except Exception as e:
+        result["message"] = "Archiving failed: {0}".format(e)
+    results.put((index, result))
+
+
+class BatchArchiver:
+    """Archive several scan sessions concurrently.
+
+    Parameters
+    ----------
+    sessions : list of (str, str)
+        the scan protocol file and the source folder of each session
+    target : str
+        the root folder of the archive
+    bv_links : bool, optional
+        whether to create BrainVoyager links (default=False)
+    tbv_links : bool, optional
+        whether to copy Turbo-BrainVoyager files and create links for them
+        (default=False)
+    tbv_files : str, optional
+        the folder with the Turbo-BrainVoyager files, relative to the source
+        (default="TBVFiles")
+    tbv_prefix : str, optional
+        the name prefix of measurements used in Turbo-BrainVoyager
+        (default="TBV_")
+    settings : dict, optional
+        the site-wide settings (default=None)
+    jobs : int, optional
+        the maximal number of sessions archived at once (default=4)
+    workers : int, optional
+        the number of processes to read DICOM images in, shared by all
+        sessions archived at once (default=None, meaning the number of CPUs)
+    device_limit : int, optional
+        the maximal number of sessions archived at once from or to the same
+        device (default=2)
+    output_format : str, optional
+        the output format of the DICOM images of each measurement (see
+        `containers.OUTPUT_FORMATS`) (default=None, meaning "OutputFormat"
+        of the settings, or "folder")
+    dicom_compression : str, optional
+        the transfer syntax to re-encode DICOM images in losslessly (see
+        `transcoding.TRANSFER_SYNTAXES`) (default=None, meaning
+        "DicomCompression" of the settings, or no re-encoding)
+    deidentification : dict, optional
+        the de-identification profile (see `deidentification`) per project
+        (default=None, meaning no de-identification)
+    mirrors : list of str, optional
+        the root folders of further archives to archive each session to at
+        the same time (see `tee`) (default=None, meaning "Targets" of
+        "Mirrors" of the settings, if any)
+    throttle : dict, optional
+        the bandwidth limits ("Bytes" in MB/s and/or "Files" per second) of
+        all sessions archived at once, overriding those of "Throttle" of the
+        settings (default=None)
+    durability : str, optional
+        how the archived files are synced to disk (see
+        `durability.MODES`) (default=None, meaning "Durability" of the
+        settings, or "directory")
+
+    """
+
+    def __init__(self, sessions, target, bv_links=False, tbv_links=False,
+                 tbv_files="TBVFiles", tbv_prefix="TBV_", settings=None,
+                 jobs=4, workers=None, device_limit=2, output_format=None,
+                 dicom_compression=None, deidentification=None,
+                 mirrors=None, throttle=None, durability=None):
+        self.sessions = list(sessions)
+        self.target = target
+        self.settings = settings or {}
+        if throttle:
+            self.settings = dict(self.settings)
+            self.settings["Throttle"] = dict(
+                self.settings.get("Throttle") or {}, **throttle)
+        if mirrors is None:
+            mirrors = (self.settings.get("Mirrors") or {}).get("Targets")
+        self.mirrors = [os.path.expanduser(str(x)) for x in mirrors or []]
+        self.options = {"bv_links": bv_links, "tbv_links": tbv_links,
+                        "tbv_files": tbv_files, "tbv_prefix": tbv_prefix,
+                        "output_format": output_format,
+                        "dicom_compression": dicom_compression,
+                        "mirrors": self.mirrors,
+                        "durability": durability}
+        self.deidentification = deidentification or {}
+        self.jobs = max(1, jobs)
+        self.workers = workers or os.cpu_count() or 1
+        self.device_limit = max(1, device_limit)
+
+    def run(self, callback=None):
+        """Archive all sessions.
+
+        Parameters
+        ----------
+        callback : callable, optional
+            a function called with the index of a session, and None when it
+            is started or its result when it is finished (default=None)
+
+        Returns
+        -------
+        report : dict
+            the consolidated report of all sessions ("started", "target",
+            "seconds", "total" and "sessions", with the "status" ("archived",
+            "failed" or "error"), "message" and archive "report" of each
+            session)
+
+        """
+
+        import queue
+        import multiprocessing
+
+        started = time.time()
+        start = time.perf_counter()
+        # Sessions are written to the spool first, if staging
+        target = get_spool(self.settings) or self.target
+        target_devices = {get_device(x) for x in [target] + self.mirrors}
+        jobs = min(self.jobs, len(self.sessions)) or 1
+        workers = max(1, self.workers // jobs)
+        settings = dict(self.settings)
+        if settings.get("Throttle"):
+            settings["Throttle"] = share_config(settings["Throttle"], jobs)
+        results = multiprocessing.Queue()
+        pending = []
+        for index, (protocol_file, source) in enumerate(self.sessions):
+            devices = {get_device(source)} | target_devices
+            pending.append((index, protocol_file, source, devices))
+        busy = {}
+        running = {}
+        finished = [None] * len(self.sessions)
+
+        while pending or running:
+            for job in list(pending):
+                if len(running) >= jobs:
+                    break
+                index, protocol_file, source, devices = job
+                if any(busy.get(x, 0) >= self.device_limit
+                       for x in devices):
+                    continue
+                pending.remove(job)
+                for device in devices:
+                    busy[device] = busy.get(device, 0) + 1
+                process = multiprocessing.Process(
+                    target=_archive_session,
+                    args=(index, protocol_file, source, self.target,
+                          self.options, settings, workers,
+                          self.deidentification, results))
+                process.start()
+                running[index] = (process, devices)
+                if callback is not None:
+                    callback(index, None)
+
+            try:
+                index, result = results.get(timeout=1)
+            except queue.Empty:
+                # A process that died without a result is a failed session
+                for index, (process, devices) in list(running.items()):
+                    if not process.is_alive() and results.empty():
+                        protocol_file, source = self.sessions[index]
+                        result = {"protocol": os.path.abspath(protocol_file),
+                                  "source": os.path.abspath(source),
+                                  "session_folder": None, "status": "error",
+                                  "message": "Archiving failed: process "
+                                             "exited with code {0}".format(
+                                                 process.exitcode),
+                                  "report": None}
+                        self._finish(index, result, running, busy, finished,
+                                     callback)
+                continue
+            self._finish(index, result, running, busy, finished, callback)
+
+        return self._consolidate(finished, started,
+                                 time.perf_counter() - start)
+
+    def _finish(self, index, result, running, busy, finished, callback):
+        process, devices = running.pop(index)
+        process.join()
+        for device in devices:
+            busy[device] -= 1
+        finished[index] = result
+        if callback is not None:
+            callback(index, result)
+
+    def _consolidate(self, sessions, started, seconds):
+        files = 0
+        nbytes = 0
+        for session in sessions:
+            if session["report"] is not None:
+                files += session["report"]["total"]["files"]
+                nbytes += session["report"]["total"]["bytes"]
+        return {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                     time.localtime(started)),
+            "target": os.path.abspath(self.target),
+            "seconds": seconds,
+            "total": {
+                "sessions": len(sessions),
+                "archived": sum(x["status"] == "archived" for x in sessions),
+                "failed": sum(x["status"] != "archived" for x in sessions),
+                "files": files,
+                "bytes": nbytes,
+                "bytes_per_second": nbytes / seconds if seconds > 0 else None},
+            "sessions": sessions}
+
+
+def summary(report):
+    """Return a human readable summary of a consolidated report."""
+
+    lines = []
+    for session in report["sessions"]:
+        lines.append("{0}: {1}\n".format(
+            session["status"].capitalize(),
+            session["session_folder"] or session["protocol"]))
+        if session["status"] != "archived":
+            lines.append("    {0}\n".format(session["message"]))
+    total = report["total"]
+    line = "\n{0} of {1} sessions archived: {2} files, {3} in {4:.2f} s".format(
+        total["archived"], total["sessions"], total["files"],
+        format_bytes(total["bytes"]), report["seconds"])
+    if total["bytes_per_second"]:
+        line += " ({0}/s)".format(format_bytes(total["bytes_per_second"]))
+    lines.append(line + "\n")
+    return "".join(lines)
+
+
+def main(argv=None):
+    from .config import load_config
+    from .protocol import ScanProtocol
+
+    parser = argparse.ArgumentParser(
+        prog="scansessiontool-batch",
+        description="Archive several scan sessions at once")
+    parser.add_argument("target", metavar="TARGET",
+                        help="the root folder of the archive")
+    parser.add_argument("-s", "--session", nargs=2, action="append",
+                        default=[], metavar=("PROTOCOL", "SOURCE"),
+                        help="a scan protocol file and the folder with the "
+                             "data of the session (or a zip or tar file "
+                             "exported by the scanner)")
+    parser.add_argument("-d", "--discover", action="append", default=[],
+                        metavar="FOLDER",
+                        help="archive all folders in FOLDER containing a "
+                             "single scan protocol file")
+    parser.add_argument("--bv-links", action="store_true",
+                        help="create BrainVoyager links")
+    parser.add_argument("--tbv-links", action="store_true",
+                        help="copy Turbo-BrainVoyager files and create links")
+    parser.add_argument("--tbv-files", default="TBVFiles", metavar="FOLDER",
+                        help="the folder with the Turbo-BrainVoyager files "
+                             "(default: TBVFiles)")
+    parser.add_argument("--tbv-prefix", default="TBV_", metavar="PREFIX",
+                        help="the name prefix of Turbo-BrainVoyager "
+                             "measurements (default: TBV_)")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS,
+                        help="store the DICOM images of each measurement in "
+                             "a folder or a container file (default: "
+                             "OutputFormat of the settings, or folder)")
+    parser.add_argument("--dicom-compression",
+                        choices=sorted(TRANSFER_SYNTAXES) + ["no"],
+                        help="re-encode DICOM images losslessly in a "
+                             "compressed transfer syntax (default: "
+                             "DicomCompression of the settings, or no)")
+    parser.add_argument("--mirror", action="append", metavar="FOLDER",
+                        help="archive each session to this folder as well, "
+                             "e.g. a backup (can be given several times; "
+                             "default: Mirrors of the settings)")
+    parser.add_argument("--max-bytes", type=float, metavar="MB",
+                        help="the maximal throughput of all sessions "
+                             "archived at once, in MB/s (default: Throttle "
+                             "of the settings, or no limit)")
+    parser.add_argument("--max-files", type=float, metavar="N",
+                        help="the maximal number of files per second of all "
+                             "sessions archived at once (default: Throttle "
+                             "of the settings, or no limit)")
+    parser.add_argument("--durability", choices=DURABILITY_MODES,
+                        help="how the archived files are synced to disk "
+                             "(default: Durability of the settings, or "
+                             "directory)")
+    parser.add_argument("-j", "--jobs", type=int, default=4,
+                        help="the maximal number of sessions archived at "
+                             "once (default: 4)")
+    parser.add_argument("-w", "--workers", type=int,
+                        help="the number of processes reading DICOM images, "
+                             "shared by all sessions (default: number of "
+                             "CPUs)")
+    parser.add_argument("--device-limit", type=int, default=2, metavar="N",
+                        help="the maximal number of sessions archived at "
+                             "once from or to the same device (default: 2)")
+    parser.add_argument("--config", metavar="PATH",
+                        help="the config file or directory (for the site-wide "
+                             "settings)")
+    parser.add_argument("--no-flush", action="store_true",
+                        help="if staging, leave flushing the sessions to the "
+                             "archive to the Scan Session Tool or "
+                             "scansessiontool-flush")
+    parser.add_argument("--report", metavar="FILE",
+                        help="the file to save the consolidated report to "
+                             "(default: batch_report_<timestamp>.json in "
+                             "TARGET)")
+    args = parser.parse_args(argv)
+
+    sessions = [tuple(x) for x in args.session]
+    for folder in args.discover:
+        sessions.extend(find_sessions(folder))
+    if not sessions:
+        parser.error("no sessions given or found")
+    if not os.path.isdir(args.target):
+        parser.error("no such directory: {0}".format(args.target))
+    for folder in args.mirror or []:
+        if not os.path.isdir(folder):
+            parser.error("no such directory: {0}".format(folder))
+
+    # De-identification profiles of the projects of all sessions
+    config = load_config(args.config)
+    deidentification = {}
+    for protocol_file, _ in sessions:
+        try:
+            with open(protocol_file) as f:
+                project = ScanProtocol.parse(f).project
+        except Exception:
+            continue  # reported when archiving
+        if config.get(project) is not None:
+            deidentification[project] = config.get(project).deidentification
+
+    def callback(index, result):
+        if result is None:
+            print("Archiving {0}...".format(sessions[index][0]))
+        else:
+            print("{0}: {1}".format(result["status"].capitalize(),
+                                    result["session_folder"] or
+                                    result["protocol"]))
+
+    archiver = BatchArchiver(sessions, args.target, args.bv_links,
+                             args.tbv_links, args.tbv_files, args.tbv_prefix,
+                             settings=config.settings,
+                             jobs=args.jobs, workers=args.workers,
+                             device_limit=args.device_limit,
+                             output_format=args.format,
+                             dicom_compression=args.dicom_compression,
+                             deidentification=deidentification,
+                             mirrors=args.mirror,
+                             throttle={key: value for key, value in
+                                       (("Bytes", args.max_bytes),
+                                        ("Files", args.max_files))
+                                       if value},
+                             durability=args.durability)
+    report = archiver.run(callback)
+    filename = args.report or os.path.join(
+        args.target, "batch_report_{0}.json".format(
+            time.strftime("%Y%m%d-%H%M%S")))
+    with open(filename, 'w') as f:
+        json.dump(report, f, indent=4)
+    print("\n" + summary(report))
+    print("Report saved to: {0}".format(filename))
+    flusher = Flusher.from_config(config.settings)
+    if flusher is not None and not args.no_flush:
+        print("\nFlushing staged sessions to the archive...")
+        flusher.flush_all(retry_failed=True)
+        print(flusher.details())
+    if report["total"]["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""Catalog.
+
+A catalog of all files archived by Scan Session Tool, stored in an SQLite
+database. For every archived file, its source and target path, size and
+SHA-256 hash are recorded, as well as the session it belongs to and (for
+DICOM files) its series, instance and echo number and protocol name. Files
+archived into a container (see `containers`) have the container as target,
+and their name in the container as member.
+
+The catalog is filled by the archiving procedure itself (from what it knows
+anyway), so it can answer questions across sessions without touching the
+archive, e.g. which series were acquired with a certain protocol, or how
+much data was archived per project.
+
+The catalog is stored in the cache directory by default, or where configured
+in the "Settings" section of the config file:
+
+    Settings:
+        Catalog:  /path/to/archive_catalog.sqlite
+
+("Catalog: no" disables the catalog.)
+
+Usage:
+    scansessiontool-catalog series [PROTOCOL_NAME] [--project PROJECT]
+    scansessiontool-catalog totals
+    scansessiontool-catalog files [--source PATTERN] [--sha256 HASH] ...
+
+"""
+
+
+import os
+import sys
+import time
+import types
+import sqlite3
+import argparse
+
+from .config import get_cache_dir
+
+
+CATALOG_FILENAME = "archive_catalog.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    source TEXT,
+    archived TEXT,
+    project TEXT,
+    subject INTEGER,
+    subject_type TEXT,
+    session INTEGER,
+    session_type TEXT,
+    date TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    session_id INTEGER NOT NULL REFERENCES sessions(id) ON DELETE CASCADE,
+    phase TEXT,
+    measurement INTEGER,
+    series INTEGER,
+    instance INTEGER,
+    echo INTEGER,
+    acquisition INTEGER,
+    protocol_name TEXT,
+    source TEXT,
+    target TEXT,
+    member TEXT,
+    size INTEGER,
+    sha256 TEXT
+);
+CREATE INDEX IF NOT EXISTS sessions_project ON sessions(project);
+CREATE INDEX IF NOT EXISTS files_session ON files(session_id, series);
+CREATE INDEX IF NOT EXISTS files_protocol_name ON files(protocol_name);
+CREATE INDEX IF NOT EXISTS files_source ON files(source);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files(sha256);
+"""
+
+# The fields of a file record (missing fields are stored as NULL)
+FILE_FIELDS = ("phase", "measurement", "series", "instance", "echo",
+               "acquisition", "protocol_name", "source", "target", "member",
+               "size", "sha256")
+
+
+def get_catalog_filename(settings):
+    """Get the catalog database configured in the settings.
+
+    Parameters
+    ----------
+    settings : dict
+        the "Settings" section of the config
+
+    Returns
+    -------
+    filename : str or None
+        the name of the catalog database (None if disabled)
+
+    """
+
+    filename = settings.get("Catalog", True)
+    if filename is False or filename is None:
+        return None
+    if filename is True:
+        return os.path.join(get_cache_dir(), CATALOG_FILENAME)
+    return os.path.expanduser(str(filename))
+
+
+class ArchiveCatalog:
+    """A catalog of archived files.
+
+    Parameters
+    ----------
+    filename : str, optional
+        the name of the catalog database (default=None, meaning
+        "archive_catalog.sqlite" in the cache directory)
+
+    """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(get_cache_dir(), CATALOG_FILENAME)
+        folder = os.path.split(os.path.abspath(filename))[0]
+        os.makedirs(folder, exist_ok=True)
+        self.filename = filename
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+        # Catalogs created before files could be archived into containers
+        columns = [x[1] for x in self.db.execute("PRAGMA table_info(files)")]
+        if "member" not in columns:
+            self.db.execute("ALTER TABLE files ADD COLUMN member TEXT")
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add_session(self, path, source, protocol, files):
+        """Add an archived session with all its files.
+
+        A session previously archived to the same path is replaced.
+
+        Parameters
+        ----------
+        path : str
+            the session folder in the archive
+        source : str
+            the folder the session was archived from
+        protocol : ScanProtocol
+            the scan protocol of the session
+        files : list of dict
+            the archived files, with the fields in `FILE_FIELDS`
+
+        Returns
+        -------
+        session_id : int
+            the id of the session in the catalog
+
+        """
+
+        def to_int(value):
+            try:
+                return int(value)
+            except ValueError:
+                return None
+
+        path = os.path.abspath(path)
+        with self.db:
+            self.db.execute("DELETE FROM sessions WHERE path = ?", (path,))
+            cursor = self.db.execute(
+                "INSERT INTO sessions (path, source, archived, project, "
+                "subject, subject_type, session, session_type, date) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (path, os.path.abspath(source),
+                 time.strftime("%Y-%m-%dT%H:%M:%S"), protocol.project,
+                 to_int(protocol.subject[0]), protocol.subject[1],
+                 to_int(protocol.session[0]), protocol.session[1],
+                 protocol.date))
+            session_id = cursor.lastrowid
+            self.db.executemany(
+                "INSERT INTO files (session_id, {0}) VALUES (?, {1})".format(
+                    ", ".join(FILE_FIELDS),
+                    ", ".join("?" * len(FILE_FIELDS))),
+                [[session_id] + [x.get(field) for field in FILE_FIELDS]
+                 for x in files])
+        return session_id
+
+    def series(self, protocol_name=None, project=None, limit=None):
+        """Get archived DICOM series.
+
+        Parameters
+        ----------
+        protocol_name : str, optional
+            the protocol name of the series; can contain wildcards ("*",
+            "?") (default=None)
+        project : str, optional
+            the project (default=None)
+        limit : int, optional
+            the maximal number of results (default=None)
+
+        Returns
+        -------
+        results : list of sqlite3.Row
+            the matching series ("project", "subject", "subject_type",
+            "session", "session_type", "date", "path", "series",
+            "protocol_name", "measurement", "files", "bytes")
+
+        """
+
+        query = "SELECT s.project, s.subject, s.subject_type, s.session, " \
+            "s.session_type, s.date, s.path, f.series, f.protocol_name, " \
+            "f.measurement, count(*) AS files, sum(f.size) AS bytes " \
+            "FROM files f JOIN sessions s ON f.session_id = s.id " \
+            "WHERE f.series IS NOT NULL"
+        args = []
+        if protocol_name is not None:
+            query += " AND f.protocol_name GLOB ?"
+            args.append(protocol_name)
+        if project is not None:
+            query += " AND s.project = ?"
+            args.append(project)
+        query += " GROUP BY f.session_id, f.series ORDER BY s.project, " \
+            "s.subject, s.session, s.path, f.series"
+        if limit is not None:
+            query += " LIMIT ?"
+            args.append(limit)
+        return self.db.execute(query, args).fetchall()
+
+    def totals(self):
+        """Get the number of archived sessions, files and bytes per project.
+
+        Returns
+        -------
+        results : list of sqlite3.Row
+            the totals per project ("project", "sessions", "files",
+            "bytes")
+
+        """
+
+        return self.db.execute(
+            "SELECT s.project, count(DISTINCT s.id) AS sessions, "
+            "count(f.session_id) AS files, coalesce(sum(f.size), 0) AS bytes "
+            "FROM sessions s LEFT JOIN files f ON f.session_id = s.id "
+            "GROUP BY s.project ORDER BY s.project").fetchall()
+
+    def files(self, source=None, target=None, sha256=None, project=None,
+              limit=None):
+        """Get archived files.
+
+        Parameters
+        ----------
+        source : str, optional
+            the source path; can contain wildcards ("*", "?") (default=None)
+        target : str, optional
+            the target path; can contain wildcards ("*", "?") (default=None)
+        sha256 : str, optional
+            the SHA-256 hash (default=None)
+        project : str, optional
+            the project (default=None)
+        limit : int, optional
+            the maximal number of results (default=None)
+
+        Returns
+        -------
+        results : list of sqlite3.Row
+            the matching files ("project", "path" of the session and all
+            fields in `FILE_FIELDS`)
+
+        """
+
+        query = "SELECT s.project, s.path, {0} FROM files f JOIN sessions s " \
+            "ON f.session_id = s.id".format(
+                ", ".join("f." + x for x in FILE_FIELDS))
+        where = []
+        args = []
+        for column, value in (("f.source", source), ("f.target", target)):
+            if value is not None:
+                where.append("{0} GLOB ?".format(column))
+                args.append(value)
+        if sha256 is not None:
+            where.append("f.sha256 = ?")
+            args.append(sha256.lower())
+        if project is not None:
+            where.append("s.project = ?")
+            args.append(project)
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY s.path, f.target"
+        if limit is not None:
+            query += " LIMIT ?"
+            args.append(limit)
+        return self.db.execute(query, args).fetchall()
+
+
+def apply_update(update):
+    """Add an archived session to the catalog once it is in the archive.
+
+    Parameters
+    ----------
+    update : dict
+        the catalog database ("filename"), the session folder in the
+        archive ("path"), the folder it was archived from ("source"), the
+        "project", "subject", "session" and "date" of its scan protocol
+        ("protocol") and its archived files ("files"), as JSON-serializable
+        data (e.g. to apply it only after the session was flushed, see
+        `staging`)
+
+    """
+
+    protocol = types.SimpleNamespace(**update["protocol"])
+    with ArchiveCatalog(update["filename"]) as catalog:
+        catalog.add_session(update["path"], update["source"], protocol,
+                            update["files"])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="scansessiontool-catalog",
+        description="Query the catalog of archived files")
+    parser.add_argument("--catalog", metavar="FILE",
+                        help="the catalog database (default: {0} in the "
+                             "cache directory)".format(CATALOG_FILENAME))
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    series = subparsers.add_parser(
+        "series", help="list archived DICOM series")
+    series.add_argument("protocol_name", nargs="?", metavar="PROTOCOL_NAME",
+                        help="the protocol name (wildcards allowed)")
+    series.add_argument("--project", help="the project")
+    series.add_argument("--limit", type=int,
+                        help="the maximal number of results")
+
+    subparsers.add_parser(
+        "totals", help="list the number of archived sessions, files and "
+                       "bytes per project")
+
+    files = subparsers.add_parser("files", help="list archived files")
+    files.add_argument("--source", metavar="PATTERN",
+                       help="the source path (wildcards allowed)")
+    files.add_argument("--target", metavar="PATTERN",
+                       help="the target path (wildcards allowed)")
+    files.add_argument("--sha256", metavar="HASH", help="the SHA-256 hash")
+    files.add_argument("--project", help="the project")
+    files.add_argument("--limit", type=int,
+                       help="the maximal number of results")
+    args = parser.parse_args(argv)
+
+    if args.catalog is not None and not os.path.isfile(args.catalog):
+        sys.exit("No such catalog: {0}".format(args.catalog))
+    with ArchiveCatalog(args.catalog) as catalog:
+        if args.command == "series":
+            for row in catalog.series(args.protocol_name, args.project,
+                                      args.limit):
+                print("{0}\t{1}\t{2:03d}\t{3}\t{4}\t{5}".format(
+                    row["project"], row["path"], row["series"],
+                    row["protocol_name"], row["files"], row["bytes"]))
+        elif args.command == "totals":
+            for row in catalog.totals():
+                print("{0}\t{1}\t{2}\t{3}".format(
+                    row["project"], row["sessions"], row["files"],
+                    row["bytes"]))
+        else:
+            for row in catalog.files(args.source, args.target, args.sha256,
+                                     args.project, args.limit):
+                target = row["target"]
+                if row["member"]:
+                    target += ":" + row["member"]
+                print("{0}\t{1}\t{2}\t{3}".format(
+                    row["source"] or "", target, row["size"],
+                    row["sha256"]))
+
+
+if __name__ == "__main__":
+    main()
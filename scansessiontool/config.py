@@ -0,0 +1,391 @@
+"""Config.
+
+Loading of the Scan Session Tool config file (sst.yaml) or config directory
+(sst.d).
+
+YAML files are compiled once into indexed project configs, which are cached
+in binary (pickle) form. The cache is validated against the modification time
+and size of the YAML file, so the YAML parser is only needed when a config
+file has changed.
+
+A config directory holds one YAML file per project (with the content of a
+single project entry of sst.yaml), named after the project. An optional
+index file ("index.yaml") can map project names to file names (under
+"Projects") and hold the site-wide "Settings". Projects in a config directory
+are only loaded when they are selected, and a number of recently used
+projects is kept in memory.
+
+"""
+
+
+import os
+import pickle
+import hashlib
+import warnings
+from collections import OrderedDict
+
+
+CONFIG_FILENAME = "sst.yaml"
+CONFIG_DIRNAME = "sst.d"
+INDEX_FILENAME = "index.yaml"
+SETTINGS_KEY = "Settings"
+PROJECTS_KEY = "Projects"
+MEASUREMENT_TYPES = ("anat", "func", "misc")
+
+# Increase whenever the compiled form changes, to invalidate old caches
+CACHE_FORMAT = 2
+
+
+def find_config():
+    """Find the config file or directory.
+
+    The config file (or directory) is looked for in the current working
+    directory, the home directory and the package directory (in that order).
+    Within a location, a config file takes precedence over a config
+    directory.
+
+    Returns
+    -------
+    path : str or None
+        the path of the config file or directory, or None if none was found
+
+    """
+
+    for folder in (os.path.curdir, os.path.expanduser("~"),
+                   os.path.split(__file__)[0]):
+        path = os.path.join(folder, CONFIG_FILENAME)
+        if os.path.isfile(path):
+            return os.path.abspath(path)
+        path = os.path.join(folder, CONFIG_DIRNAME)
+        if os.path.isdir(path):
+            return os.path.abspath(path)
+
+
+def get_cache_dir():
+    """Get the directory to store cached compiled configs in."""
+
+    if "SST_CACHE_DIR" in os.environ:
+        return os.environ["SST_CACHE_DIR"]
+    if os.name == "nt" and "LOCALAPPDATA" in os.environ:
+        base = os.environ["LOCALAPPDATA"]
+    else:
+        base = os.environ.get("XDG_CACHE_HOME",
+                              os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "scansessiontool")
+
+
+class ProjectConfig:
+    """The config of a single project, with precomputed indexes.
+
+    Parameters
+    ----------
+    name : str
+        the name of the project
+    data : dict
+        the (parsed) config of the project
+
+    """
+
+    def __init__(self, name, data):
+        if not isinstance(data, dict):
+            data = {}
+        self.name = name
+
+        def as_list(key):
+            value = data.get(key)
+            if value is None:
+                return []
+            return [str(x) for x in value]
+
+        self.subject_types = as_list("SubjectTypes")
+        self.session_types = as_list("SessionTypes")
+        self.users = as_list("Users")
+        self.files = as_list("Files")
+        self.checklist = as_list("Checklist")
+        self.notes = data.get("Notes")
+        self.deidentification = data.get("Deidentification")
+
+        # Name -> measurement and sorted name completions, per type
+        self.measurements = {}
+        self.completions = {}
+        for type_ in MEASUREMENT_TYPES:
+            index = {}
+            for measurement in data.get("Measurements " + type_) or []:
+                try:
+                    name = str(measurement["Name"])
+                except (KeyError, TypeError):
+                    continue
+                index.setdefault(name, measurement)
+            self.measurements[type_] = index
+            self.completions[type_] = sorted(index.keys(), key=str.lower)
+
+    def get_measurement(self, type_, name):
+        """Get the config of a measurement.
+
+        Parameters
+        ----------
+        type_ : str
+            the type of the measurement ("anat", "func" or "misc")
+        name : str
+            the name of the measurement
+
+        Returns
+        -------
+        measurement : dict or None
+            the config of the measurement ("Name", "Vols", "Comments"), or
+            None if the measurement is not specified in the config
+
+        """
+
+        try:
+            return self.measurements[type_][name]
+        except KeyError:
+            return None
+
+    def get_completions(self, type_):
+        """Get the sorted measurement names of a type.
+
+        Parameters
+        ----------
+        type_ : str
+            the type of the measurements ("anat", "func" or "misc")
+
+        Returns
+        -------
+        names : list of str
+            the sorted measurement names
+
+        """
+
+        return self.completions.get(type_, [])
+
+
+class Config:
+    """The compiled config of Scan Session Tool.
+
+    Parameters
+    ----------
+    projects : dict, optional
+        the project configs by project name (default=None)
+    settings : dict, optional
+        the site-wide settings (default=None)
+
+    """
+
+    def __init__(self, projects=None, settings=None):
+        self._projects = projects or {}
+        self.settings = settings or {}
+        self.projects = sorted(self._projects.keys(), key=str.lower)
+
+    @classmethod
+    def compile(cls, data):
+        """Compile a parsed config file.
+
+        Parameters
+        ----------
+        data : dict
+            the parsed config file
+
+        Returns
+        -------
+        config : Config
+            the compiled config
+
+        """
+
+        if not isinstance(data, dict):
+            data = {}
+        data = dict(data)
+        settings = data.pop(SETTINGS_KEY, None)
+        return cls({str(name): ProjectConfig(str(name), project)
+                    for name, project in data.items()}, settings)
+
+    def get(self, name):
+        """Get the config of a project.
+
+        Parameters
+        ----------
+        name : str
+            the name of the project
+
+        Returns
+        -------
+        project : ProjectConfig or None
+            the config of the project, or None if it does not exist
+
+        """
+
+        return self._projects.get(name)
+
+    def __contains__(self, name):
+        return name in self._projects
+
+    def __len__(self):
+        return len(self.projects)
+
+
+class LazyConfig(Config):
+    """The config of Scan Session Tool from a config directory.
+
+    Projects are loaded (and compiled) on first access, and the most recently
+    used projects are kept in memory.
+
+    Parameters
+    ----------
+    files : dict
+        the paths of the project config files by project name
+    settings : dict, optional
+        the site-wide settings (default=None)
+    cache_size : int, optional
+        the number of recently used projects to keep in memory (default=8)
+    use_cache : bool, optional
+        whether to use (and update) cached compiled project configs
+        (default=True)
+
+    Attributes
+    ----------
+    errors : dict
+        the error of each project whose config file could not be loaded
+        (when it was last accessed)
+
+    """
+
+    def __init__(self, files, settings=None, cache_size=8, use_cache=True):
+        Config.__init__(self, settings=settings)
+        self._files = files
+        self.errors = {}
+        self.projects = sorted(files.keys(), key=str.lower)
+        self.cache_size = cache_size
+        self.use_cache = use_cache
+        self._recent = OrderedDict()
+
+    def get(self, name):
+        try:
+            self._recent.move_to_end(name)
+            return self._recent[name]
+        except KeyError:
+            pass
+        try:
+            path = self._files[name]
+        except KeyError:
+            return None
+        try:
+            project = _load_yaml(path,
+                                 lambda data: ProjectConfig(name, data),
+                                 self.use_cache)
+        except Exception as e:
+            # Loaded on first access (e.g. from the GUI), not at startup
+            import yaml
+            if not isinstance(e, (OSError, yaml.YAMLError)):
+                raise
+            self.errors[name] = "{0}: {1}".format(path, e)
+            warnings.warn("Could not load the config of project {0} "
+                          "({1})".format(name, self.errors[name]))
+            return None
+        self.errors.pop(name, None)
+        self._recent[name] = project
+        while len(self._recent) > self.cache_size:
+            self._recent.popitem(last=False)
+        return project
+
+    def __contains__(self, name):
+        return name in self._files
+
+
+def _cache_filename(path):
+    digest = hashlib.sha1(path.encode("utf-8")).hexdigest()
+    return os.path.join(get_cache_dir(), "config-{0}.pickle".format(digest))
+
+
+def _load_yaml(path, compile, use_cache=True):
+    """Load and compile a YAML file, using the cached compiled form if valid.
+
+    Parameters
+    ----------
+    path : str
+        the path of the YAML file
+    compile : callable
+        a function compiling the parsed YAML file
+    use_cache : bool, optional
+        whether to use (and update) the cached compiled form (default=True)
+
+    Returns
+    -------
+    compiled : object
+        the compiled YAML file
+
+    """
+
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (CACHE_FORMAT, path, stat.st_mtime_ns, stat.st_size)
+
+    cache = _cache_filename(path)
+    if use_cache:
+        try:
+            with open(cache, 'rb') as f:
+                cached_key, compiled = pickle.load(f)
+            if cached_key == key:
+                return compiled
+        except Exception:
+            pass
+
+    import yaml  # only needed when the cache is outdated
+
+    with open(path) as f:
+        compiled = compile(yaml.safe_load(f))
+
+    if use_cache:
+        try:
+            os.makedirs(os.path.split(cache)[0], exist_ok=True)
+            tmp = cache + ".{0}.tmp".format(os.getpid())
+            with open(tmp, 'wb') as f:
+                pickle.dump((key, compiled), f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, cache)
+        except OSError:
+            pass
+    return compiled
+
+
+def _load_config_dir(path, use_cache=True):
+    files = {}
+    settings = None
+    index = os.path.join(path, INDEX_FILENAME)
+    if os.path.isfile(index):
+        data = _load_yaml(index, lambda data: data or {}, use_cache)
+        settings = data.get(SETTINGS_KEY)
+        for name, filename in (data.get(PROJECTS_KEY) or {}).items():
+            files[str(name)] = os.path.join(path, str(filename))
+    else:
+        for filename in os.listdir(path):
+            name, ext = os.path.splitext(filename)
+            if ext in (".yaml", ".yml") and filename != INDEX_FILENAME:
+                files[name] = os.path.join(path, filename)
+    return LazyConfig(files, settings, use_cache=use_cache)
+
+
+def load_config(path=None, use_cache=True):
+    """Load a config file or directory.
+
+    Parameters
+    ----------
+    path : str, optional
+        the path of the config file or directory (default=None, meaning look
+        for it with `find_config`)
+    use_cache : bool, optional
+        whether to use (and update) cached compiled configs (default=True)
+
+    Returns
+    -------
+    config : Config
+        the compiled config (empty if no config file was found)
+
+    """
+
+    if path is None:
+        path = find_config()
+        if path is None:
+            return Config()
+    if os.path.isdir(path):
+        return _load_config_dir(path, use_cache)
+    return _load_yaml(path, Config.compile, use_cache)
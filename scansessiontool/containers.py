@@ -0,0 +1,254 @@
+"""Containers.
+
+Container files to archive the DICOM images of a measurement in, instead of
+a folder with thousands of small files: a tar file (optionally gzip or zstd
+compressed), or an uncompressed zip file.
+
+Compressed tar files consist of one gzip member (or zstd frame) per file,
+which standard tools read as a single stream, but which can be compressed
+independently (in parallel) and decompressed individually. Next to each tar
+file, an index ("<container>.index.json") records where each file is, so
+that a single image can be read without reading the whole container (see
+`read_member`). Zip files have such an index (their central directory)
+built in.
+
+"""
+
+
+import os
+import json
+import time
+import zlib
+import tarfile
+import zipfile
+
+
+CONTAINER_FORMATS = ("tar", "tar.gz", "tar.zst", "zip")
+OUTPUT_FORMATS = ("folder",) + CONTAINER_FORMATS
+INDEX_SUFFIX = ".index.json"
+
+_BLOCK = tarfile.BLOCKSIZE
+
+
+def get_container_filename(folder, format, name="DICOM"):
+    """Get the file name of a container.
+
+    Parameters
+    ----------
+    folder : str
+        the folder of the container
+    format : str
+        the container format (see `CONTAINER_FORMATS`)
+    name : str, optional
+        the name of the container, without extension (default="DICOM")
+
+    Returns
+    -------
+    filename : str
+        the file name of the container
+
+    """
+
+    return os.path.join(folder, "{0}.{1}".format(name, format))
+
+
+def zstd_available():
+    try:
+        import zstandard
+    except ImportError:
+        return False
+    return True
+
+
+class ContainerWriter:
+    """Write files into a container.
+
+    Files are added in two steps: `pack` prepares (and compresses) a file and
+    can be called from several threads at once, `write` appends a packed file
+    to the container and must be called from one thread only.
+
+    Parameters
+    ----------
+    filename : str
+        the name of the container file
+    format : str
+        the container format (see `CONTAINER_FORMATS`)
+    level : int, optional
+        the compression level (default=None, meaning the default level of
+        the compression)
+    open_target : callable, optional
+        the function to open the container file for writing with
+        (default=None, meaning `open(filename, 'wb')`)
+
+    """
+
+    def __init__(self, filename, format, level=None, open_target=None):
+        if format not in CONTAINER_FORMATS:
+            raise ValueError("Unknown container format: {0}".format(format))
+        self.filename = filename
+        self.format = format
+        self.level = level
+        self.members = {}
+        self._offset = 0
+        if format == "tar.zst":
+            import zstandard  # optional dependency
+            self._zstd = zstandard
+        if open_target is None:
+            self._raw = open(filename, 'wb')
+        else:
+            self._raw = open_target(filename)
+        if format == "zip":
+            self._file = zipfile.ZipFile(self._raw, 'w', zipfile.ZIP_STORED,
+                                         allowZip64=True)
+        else:
+            self._file = self._raw
+
+    def _compress(self, block):
+        if self.format == "tar.gz":
+            level = 6 if self.level is None else self.level
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            return compressor.compress(block) + compressor.flush()
+        elif self.format == "tar.zst":
+            level = 3 if self.level is None else self.level
+            return self._zstd.ZstdCompressor(level=level).compress(block)
+        return block
+
+    def pack(self, name, data, mtime=0):
+        """Prepare a file to be written into the container (thread-safe).
+
+        Parameters
+        ----------
+        name : str
+            the name of the file in the container
+        data : bytes
+            the content of the file
+        mtime : float, optional
+            the modification time of the file (default=0)
+
+        Returns
+        -------
+        packed : tuple
+            the packed file (to be given to `write`)
+
+        """
+
+        if self.format == "zip":
+            return name, data, 0, len(data), mtime
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(mtime)
+        info.mode = 0o644
+        header = info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+        padding = b"\0" * (-len(data) % _BLOCK)
+        return (name, self._compress(header + data + padding), len(header),
+                len(data), mtime)
+
+    def write(self, packed, sha256=None):
+        """Append a packed file to the container.
+
+        Parameters
+        ----------
+        packed : tuple
+            the packed file (as returned by `pack`)
+        sha256 : str, optional
+            the SHA-256 hash of the file, to be recorded in the index
+            (default=None)
+
+        """
+
+        name, block, data_offset, size, mtime = packed
+        if self.format == "zip":
+            # Zip files cannot store times before 1980
+            info = zipfile.ZipInfo(
+                name, time.localtime(max(mtime, 315619200))[:6])
+            info.external_attr = 0o644 << 16
+            self._file.writestr(info, block)
+        else:
+            self._file.write(block)
+            self.members[name] = {"offset": self._offset,
+                                  "length": len(block),
+                                  "data_offset": data_offset,
+                                  "size": size,
+                                  "sha256": sha256}
+            self._offset += len(block)
+
+    def close(self):
+        """Finish the container (and write its index)."""
+
+        if self.format == "zip":
+            self._file.close()
+            self._raw.close()
+            return
+        self._file.write(self._compress(b"\0" * (2 * _BLOCK)))
+        self._file.close()
+        with open(self.filename + INDEX_SUFFIX, 'w') as f:
+            json.dump({"format": self.format,
+                       "members": self.members}, f, indent=1)
+
+    def abort(self):
+        """Close and remove the (incomplete) container."""
+
+        try:
+            self._raw.close()
+        finally:
+            for filename in (self.filename, self.filename + INDEX_SUFFIX):
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+
+def list_members(filename):
+    """List the files in a container.
+
+    Parameters
+    ----------
+    filename : str
+        the name of the container file
+
+    Returns
+    -------
+    names : list of str
+        the names of the files in the container
+
+    """
+
+    if filename.endswith(".zip"):
+        with zipfile.ZipFile(filename) as f:
+            return f.namelist()
+    with open(filename + INDEX_SUFFIX) as f:
+        return list(json.load(f)["members"])
+
+
+def read_member(filename, name):
+    """Read a single file from a container, without reading the whole
+    container.
+
+    Parameters
+    ----------
+    filename : str
+        the name of the container file
+    name : str
+        the name of the file in the container
+
+    Returns
+    -------
+    data : bytes
+        the content of the file
+
+    """
+
+    if filename.endswith(".zip"):
+        with zipfile.ZipFile(filename) as f:
+            return f.read(name)
+    with open(filename + INDEX_SUFFIX) as f:
+        index = json.load(f)
+    member = index["members"][name]
+    with open(filename, 'rb') as f:
+        f.seek(member["offset"])
+        block = f.read(member["length"])
+    if index["format"] == "tar.gz":
+        block = zlib.decompress(block, 31)
+    elif index["format"] == "tar.zst":
+        import zstandard
+        block = zstandard.ZstdDecompressor().decompress(block)
+    start = member["data_offset"]
+    return block[start:start + member["size"]]
@@ -0,0 +1,271 @@
+"""De-identification.
+
+De-identification of DICOM images while archiving, configured per project in
+the config file:
+
+    Project 1:
+        Deidentification:
+            Pseudonym:  "{project}-sub-{subject}"
+            Remove:
+                - PatientSize
+            Keep:
+                - PatientSex
+            RemovePrivateTags: no
+            Log:        ~/deidentification_log.jsonl
+
+("Deidentification: yes" uses the defaults.)
+
+PatientName and PatientID are replaced by the pseudonym, the attributes in
+`EMPTY` are emptied and the attributes in `REMOVE` (plus "Remove") are
+removed, except for the attributes in "Keep" (also in the items of
+sequences, e.g. ReferencedPatientSequence). Only the header of an image is
+rewritten; its pixel data (and everything after it) is copied unchanged.
+
+The original values of the replaced attributes are appended to a log file
+(JSON lines, by default in the cache directory), together with the
+pseudonym and the session folder, to allow for re-identification. The log
+is never written into the archive.
+
+"""
+
+
+import io
+import os
+import json
+import time
+import hashlib
+import threading
+
+from .config import get_cache_dir
+
+
+LOG_FILENAME = "deidentification_log.jsonl"
+DEFAULT_PSEUDONYM = "{project}-sub-{subject}"
+
+# Attributes replaced by the pseudonym
+REPLACE = ("PatientName", "PatientID")
+
+# Attributes emptied (required to be present, but allowed to be empty)
+EMPTY = ("PatientBirthDate", "PatientSex", "ReferringPhysicianName",
+         "AccessionNumber", "StudyID")
+
+# Attributes removed
+REMOVE = ("PatientBirthTime", "PatientAge", "PatientAddress",
+          "PatientTelephoneNumbers", "PatientMotherBirthName",
+          "OtherPatientIDs", "OtherPatientIDsSequence", "OtherPatientNames",
+          "PatientBirthName", "MilitaryRank", "BranchOfService",
+          "Occupation", "AdditionalPatientHistory", "PatientComments",
+          "MedicalRecordLocator", "InstitutionName", "InstitutionAddress",
+          "InstitutionalDepartmentName", "StationName",
+          "PerformingPhysicianName", "NameOfPhysiciansReadingStudy",
+          "PhysiciansOfRecord", "OperatorsName", "RequestingPhysician",
+          "ReferringPhysicianAddress", "ReferringPhysicianTelephoneNumbers",
+          "DeviceSerialNumber")
+
+# Original values recorded in the log
+LOGGED = ("PatientName", "PatientID", "PatientBirthDate", "PatientSex")
+
+_DEFLATED = "1.2.840.10008.1.2.1.99"
+
+
+def get_log_filename(profile):
+    """Get the re-identification log configured in a profile.
+
+    Parameters
+    ----------
+    profile : dict
+        the de-identification profile of a project
+
+    Returns
+    -------
+    filename : str
+        the name of the log file
+
+    """
+
+    filename = profile.get("Log")
+    if not filename:
+        return os.path.join(get_cache_dir(), LOG_FILENAME)
+    return os.path.expanduser(str(filename))
+
+
+class Deidentifier:
+    """De-identify the DICOM images of a session.
+
+    Parameters
+    ----------
+    profile : dict or True
+        the de-identification profile of the project (True for the
+        defaults)
+    protocol : ScanProtocol
+        the scan protocol of the session
+
+    Attributes
+    ----------
+    pseudonym : str
+        the pseudonym replacing PatientName and PatientID
+    originals : list of dict
+        the (distinct) original values of the attributes in `LOGGED`
+
+    """
+
+    def __init__(self, profile, protocol):
+        if not isinstance(profile, dict):
+            profile = {}
+        self.profile = profile
+        keep = set(profile.get("Keep") or [])
+        self.empty = [x for x in EMPTY if x not in keep]
+        self.remove = [x for x in REMOVE + tuple(profile.get("Remove") or [])
+                       if x not in keep]
+        self.remove_private = bool(profile.get("RemovePrivateTags", False))
+        pattern = str(profile.get("Pseudonym") or DEFAULT_PSEUDONYM)
+        self.pseudonym = pattern.format(
+            project=protocol.project,
+            subject=repr(int(protocol.subject[0])).zfill(3),
+            session=repr(int(protocol.session[0])).zfill(3))
+        self.originals = []
+        self._lock = threading.Lock()
+
+    def _apply(self, dataset):
+        original = {x: str(dataset.get(x, "") or "") for x in LOGGED}
+        with self._lock:
+            if original not in self.originals:
+                self.originals.append(original)
+
+        for keyword in REPLACE:
+            setattr(dataset, keyword, self.pseudonym)
+        self._apply_nested(dataset)
+        if self.remove_private:
+            dataset.remove_private_tags()  # in sequences as well
+
+    def _apply_nested(self, dataset):
+        # In the items of sequences (e.g. ReferencedPatientSequence), the
+        # attributes in `REPLACE` are only replaced if present
+        for keyword in REPLACE:
+            if keyword in dataset:
+                dataset.data_element(keyword).value = self.pseudonym
+        for keyword in self.empty:
+            if keyword in dataset:
+                dataset.data_element(keyword).value = ""
+        for keyword in self.remove:
+            if keyword in dataset:
+                delattr(dataset, keyword)
+        # Group lengths (retired) would be wrong after the changes
+        for tag in [x for x in dataset.keys() if x.element == 0]:
+            del dataset[tag]
+        for element in dataset:
+            if element.VR == "SQ":
+                for item in element.value:
+                    self._apply_nested(item)
+
+    def header(self, f):
+        """De-identify the header of a DICOM file.
+
+        Parameters
+        ----------
+        f : file object
+            the DICOM file (binary, seekable), positioned at its beginning
+
+        Returns
+        -------
+        header : bytes
+            the de-identified header; the rest of the file (from the current
+            position of `f`) follows unchanged
+
+        """
+
+        import pydicom  # imported on first use, as it is slow to import
+
+        dataset = pydicom.dcmread(f, stop_before_pixels=True)
+        if dataset.file_meta.get("TransferSyntaxUID") == _DEFLATED:
+            # The whole dataset is compressed: rewrite all of it
+            f.seek(0)
+            dataset = pydicom.dcmread(f)
+            f.seek(0, io.SEEK_END)
+        self._apply(dataset)
+        buffer = io.BytesIO()
+        dataset.save_as(buffer)  # like the original
+        return buffer.getvalue()
+
+    def copy(self, f, destination, chunk_size=1024*1024, open_target=None):
+        """Copy a DICOM file, de-identified, and compute the SHA-256 hash of
+        the copy in one pass.
+
+        Parameters
+        ----------
+        f : file object
+            the DICOM file (binary, seekable)
+        destination : str
+            the file to copy to
+        chunk_size : int, optional
+            the number of bytes to read at once (default=1048576)
+        open_target : callable, optional
+            the function to open the destination for writing with
+            (default=None, meaning `open(destination, 'wb')`)
+
+        Returns
+        -------
+        size : int
+            the number of bytes written
+        sha256 : str
+            the SHA-256 hash of the copy (hexadecimal)
+
+        """
+
+        header = self.header(f)
+        digest = hashlib.sha256(header)
+        size = len(header)
+        if open_target is None:
+            fdst = open(destination, 'wb')
+        else:
+            fdst = open_target(destination)
+        with fdst:
+            fdst.write(header)
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                digest.update(chunk)
+                fdst.write(chunk)
+                size += len(chunk)
+        return size, digest.hexdigest()
+
+    def apply(self, data):
+        """De-identify the content of a DICOM file.
+
+        Parameters
+        ----------
+        data : bytes
+            the content of the DICOM file
+
+        Returns
+        -------
+        data : bytes
+            the content of the de-identified DICOM file
+
+        """
+
+        f = io.BytesIO(data)
+        header = self.header(f)
+        return header + data[f.tell():]
+
+    def log(self, session_folder, filename=None):
+        """Append the original values to the re-identification log.
+
+        Parameters
+        ----------
+        session_folder : str
+            the folder the session was archived to
+        filename : str, optional
+            the log file (default=None, meaning as configured in the
+            profile)
+
+        """
+
+        if filename is None:
+            filename = get_log_filename(self.profile)
+        folder = os.path.split(os.path.abspath(filename))[0]
+        os.makedirs(folder, exist_ok=True)
+        with open(filename, 'a') as f:
+            f.write(json.dumps({
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "session_folder": os.path.abspath(session_folder),
+                "pseudonym": self.pseudonym,
+                "originals": self.originals}) + "\n")
@@ -39,6 +39,9 @@ class ArchiveDialogue:
         self.source_button = Button(self.data_frame, text="Browse",
                                     command=self.set_source)
         self.source_button.grid(row=0, column=3, sticky="E")
+        self.source_export_button = Button(self.data_frame, text="Export",
+                                           command=self.set_source_export)
+        self.source_export_button.grid(row=0, column=4, sticky="E")
         self.target_label = Label(self.data_frame, text="Target:")
         self.target_label.grid(row=1, column=0, sticky="E", padx=(0, 3),
                                pady=3)
@@ -50,6 +53,21 @@ class ArchiveDialogue:
         self.target_button = Button(self.data_frame, text="Browse",
                                     command=self.set_target)
         self.target_button.grid(row=1, column=3, sticky="E")
+        self.backups_label = Label(self.data_frame, text="Backups:")
+        self.backups_label.grid(row=2, column=0, sticky="E", padx=(0, 3),
+                                pady=3)
+        self.backups = []
+        self.backups_var = StringVar()
+        self.backups_entry = Entry(self.data_frame, width=50,
+                                   textvariable=self.backups_var)
+        self.backups_entry["state"] = "readonly"
+        self.backups_entry.grid(row=2, column=1, sticky="W")
+        self.backups_button = Button(self.data_frame, text="Add",
+                                     command=self.add_backup)
+        self.backups_button.grid(row=2, column=3, sticky="E")
+        self.backups_clear_button = Button(self.data_frame, text="Clear",
+                                           command=self.clear_backups)
+        self.backups_clear_button.grid(row=2, column=4, sticky="E")
 
         self.options_frame = LabelFrame(top, text="Options", padding=(5,5))
         self.options_frame.grid(row=1, column=0, sticky="NSWE", padx=10)
@@ -88,6 +106,20 @@ class ArchiveDialogue:
         self.tbv_prefix_var.set("TBV_")
         self.tbv_prefix_entry["state"] = DISABLED
         self.tbv_prefix_entry.grid(row=3, column=1, sticky="WE")
+        self.max_bytes_label = Label(self.options_frame,
+                                     text="Max. MB/s:")
+        self.max_bytes_label.grid(row=4, column=0, sticky="E", padx=(0, 3))
+        self.max_bytes_var = StringVar()
+        self.max_bytes_entry = Entry(self.options_frame,
+                                     textvariable=self.max_bytes_var)
+        self.max_bytes_entry.grid(row=4, column=1, sticky="WE")
+        self.max_files_label = Label(self.options_frame,
+                                     text="Max. files/s:")
+        self.max_files_label.grid(row=5, column=0, sticky="E", padx=(0, 3))
+        self.max_files_var = StringVar()
+        self.max_files_entry = Entry(self.options_frame,
+                                     textvariable=self.max_files_var)
+        self.max_files_entry.grid(row=5, column=1, sticky="WE")
 
         self.okay_button = Button(top, text="GO", command=self.archive)
         self.okay_button["state"] = DISABLED
@@ -127,6 +159,16 @@ class ArchiveDialogue:
         if self.source_var.get() != "" and self.target_var.get() != "":
             self.okay_button["state"] = NORMAL
 
+    def set_source_export(self):
+        f = tkFileDialog.askopenfilename(parent=self.top,
+            title="Select scanner export (zip or tar file) to archive",
+            filetypes=[("Scanner exports", "*.zip *.tar"),
+                       ("All files", "*")])
+        if f not in ("", ()):
+            self.source_var.set(os.path.abspath(f))
+        if self.source_var.get() != "" and self.target_var.get() != "":
+            self.okay_button["state"] = NORMAL
+
     def set_target(self):
         d = tkFileDialog.askdirectory(parent=self.top,
             title="Select target directory to archive data to")
@@ -135,6 +177,29 @@ class ArchiveDialogue:
         if self.source_var.get() != "" and self.target_var.get() != "":
             self.okay_button["state"] = NORMAL
 
+    def add_backup(self):
+        d = tkFileDialog.askdirectory(parent=self.top,
+            title="Select directory to archive a backup copy to")
+        if d not in ("", ()) and os.path.abspath(d) not in self.backups:
+            self.backups.append(os.path.abspath(d))
+            self.backups_var.set("; ".join(self.backups))
+
+    def clear_backups(self):
+        self.backups = []
+        self.backups_var.set("")
+
+    def get_throttle(self):
+        throttle = {}
+        for key, var in (("Bytes", self.max_bytes_var),
+                         ("Files", self.max_files_var)):
+            try:
+                value = float(var.get())
+            except ValueError:
+                continue
+            if value > 0:
+                throttle[key] = value
+        return throttle or None
+
     def get(self):
         return (self.okay,
                 self.source_var.get(),
@@ -142,7 +207,9 @@ class ArchiveDialogue:
                 self.bv_links_var.get(),
                 self.tbv_links_var.get(),
                 self.tbv_files_var.get(),
-                self.tbv_prefix_var.get())
+                self.tbv_prefix_var.get(),
+                list(self.backups),
+                self.get_throttle())
 
     def destroy(self):
         if platform.system() == "Windows":
@@ -0,0 +1,301 @@
+"""Durability.
+
+How archived files are synced to disk (so that a power loss right after
+archiving does not leave files truncated or missing), configured in the
+"Settings" section of the config file:
+
+    Settings:
+        Durability:  directory
+
+The modes (see `MODES`) trade safety during archiving for speed:
+
+    "none"       files are written back by the operating system eventually
+    "file"       every file (and its folder) is synced right after it was
+                 written (slowest: every file waits for the disk)
+    "directory"  the files of each measurement folder are synced as a batch
+                 once the folder is complete, and everything else at the end
+                 (default)
+    "session"    the whole file system is synced once, at the end of the
+                 session (`syncfs` on Linux; the files of the session one by
+                 one elsewhere); this flushes the data of every other writer
+                 to that file system as well, so concurrent sessions wait for
+                 each other
+
+In all modes but "none", the session is on disk when archiving reports it as
+archived, and so are its mirrors (see `tee`; written in threads of their
+own, they are synced as a whole at the end of the session). The mode and the
+guarantee it gives are recorded in the archive report, with the mirrors that
+were synced. When staging (see `staging`), the guarantee applies to the
+spool; flushed sessions are synced to the archive before they are removed
+from the spool.
+
+"""
+
+
+import os
+import sys
+import time
+import threading
+
+
+MODES = ("none", "file", "directory", "session")
+DEFAULT_MODE = "directory"
+
+GUARANTEES = {
+    "none": "not synced; files may be lost or truncated on power loss",
+    "file": "every file synced to disk right after it was written",
+    "directory": "every measurement folder synced to disk once complete, "
+                 "the session once complete",
+    "session": "the session synced to disk once complete"}
+
+
+def fsync_path(path):
+    """Sync a file or folder to disk.
+
+    Folders cannot be synced on Windows (their entries are synced with the
+    files there).
+
+    Parameters
+    ----------
+    path : str
+        the file or folder
+
+    """
+
+    if os.path.isdir(path):
+        if os.name == "nt":
+            return
+        flags = os.O_RDONLY
+    else:
+        # Windows can only flush files opened for writing
+        flags = os.O_RDWR if os.name == "nt" else os.O_RDONLY
+    fd = os.open(path, flags | getattr(os, "O_BINARY", 0))
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def syncfs(path):
+    """Sync the file system a path is on to disk.
+
+    Parameters
+    ----------
+    path : str
+        the path
+
+    Returns
+    -------
+    synced : bool
+        whether the file system could be synced (False if not on Linux)
+
+    """
+
+    if sys.platform.startswith("linux"):
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                if libc.syncfs(fd) == 0:
+                    return True
+            finally:
+                os.close(fd)
+        except (OSError, AttributeError):
+            pass
+    return False
+
+
+class Durability:
+    """Sync archived files to disk.
+
+    Parameters
+    ----------
+    mode : str, optional
+        the durability mode (see `MODES`) (default="directory")
+
+    Attributes
+    ----------
+    exclude : set of str
+        files not to sync yet in mode "file" (e.g. containers still being
+        written)
+    files : int
+        the number of files synced
+    seconds : float
+        the total time spent syncing
+
+    """
+
+    def __init__(self, mode=DEFAULT_MODE):
+        if mode in (False, None):
+            mode = "none"
+        if mode not in MODES:
+            raise ValueError("Unknown durability mode: {0}".format(mode))
+        self.mode = mode
+        self.exclude = set()
+        self.files = 0
+        self.seconds = 0.0
+        self._synced = set()  # folders synced completely
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, settings):
+        """Create a durability with "Durability" of the settings.
+
+        Parameters
+        ----------
+        settings : dict
+            the site-wide settings
+
+        Returns
+        -------
+        durability : Durability
+            the durability
+
+        """
+
+        return cls((settings or {}).get("Durability", DEFAULT_MODE))
+
+    def _sync(self, paths):
+        start = time.perf_counter()
+        files = 0
+        for path in paths:
+            fsync_path(path)
+            files += not os.path.isdir(path)
+        with self._lock:
+            self.files += files
+            self.seconds += time.perf_counter() - start
+
+    def written(self, filename):
+        """Sync a file that was just written (in mode "file").
+
+        Parameters
+        ----------
+        filename : str
+            the file
+
+        """
+
+        if self.mode != "file" or filename in self.exclude or \
+                not os.path.isfile(filename):
+            return
+        self._sync([filename, os.path.dirname(os.path.abspath(filename))])
+
+    def sync_file(self, filename):
+        """Sync a single file (in all modes but "none").
+
+        Parameters
+        ----------
+        filename : str
+            the file
+
+        """
+
+        if self.mode != "none":
+            self._sync([filename, os.path.dirname(os.path.abspath(filename))])
+
+    def _sync_tree(self, folder, files=True):
+        folder = os.path.abspath(folder)
+        paths = []
+        for root, dirs, names in os.walk(folder):
+            dirs[:] = [x for x in dirs
+                       if os.path.join(root, x) not in self._synced]
+            if files:
+                paths.extend(os.path.join(root, x) for x in names)
+            paths.append(root)
+        self._sync(paths)
+        self._synced.add(folder)
+
+    def folder_complete(self, folder):
+        """Sync a complete folder as a batch (in mode "directory").
+
+        Parameters
+        ----------
+        folder : str
+            the folder
+
+        """
+
+        if self.mode == "directory":
+            self._sync_tree(folder)
+
+    def finish(self, session_folder, root):
+        """Sync everything not synced yet at the end of a session.
+
+        Parameters
+        ----------
+        session_folder : str
+            the session folder
+        root : str
+            the root folder of the archive (the folders between it and the
+            session folder are synced as well)
+
+        """
+
+        if self.mode == "none":
+            return
+        if self.mode == "session":
+            if self._syncfs(session_folder):
+                return
+            self._sync_tree(session_folder)
+        else:
+            # Files are synced already in mode "file"
+            self._sync_tree(session_folder, files=self.mode != "file")
+        self.sync_parents(session_folder, root)
+
+    def finish_mirror(self, session_folder, root):
+        """Sync a mirror of the session (see `tee`) at the end of a session
+        (in all modes but "none").
+
+        Parameters
+        ----------
+        session_folder : str
+            the session folder in the mirror
+        root : str
+            the root folder of the mirror
+
+        """
+
+        if self.mode == "none":
+            return
+        if self.mode == "session" and self._syncfs(session_folder):
+            return
+        # Not synced while written
+        self._sync_tree(session_folder)
+        self.sync_parents(session_folder, root)
+
+    def _syncfs(self, path):
+        start = time.perf_counter()
+        synced = syncfs(path)
+        with self._lock:
+            self.seconds += time.perf_counter() - start
+        return synced
+
+    def sync_parents(self, folder, root):
+        """Sync the folders between a root folder and a folder (e.g. after
+        the folder was created or renamed) (in all modes but "none").
+
+        Parameters
+        ----------
+        folder : str
+            the folder
+        root : str
+            the root folder
+
+        """
+
+        if self.mode == "none":
+            return
+        parents = []
+        folder = os.path.dirname(os.path.abspath(folder))
+        root = os.path.abspath(root)
+        while folder.startswith(root) and folder != os.path.dirname(folder):
+            parents.append(folder)
+            if folder == root:
+                break
+            folder = os.path.dirname(folder)
+        self._sync(parents)
+
+    def stats(self):
+        return {"mode": self.mode, "guarantee": GUARANTEES[self.mode],
+                "files": self.files, "seconds": self.seconds}
@@ -0,0 +1,242 @@
+"""Exports.
+
+Scanner exports (zip or tar files with the DICOM images of a session) as the
+source of the archiving procedure, without extracting them first: the headers
+of the DICOM images are read from the beginning of each member only, and the
+members are copied straight from the export into the archive.
+
+Files in an export are addressed by paths "<export>/<member>" (e.g.
+"/data/study.zip/DICOM/MR.0001.IMA"), so that they can be handled like files
+in a folder. Logfiles and documents are not expected in the export, but in
+the folder the export is in.
+
+Compressed tar files can only be read from the beginning and are hence not
+supported; they have to be extracted (or decompressed) first.
+
+"""
+
+
+import io
+import os
+import time
+import tarfile
+import zipfile
+
+
+def is_export(path):
+    """Check whether a path is a scanner export (a zip or tar file).
+
+    Parameters
+    ----------
+    path : str
+        the path
+
+    Returns
+    -------
+    is_export : bool
+        whether the path is a zip or tar file
+
+    """
+
+    if not os.path.isfile(path):
+        return False
+    return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+
+
+class _MemberFile(io.RawIOBase):
+    """A read-only view on a part of a file."""
+
+    def __init__(self, filename, offset, size, name=None):
+        self.name = name
+        self._file = open(filename, 'rb')
+        self._offset = offset
+        self._size = size
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, position, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            position += self._position
+        elif whence == io.SEEK_END:
+            position += self._size
+        self._position = max(0, position)
+        return self._position
+
+    def readinto(self, buffer):
+        length = max(0, min(len(buffer), self._size - self._position))
+        if length == 0:
+            return 0
+        self._file.seek(self._offset + self._position)
+        length = self._file.readinto(memoryview(buffer)[:length])
+        self._position += length
+        return length
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class ExportArchive:
+    """A scanner export (a zip or uncompressed tar file).
+
+    Parameters
+    ----------
+    filename : str
+        the name of the export file
+
+    Attributes
+    ----------
+    filename : str
+        the absolute name of the export file
+    format : str
+        the format of the export ("zip" or "tar")
+    members : dict
+        the position in the export, size and modification time of each
+        (regular) file in the export, by name
+
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.members = {}
+        self._zip = None
+        if zipfile.is_zipfile(filename):
+            self.format = "zip"
+            self._zip = zipfile.ZipFile(filename)
+            for info in self._zip.infolist():
+                if not info.filename.endswith("/"):
+                    self.members[info.filename] = (
+                        info.header_offset, info.file_size,
+                        time.mktime(info.date_time + (0, 0, -1)))
+        elif tarfile.is_tarfile(filename):
+            self.format = "tar"
+            try:
+                with tarfile.open(filename, "r:") as f:
+                    for info in f:
+                        if info.isfile():
+                            self.members[info.name] = (
+                                info.offset_data, info.size, info.mtime)
+            except tarfile.ReadError:
+                raise ValueError(
+                    "Compressed tar files are not supported: {0}".format(
+                        filename))
+        else:
+            raise ValueError("Not a zip or tar file: {0}".format(filename))
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_path(self, name):
+        """Get the path of a file in the export."""
+
+        return os.path.join(self.filename, *name.split("/"))
+
+    def get_name(self, path):
+        """Get the name in the export of a path (see `get_path`)."""
+
+        return os.path.relpath(path, self.filename).replace(os.sep, "/")
+
+    def paths(self):
+        """Get the paths of all files in the export, in export order."""
+
+        return [self.get_path(x) for x in sorted(
+            self.members, key=lambda x: self.members[x][0])]
+
+    def getsize(self, path):
+        return self.members[self.get_name(path)][1]
+
+    def getmtime(self, path):
+        return self.members[self.get_name(path)][2]
+
+    def open(self, path):
+        """Open a file in the export for reading (thread-safe).
+
+        Parameters
+        ----------
+        path : str
+            the path of the file (see `get_path`)
+
+        Returns
+        -------
+        f : file object
+            the (binary, seekable) file object
+
+        """
+
+        name = self.get_name(path)
+        if self.format == "zip":
+            return self._zip.open(name)
+        offset, size, _ = self.members[name]
+        return io.BufferedReader(_MemberFile(self.filename, offset, size,
+                                             path))
+
+    def sort(self, operations):
+        """Sort file operations by the position of their source files in the
+        export (so that the export is read from beginning to end).
+
+        Parameters
+        ----------
+        operations : list of tuple
+            the operations, starting with their source file
+
+        Returns
+        -------
+        operations : list of tuple
+            the sorted operations
+
+        """
+
+        return sorted(operations,
+                      key=lambda x: self.members[self.get_name(x[0])][0])
+
+
+_exports = {}  # opened exports of a worker process
+
+def readdicom_timed(path):
+    """Read metadata from a DICOM file in an export and measure how long that
+    took.
+
+    Only the beginning of the file (up to the pixel data) is read.
+
+    Parameters
+    ----------
+    path : (str, str)
+        the name of the export file and the path of the DICOM file in it
+
+    Returns
+    -------
+    metadata : list
+        the metadata as returned by `utilities.readdicom`
+    latency : float
+        the time in seconds it took to read the metadata
+
+    """
+
+    from .utilities import readdicom
+
+    filename, path = path
+    start = time.perf_counter()
+    export = _exports.get(filename)
+    if export is None:
+        export = _exports[filename] = ExportArchive(filename)
+    with export.open(path) as f:
+        if not f.seekable():  # zip files before Python 3.7
+            f = io.BytesIO(f.read())
+        metadata = readdicom(f)
+    metadata[0] = path
+    return metadata, time.perf_counter() - start
@@ -0,0 +1,301 @@
+"""Metrics.
+
+An optional metrics sink for monitoring the archiving procedure of Scan
+Session Tool across several machines.
+
+The sink is configured in the "Settings" section of the config file, e.g.:
+
+    Settings:
+        Metrics:
+            Prometheus:  /var/lib/node_exporter/scansessiontool.prom
+            EventLog:    /var/log/scansessiontool/events.jsonl
+            FileEvents:  no
+            Buckets:     [0.001, 0.01, 0.1, 1, 10]
+            Labels:
+                site:    console1
+
+"Prometheus" is the path of a file for the Prometheus node exporter textfile
+collector, which is (atomically) rewritten at the end of each archiving
+procedure. "EventLog" is the path of a JSON-lines file events are appended to.
+Both are optional; without any of them, no metrics are collected.
+
+"""
+
+
+import os
+import json
+import time
+import socket
+
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """A cumulative histogram of observed values."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+class MetricsSink:
+    """Collect archiving metrics and export them to files.
+
+    Parameters
+    ----------
+    prometheus : str, optional
+        the path of the Prometheus textfile collector file (default=None)
+    event_log : str, optional
+        the path of the JSON-lines event log (default=None)
+    file_events : bool, optional
+        whether to log an event for every single file (default=False)
+    buckets : list of float, optional
+        the upper bounds of the latency histogram buckets in seconds
+        (default=None)
+    labels : dict, optional
+        additional labels to attach to all metrics and events (default=None)
+
+    """
+
+    def __init__(self, prometheus=None, event_log=None, file_events=False,
+                 buckets=None, labels=None):
+        self.prometheus = prometheus
+        self.event_log = event_log
+        self.file_events = file_events
+        self.buckets = buckets or DEFAULT_BUCKETS
+        self.labels = {"host": socket.gethostname()}
+        if labels is not None:
+            self.labels.update({str(k): str(v) for k, v in labels.items()})
+        self.enabled = prometheus is not None or event_log is not None
+        self.copy_latency = {}
+        self.parse_latency = Histogram(self.buckets)
+        self.throughput = {}
+        self.queue_depth = {}
+        self.errors = {}
+        self._log = None
+
+    @classmethod
+    def from_config(cls, settings):
+        """Create a metrics sink from the "Settings" section of the config.
+
+        Parameters
+        ----------
+        settings : dict
+            the "Settings" section of the config file
+
+        Returns
+        -------
+        sink : MetricsSink
+            the (possibly disabled) metrics sink
+
+        """
+
+        try:
+            metrics = settings["Metrics"]
+        except (KeyError, TypeError):
+            metrics = None
+        if not metrics:
+            return cls()
+
+        def path(key):
+            value = metrics.get(key)
+            if value:
+                return os.path.expanduser(str(value))
+
+        return cls(prometheus=path("Prometheus"),
+                   event_log=path("EventLog"),
+                   file_events=bool(metrics.get("FileEvents", False)),
+                   buckets=metrics.get("Buckets"),
+                   labels=metrics.get("Labels"))
+
+    def event(self, name, **fields):
+        """Append an event to the event log.
+
+        Parameters
+        ----------
+        name : str
+            the name of the event
+        **fields
+            additional fields of the event
+
+        """
+
+        if self.event_log is None:
+            return
+        if self._log is None:
+            folder = os.path.split(self.event_log)[0]
+            if folder != "" and not os.path.exists(folder):
+                os.makedirs(folder)
+            self._log = open(self.event_log, 'a')
+        record = {"time": time.time(), "event": name}
+        record.update(self.labels)
+        record.update(fields)
+        self._log.write(json.dumps(record) + "\n")
+
+    def start(self, session):
+        """Signal the start of an archiving procedure."""
+
+        self.event("archive_start", session=session)
+
+    def observe_parse(self, seconds):
+        """Record the latency of parsing a single DICOM header."""
+
+        if not self.enabled:
+            return
+        self.parse_latency.observe(seconds)
+        if self.file_events:
+            self.event("header", seconds=seconds)
+
+    def observe_copy(self, stage, seconds, nbytes):
+        """Record the latency of copying (or linking) a single file."""
+
+        if not self.enabled:
+            return
+        if stage not in self.copy_latency:
+            self.copy_latency[stage] = Histogram(self.buckets)
+        self.copy_latency[stage].observe(seconds)
+        if self.file_events:
+            self.event("file", stage=stage, seconds=seconds, bytes=nbytes)
+
+    def observe_queue(self, stage, depth):
+        """Record the number of files still waiting to be processed."""
+
+        if not self.enabled:
+            return
+        current = self.queue_depth.get(stage, (0, 0))
+        self.queue_depth[stage] = (depth, max(current[1], depth))
+
+    def error(self, stage):
+        """Record an error."""
+
+        if not self.enabled:
+            return
+        self.errors[stage] = self.errors.get(stage, 0) + 1
+        self.event("error", stage=stage)
+
+    def phase(self, stage, seconds, files, nbytes):
+        """Record the outcome of a (completed) phase."""
+
+        if not self.enabled:
+            return
+        if seconds > 0:
+            self.throughput[stage] = nbytes / seconds
+        self.event("phase", stage=stage, seconds=seconds, files=files,
+                   bytes=nbytes)
+
+    def finish(self, report):
+        """Signal the end of an archiving procedure and export all metrics.
+
+        Parameters
+        ----------
+        report : ArchiveReport
+            the report of the finished archiving procedure
+
+        """
+
+        if not self.enabled:
+            return
+        total = report.to_dict()["total"]
+        self.event("archive_end", seconds=total["seconds"],
+                   files=total["files"], bytes=total["bytes"],
+                   errors=sum(self.errors.values()))
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        if self.prometheus is not None:
+            self.write_prometheus(total)
+
+    def _format_labels(self, **extra):
+        labels = dict(self.labels)
+        labels.update(extra)
+        return "{" + ",".join('{0}="{1}"'.format(
+            k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                              for k, v in sorted(labels.items())) + "}"
+
+    def _format_histogram(self, name, histogram, **labels):
+        lines = []
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            lines.append("{0}_bucket{1} {2}".format(
+                name, self._format_labels(le=repr(float(bound)), **labels),
+                count))
+        lines.append("{0}_bucket{1} {2}".format(
+            name, self._format_labels(le="+Inf", **labels), histogram.count))
+        lines.append("{0}_sum{1} {2}".format(
+            name, self._format_labels(**labels), histogram.sum))
+        lines.append("{0}_count{1} {2}".format(
+            name, self._format_labels(**labels), histogram.count))
+        return lines
+
+    def write_prometheus(self, total):
+        """Write all metrics to the Prometheus textfile collector file."""
+
+        lines = [
+            "# HELP sst_archive_last_run_timestamp_seconds "
+            "End time of the last archiving procedure.",
+            "# TYPE sst_archive_last_run_timestamp_seconds gauge",
+            "sst_archive_last_run_timestamp_seconds{0} {1}".format(
+                self._format_labels(), time.time()),
+            "# HELP sst_archive_duration_seconds "
+            "Duration of the last archiving procedure.",
+            "# TYPE sst_archive_duration_seconds gauge",
+            "sst_archive_duration_seconds{0} {1}".format(
+                self._format_labels(), total["seconds"]),
+            "# HELP sst_archive_files Files archived in the last run.",
+            "# TYPE sst_archive_files gauge",
+            "sst_archive_files{0} {1}".format(self._format_labels(),
+                                              total["files"]),
+            "# HELP sst_archive_bytes Bytes archived in the last run.",
+            "# TYPE sst_archive_bytes gauge",
+            "sst_archive_bytes{0} {1}".format(self._format_labels(),
+                                              total["bytes"])]
+        lines += [
+            "# HELP sst_archive_header_parse_seconds "
+            "Latency of parsing a single DICOM header.",
+            "# TYPE sst_archive_header_parse_seconds histogram"]
+        lines += self._format_histogram("sst_archive_header_parse_seconds",
+                                        self.parse_latency)
+        lines += [
+            "# HELP sst_archive_file_copy_seconds "
+            "Latency of copying or linking a single file.",
+            "# TYPE sst_archive_file_copy_seconds histogram"]
+        for stage, histogram in sorted(self.copy_latency.items()):
+            lines += self._format_histogram("sst_archive_file_copy_seconds",
+                                            histogram, stage=stage)
+        lines += [
+            "# HELP sst_archive_bytes_per_second Throughput per stage.",
+            "# TYPE sst_archive_bytes_per_second gauge"]
+        for stage, value in sorted(self.throughput.items()):
+            lines.append("sst_archive_bytes_per_second{0} {1}".format(
+                self._format_labels(stage=stage), value))
+        lines += [
+            "# HELP sst_archive_queue_depth_max "
+            "Maximum number of files waiting to be processed per stage.",
+            "# TYPE sst_archive_queue_depth_max gauge"]
+        for stage, (_, value) in sorted(self.queue_depth.items()):
+            lines.append("sst_archive_queue_depth_max{0} {1}".format(
+                self._format_labels(stage=stage), value))
+        lines += [
+            "# HELP sst_archive_errors Errors per stage in the last run.",
+            "# TYPE sst_archive_errors gauge"]
+        for stage, value in sorted(self.errors.items()):
+            lines.append("sst_archive_errors{0} {1}".format(
+                self._format_labels(stage=stage), value))
+
+        folder = os.path.split(self.prometheus)[0]
+        if folder != "" and not os.path.exists(folder):
+            os.makedirs(folder)
+        tmp = self.prometheus + ".{0}.tmp".format(os.getpid())
+        with open(tmp, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp, self.prometheus)
@@ -0,0 +1,260 @@
+"""Profiling.
+
+A built-in profiler for the archiving procedure and the GUI hot paths of
+Scan Session Tool. Results are written to a timestamped zip bundle that can be
+attached to a bug report.
+
+"""
+
+
+import os
+import io
+import sys
+import time
+import threading
+import tracemalloc
+import functools
+import tkinter
+
+# The profiling modules themselves (cProfile, pstats) and zipfile are only
+# imported when profiling, to not slow down the application start
+
+
+def deep_getsizeof(obj, seen=None):
+    """Get the (approximate) memory size of an object and all its contents.
+
+    Parameters
+    ----------
+    obj : object
+        the object to get the size of
+
+    Returns
+    -------
+    size : int
+        the size in bytes
+
+    """
+
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += deep_getsizeof(key, seen) + deep_getsizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for item in obj:
+            size += deep_getsizeof(item, seen)
+    return size
+
+
+class Profiler:
+    """Profile wrapped methods and Tk callbacks.
+
+    Wrapped methods are always called through the profiler, but are only
+    profiled (with cProfile) while the profiler is active. While active, the
+    duration of every Tk callback is recorded and memory allocations are
+    traced with tracemalloc.
+
+    Parameters
+    ----------
+    folder : str, optional
+        the folder to write profiling bundles to (default=None, meaning the
+        home directory)
+    max_callbacks : int, optional
+        the number of slowest Tk callbacks to report (default=50)
+
+    """
+
+    def __init__(self, folder=None, max_callbacks=50):
+        if folder is None:
+            folder = os.path.expanduser("~")
+        self.folder = folder
+        self.max_callbacks = max_callbacks
+        self.active = False
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.profiles = {}
+        self.calls = {}
+        self.callbacks = []
+        self.memory = {}
+        self._marks = {}
+        self.started = None
+
+    def wrap(self, name, func):
+        """Wrap a function so it gets profiled while the profiler is active.
+
+        Parameters
+        ----------
+        name : str
+            the name to report the function under
+        func : callable
+            the function to wrap
+
+        Returns
+        -------
+        wrapped : callable
+            the wrapped function
+
+        """
+
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            if not self.active:
+                return func(*args, **kwargs)
+            import cProfile
+            profile = cProfile.Profile()
+            start = time.perf_counter()
+            try:
+                return profile.runcall(func, *args, **kwargs)
+            finally:
+                duration = time.perf_counter() - start
+                with self._lock:
+                    self.profiles.setdefault(name, []).append(profile)
+                    calls = self.calls.setdefault(name, [0, 0.0, 0.0])
+                    calls[0] += 1
+                    calls[1] += duration
+                    calls[2] = max(calls[2], duration)
+
+        return wrapped
+
+    def _timed_callback(self, original):
+        profiler = self
+
+        def __call__(wrapper, *args):
+            start = time.perf_counter()
+            try:
+                return original(wrapper, *args)
+            finally:
+                duration = time.perf_counter() - start
+                func = wrapper.func
+                name = getattr(func, "__qualname__", repr(func))
+                with profiler._lock:
+                    profiler.callbacks.append((duration, name, args[:3]))
+
+        return __call__
+
+    def start(self):
+        """Start profiling."""
+
+        if self.active:
+            return
+        self._reset()
+        self.started = time.localtime()
+        tracemalloc.start(25)
+        self._original_call = tkinter.CallWrapper.__call__
+        tkinter.CallWrapper.__call__ = self._timed_callback(
+            self._original_call)
+        self.active = True
+
+    def mark(self, name):
+        """Start measuring the peak memory of building a data structure.
+
+        Parameters
+        ----------
+        name : str
+            the name of the data structure
+
+        """
+
+        if not self.active:
+            return
+        if hasattr(tracemalloc, "reset_peak"):
+            tracemalloc.reset_peak()
+        self._marks[name] = tracemalloc.get_traced_memory()[0]
+
+    def measure(self, name, obj=None):
+        """Stop measuring the peak memory of building a data structure.
+
+        Parameters
+        ----------
+        name : str
+            the name of the data structure (as given to `mark`)
+        obj : object, optional
+            the data structure itself, to additionally report its size
+            (default=None)
+
+        """
+
+        if not self.active:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        baseline = self._marks.pop(name, 0)
+        self.memory[name] = {"peak": peak - baseline,
+                             "retained": current - baseline}
+        if obj is not None:
+            self.memory[name]["size"] = deep_getsizeof(obj)
+
+    def stop(self):
+        """Stop profiling and write the profiling bundle.
+
+        Returns
+        -------
+        filename : str
+            the name of the written bundle
+
+        """
+
+        if not self.active:
+            return
+        import pstats
+        import zipfile
+
+        self.active = False
+        tkinter.CallWrapper.__call__ = self._original_call
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        timestamp = time.strftime("%Y%m%d-%H%M%S", self.started)
+        filename = os.path.join(self.folder,
+                                "sst_profile_{0}.zip".format(timestamp))
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as bundle:
+            summary = io.StringIO()
+            summary.write("Scan Session Tool profile {0}\n\n".format(
+                timestamp))
+            summary.write("Wrapped calls (count, total s, slowest s):\n")
+            for name, (count, total, slowest) in sorted(self.calls.items()):
+                summary.write("    {0}: {1}, {2:.4f}, {3:.4f}\n".format(
+                    name, count, total, slowest))
+            summary.write("\nMemory (bytes):\n")
+            summary.write("    traced current: {0}\n".format(current))
+            summary.write("    traced peak: {0}\n".format(peak))
+            for name, values in sorted(self.memory.items()):
+                for key, value in sorted(values.items()):
+                    summary.write("    {0} {1}: {2}\n".format(name, key,
+                                                             value))
+            bundle.writestr("summary.txt", summary.getvalue())
+
+            callbacks = io.StringIO()
+            callbacks.write("Slowest Tk callbacks (s, callback, args):\n")
+            for duration, name, args in sorted(
+                    self.callbacks, key=lambda x: x[0],
+                    reverse=True)[:self.max_callbacks]:
+                callbacks.write("    {0:.4f}  {1}  {2}\n".format(
+                    duration, name, args))
+            bundle.writestr("callbacks.txt", callbacks.getvalue())
+
+            for name, profiles in self.profiles.items():
+                stats = pstats.Stats(profiles[0], stream=io.StringIO())
+                for profile in profiles[1:]:
+                    stats.add(profile)
+                stats.dump_stats(filename + ".tmp")
+                bundle.write(filename + ".tmp", "{0}.prof".format(name))
+                os.remove(filename + ".tmp")
+                stats.stream = io.StringIO()
+                stats.sort_stats("cumulative").print_stats(50)
+                bundle.writestr("{0}.txt".format(name),
+                                stats.stream.getvalue())
+
+            memory = io.StringIO()
+            memory.write("Top memory allocations:\n")
+            for stat in snapshot.statistics("lineno")[:50]:
+                memory.write("    {0}\n".format(stat))
+            bundle.writestr("memory.txt", memory.getvalue())
+
+        return filename
@@ -0,0 +1,346 @@
+"""Protocol.
+
+The data model of a Scan Session Tool scan protocol, independent of the
+widgets showing it.
+
+"""
+
+
+class Measurement:
+    """A single measurement of a scan session.
+
+    All fields are kept as the strings shown in the form. Multi-line fields
+    (logfiles and comments) hold one entry per line, without a trailing
+    newline.
+
+    Parameters
+    ----------
+    number : str, optional
+        the (zero-padded) number of the measurement (default="001")
+    type : str, optional
+        the type of the measurement ("anat", "func" or "misc")
+        (default="anat")
+    vols : str, optional
+        the number of volumes (default="")
+    name : str, optional
+        the name of the measurement (default="")
+    logfiles : str, optional
+        the logfiles of the measurement (default="")
+    comments : str, optional
+        the comments on the measurement (default="")
+
+    """
+
+    FIELDS = ("number", "type", "vols", "name", "logfiles", "comments")
+
+    def __init__(self, number="001", type="anat", vols="", name="",
+                 logfiles="", comments=""):
+        self.number = number
+        self.type = type
+        self.vols = vols
+        self.name = name
+        self.logfiles = logfiles
+        self.comments = comments
+
+        # The protocol file automatically added to the logfiles
+        self.prt_file = ""
+
+    def __repr__(self):
+        return "Measurement({0})".format(", ".join(
+            "{0}={1!r}".format(x, getattr(self, x)) for x in self.FIELDS))
+
+    def is_empty(self):
+        """Whether nothing has been filled in (besides number and type)."""
+
+        return self.vols == "" and self.name == "" and \
+            self.logfiles.strip("\n") == "" and \
+            self.comments.strip("\n") == ""
+
+
+class ScanProtocol:
+    """A scan protocol, i.e. the documentation of a single scan session.
+
+    All fields are kept as the strings shown in the form.
+
+    Attributes
+    ----------
+    project, date, time_a, time_b, user_1, user_2 : str
+        the general information
+    subject, session : list of str
+        the (zero-padded) number and the type of the subject and session
+    notes : str
+        the notes (one line per line)
+    files : str
+        the files documenting the session (one per line)
+    documents : list of [str, bool]
+        the checklist, as pairs of document name and whether it is checked
+    measurements : list of Measurement
+        the measurements
+
+    """
+
+    GENERAL = ("Project:", "Subject:", "Session:", "Date:", "Time A:",
+               "Time B:", "User 1:", "User 2:")
+    GENERAL_FIELDS = ("project", "subject", "session", "date", "time_a",
+                      "time_b", "user_1", "user_2")
+    MEASUREMENT = ("Type", "Vols", "Name", "Logfiles", "Comments")
+    JSON_FORMAT = 1
+
+    def __init__(self):
+        self.project = ""
+        self.subject = ["001", ""]
+        self.session = ["001", ""]
+        self.date = ""
+        self.time_a = ""
+        self.time_b = ""
+        self.user_1 = ""
+        self.user_2 = ""
+        self.notes = ""
+        self.files = ""
+        self.documents = []
+        self.measurements = []
+
+    @property
+    def general(self):
+        """The general information, in the order of the protocol file."""
+
+        return [getattr(self, x) for x in self.GENERAL_FIELDS]
+
+    @general.setter
+    def general(self, values):
+        for field, value in zip(self.GENERAL_FIELDS, values):
+            setattr(self, field, value)
+
+    def get_filename(self):
+        """Get the (base) name of the scan protocol file.
+
+        Returns
+        -------
+        filename : str
+            the file name, without extension (e.g.
+            "ScanProtocol_Project_sub-001_ses-001_20211203")
+
+        """
+
+        project = self.project
+        if project == "":
+            project = "Project"
+        subject = "sub-" + repr(int(self.subject[0])).zfill(3)
+        if self.subject[1] != "":
+            subject = "{0}-{1}".format(subject, self.subject[1])
+        session = "ses-" + repr(int(self.session[0])).zfill(3)
+        if self.session[1] != "":
+            session = "{0}-{1}".format(session, self.session[1])
+        date = self.date
+        if date == "":
+            date = "Date"
+        else:
+            date = "".join(date.split("-"))
+        return "ScanProtocol_{0}_{1}_{2}_{3}".format(project, subject,
+                                                     session, date)
+
+    @classmethod
+    def parse(cls, lines):
+        """Parse a scan protocol file.
+
+        Every line starting with a label ("Label:") sets a field; following
+        lines that are indented continue a multi-line field.
+
+        Parameters
+        ----------
+        lines : iterable of str
+            the lines of the scan protocol file (e.g. the open file)
+
+        Returns
+        -------
+        protocol : ScanProtocol
+            the parsed scan protocol
+
+        """
+
+        protocol = cls()
+        general = dict((label[:-1], field) for label, field in
+                       zip(cls.GENERAL, cls.GENERAL_FIELDS))
+        blocks = []  # (object, field, lines) of multi-line fields
+        block = None
+        measurement = None
+        for line in lines:
+            if line[:1] == " ":
+                if block is not None:
+                    block.append(line.strip())
+                continue
+            line = line.strip()
+            if line == "":
+                continue
+            block = None
+            if line.startswith("No. "):
+                measurement = Measurement(number=line[4:].strip().zfill(3))
+                protocol.measurements.append(measurement)
+                continue
+            label, colon, value = line.partition(":")
+            if colon == "":
+                continue
+            value = value.strip()
+            if measurement is not None:
+                target = measurement
+                if label not in cls.MEASUREMENT:
+                    continue
+                field = label.lower()
+            else:
+                target = protocol
+                if label in general:
+                    field = general[label]
+                elif label in ("Notes", "Files", "Checklist"):
+                    field = label.lower()
+                else:
+                    continue
+            if field in ("subject", "session"):
+                number = value[:3] if value[:3].isdigit() else ""
+                setattr(target, field, [number, value[len(number):].strip()])
+            elif field in ("notes", "files", "checklist", "logfiles",
+                           "comments"):
+                block = [value]
+                blocks.append((target, field, block))
+            else:
+                setattr(target, field, value)
+
+        for target, field, block in blocks:
+            if field == "checklist":
+                for entry in block:
+                    if entry[:1] == "[" and entry[1:3] in (" ]", "x]"):
+                        target.documents.append([entry[3:].strip(),
+                                                 entry[1] == "x"])
+            else:
+                setattr(target, field, "\n".join(block))
+        return protocol
+
+    @staticmethod
+    def _format_lines(label, lines):
+        return "".join(
+            (" " * (24 - len(label)) if line_nr == 0 else "\n" + " " * 24) +
+            line for line_nr, line in enumerate(lines))
+
+    def format(self):
+        """Format the scan protocol as the content of a scan protocol file.
+
+        Returns
+        -------
+        text : str
+            the content of the scan protocol file
+
+        """
+
+        out = ["General Information\n",
+               "===================\n",
+               "\n"]
+        for pos, (label, value) in enumerate(zip(self.GENERAL,
+                                                 self.general)):
+            if pos in (1, 2):
+                if pos == 1:
+                    value = value[0].zfill(3) + value[1].lstrip(" ")
+                else:
+                    value = value[0].zfill(3) + " " + value[1]
+                out.append("{0}{1}{2}\n".format(label, " "*(24-len(label)),
+                                                value))
+            elif value == "":
+                out.append("{0}\n".format(label))
+            else:
+                out.append("{0}{1}{2}\n".format(label, " "*(24-len(label)),
+                                                value))
+
+        out.append("\nNotes:")
+        if self.notes.strip() != "":
+            out.append(self._format_lines(
+                "Notes:", [x.strip() for x in self.notes.split("\n")]))
+        out.append("\n\n\nDocuments\n=========\n")
+
+        out.append("\nFiles:")
+        out.append(self._format_lines(
+            "Files:", [x.strip() for x in self.files.split("\n")
+                       if x != ""]))
+
+        out.append("\n\nChecklist:")
+        states = ("[ ]", "[x]")
+        out.append(self._format_lines(
+            "Checklist:", ["{0} {1}".format(states[int(checked)], label)
+                           for label, checked in self.documents]))
+
+        out.append("\n\n\nMeasurements\n============\n")
+        for m in self.measurements:
+            out.append("\nNo. {0}\n-----\n\n".format(int(m.number)))
+            logfiles = [x.strip() for x in m.logfiles.split("\n") if x != ""]
+            for label, value in zip(self.MEASUREMENT,
+                                    (m.type, m.vols, m.name,
+                                     ("\n" + " "*24).join(logfiles))):
+                if value == "":
+                    out.append("{0}:\n".format(label))
+                else:
+                    out.append("{0}:{1}{2}\n".format(
+                        label, " "*(23-len(label)), value))
+            out.append("\nComments:")
+            if m.comments.strip("\n") != "":
+                out.append(self._format_lines(
+                    "Comments:", [x.strip() for x in m.comments.split("\n")]))
+            out.append("\n\n")
+        return "".join(out)
+
+    def to_dict(self):
+        """Get the scan protocol as a dictionary of plain (JSON) types.
+
+        Numbers are converted to integers (None when not filled in), and
+        multi-line fields holding lists are converted to lists.
+
+        Returns
+        -------
+        protocol : dict
+            the scan protocol
+
+        """
+
+        def to_int(value):
+            try:
+                return int(value)
+            except ValueError:
+                return None
+
+        def to_list(value):
+            return [x.strip() for x in value.split("\n") if x.strip() != ""]
+
+        return {
+            "format": self.JSON_FORMAT,
+            "project": self.project,
+            "subject": {"number": to_int(self.subject[0]),
+                        "type": self.subject[1]},
+            "session": {"number": to_int(self.session[0]),
+                        "type": self.session[1]},
+            "date": self.date,
+            "time_a": self.time_a,
+            "time_b": self.time_b,
+            "users": [x for x in (self.user_1, self.user_2) if x != ""],
+            "notes": self.notes.strip("\n"),
+            "files": to_list(self.files),
+            "checklist": [{"document": label, "checked": bool(checked)}
+                          for label, checked in self.documents],
+            "measurements": [{"number": to_int(m.number),
+                              "type": m.type,
+                              "vols": to_int(m.vols),
+                              "name": m.name,
+                              "logfiles": to_list(m.logfiles),
+                              "comments": m.comments.strip("\n")}
+                             for m in self.measurements]}
+
+    def write_json(self, filename):
+        """Write the scan protocol to a JSON file.
+
+        Parameters
+        ----------
+        filename : str
+            the name of the JSON file
+
+        """
+
+        import json
+
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+            f.write("\n")
@@ -0,0 +1,477 @@
+"""Protocol index.
+
+A searchable index over all scan protocols ("ScanProtocol_*.txt") in an
+archive, stored in an SQLite database (with a full-text search table, if
+SQLite supports it).
+
+The archive is walked in parallel and only new or changed protocol files
+(according to their modification time and size) are parsed again, so the
+index can be updated cheaply, e.g. after every archiving procedure.
+
+Usage:
+    scansessiontool-index update ARCHIVE [ARCHIVE ...]
+    scansessiontool-index query [TEXT] [--name NAME] [--max-vols N] ...
+
+For example, to find all sessions that ran measurement "Run1" with fewer
+than 300 volumes:
+    scansessiontool-index query --name Run1 --max-vols 299
+
+"""
+
+
+import os
+import sys
+import fnmatch
+import sqlite3
+import argparse
+
+from .protocol import ScanProtocol
+from .config import get_cache_dir
+from .publishing import INCOMING_FOLDER, TRASH_FOLDER
+
+
+PROTOCOL_PATTERN = "ScanProtocol_*.txt"
+INDEX_FILENAME = "protocol_index.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS protocols (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    project TEXT,
+    subject INTEGER,
+    subject_type TEXT,
+    session INTEGER,
+    session_type TEXT,
+    date TEXT,
+    time_a TEXT,
+    time_b TEXT,
+    users TEXT,
+    notes TEXT,
+    files TEXT
+);
+CREATE TABLE IF NOT EXISTS checklist (
+    protocol_id INTEGER NOT NULL REFERENCES protocols(id) ON DELETE CASCADE,
+    document TEXT,
+    checked INTEGER
+);
+CREATE TABLE IF NOT EXISTS measurements (
+    protocol_id INTEGER NOT NULL REFERENCES protocols(id) ON DELETE CASCADE,
+    number INTEGER,
+    type TEXT,
+    vols INTEGER,
+    name TEXT,
+    logfiles TEXT,
+    comments TEXT
+);
+CREATE INDEX IF NOT EXISTS protocols_project ON protocols(project);
+CREATE INDEX IF NOT EXISTS checklist_protocol ON checklist(protocol_id);
+CREATE INDEX IF NOT EXISTS checklist_document ON checklist(document);
+CREATE INDEX IF NOT EXISTS measurements_protocol ON measurements(protocol_id);
+CREATE INDEX IF NOT EXISTS measurements_name ON measurements(name, vols);
+"""
+
+# The searchable text of a protocol (the rowid is the protocol id)
+SEARCH_COLUMNS = ("project", "general", "notes", "measurements")
+
+# Sessions not (or no longer) published (see `publishing`)
+SKIPPED_FOLDERS = (INCOMING_FOLDER, TRASH_FOLDER)
+
+
+def _scan_folder(folder):
+    """Find all protocol files in a folder (recursively)."""
+
+    found = []
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [x for x in dirs if x not in SKIPPED_FOLDERS]
+        for filename in fnmatch.filter(files, PROTOCOL_PATTERN):
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            found.append((path, stat.st_mtime_ns, stat.st_size))
+    return found
+
+
+def find_protocols(root, workers=8):
+    """Find all protocol files in an archive.
+
+    The top-level folders (projects) of the archive are walked in parallel.
+    Sessions that are not published (yet), or were rolled back (see
+    `publishing`), are skipped.
+
+    Parameters
+    ----------
+    root : str
+        the root folder of the archive
+    workers : int, optional
+        the number of folders to walk in parallel (default=8)
+
+    Returns
+    -------
+    protocols : list of (str, int, int)
+        the path, modification time (in ns) and size of each protocol file
+
+    """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    root = os.path.abspath(root)
+    folders = []
+    found = []
+    for entry in os.scandir(root):
+        if entry.is_dir():
+            if entry.name not in SKIPPED_FOLDERS:
+                folders.append(entry.path)
+        elif fnmatch.fnmatch(entry.name, PROTOCOL_PATTERN):
+            stat = entry.stat()
+            found.append((entry.path, stat.st_mtime_ns, stat.st_size))
+    with ThreadPoolExecutor(max(1, workers)) as executor:
+        for result in executor.map(_scan_folder, folders):
+            found.extend(result)
+    return found
+
+
+def _parse_protocol(item):
+    """Parse a protocol file (in a worker process)."""
+
+    path, mtime_ns, size = item
+    try:
+        with open(path) as f:
+            return path, mtime_ns, size, ScanProtocol.parse(f).to_dict()
+    except Exception:
+        return path, mtime_ns, size, None
+
+
+class ProtocolIndex:
+    """A searchable index over the scan protocols of one or more archives.
+
+    Parameters
+    ----------
+    filename : str, optional
+        the name of the index database (default=None, meaning
+        "protocol_index.sqlite" in the cache directory)
+
+    """
+
+    def __init__(self, filename=None):
+        if filename is None:
+            folder = get_cache_dir()
+            os.makedirs(folder, exist_ok=True)
+            filename = os.path.join(folder, INDEX_FILENAME)
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.executescript(SCHEMA)
+        try:
+            self.db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5({0})"
+                .format(", ".join(SEARCH_COLUMNS)))
+            self.fts = True
+        except sqlite3.OperationalError:  # SQLite without FTS5
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS search (rowid INTEGER PRIMARY "
+                "KEY, {0})".format(", ".join(SEARCH_COLUMNS)))
+            self.fts = False
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def update(self, root, workers=None):
+        """Update the index with the protocol files of an archive.
+
+        Only new and changed protocol files are parsed, and protocol files
+        that do no longer exist are removed from the index.
+
+        Parameters
+        ----------
+        root : str
+            the root folder of the archive
+        workers : int, optional
+            the number of processes to parse protocol files in
+            (default=None, meaning the number of CPUs)
+
+        Returns
+        -------
+        counts : dict
+            the number of "added", "updated", "removed", "unchanged" and
+            "failed" protocol files
+
+        """
+
+        root = os.path.abspath(root)
+        workers = workers or os.cpu_count() or 1
+        found = find_protocols(root, workers)
+
+        known = {}
+        prefix = os.path.join(root, "")
+        for row in self.db.execute(
+                "SELECT id, path, mtime_ns, size FROM protocols "
+                "WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)):
+            known[row["path"]] = (row["mtime_ns"], row["size"], row["id"])
+
+        counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0,
+                  "failed": 0}
+        changed = []
+        for item in found:
+            entry = known.pop(item[0], None)
+            if entry is not None and entry[:2] == item[1:]:
+                counts["unchanged"] += 1
+            else:
+                changed.append(item)
+
+        if workers > 1 and len(changed) > workers:
+            import multiprocessing
+            pool = multiprocessing.Pool(workers)
+            parsed = pool.imap_unordered(_parse_protocol, changed,
+                                         chunksize=16)
+        else:
+            pool = None
+            parsed = map(_parse_protocol, changed)
+
+        try:
+            with self.db:
+                for path, (_, _, protocol_id) in known.items():
+                    self._remove(protocol_id)
+                    counts["removed"] += 1
+                for path, mtime_ns, size, protocol in parsed:
+                    if protocol is None:
+                        counts["failed"] += 1
+                        continue
+                    row = self.db.execute(
+                        "SELECT id FROM protocols WHERE path = ?",
+                        (path,)).fetchone()
+                    if row is not None:
+                        self._remove(row["id"])
+                        counts["updated"] += 1
+                    else:
+                        counts["added"] += 1
+                    self._add(path, mtime_ns, size, protocol)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return counts
+
+    def _remove(self, protocol_id):
+        self.db.execute("DELETE FROM search WHERE rowid = ?", (protocol_id,))
+        self.db.execute("DELETE FROM protocols WHERE id = ?", (protocol_id,))
+
+    def _add(self, path, mtime_ns, size, protocol):
+        users = ", ".join(protocol["users"])
+        cursor = self.db.execute(
+            "INSERT INTO protocols (path, mtime_ns, size, project, subject, "
+            "subject_type, session, session_type, date, time_a, time_b, "
+            "users, notes, files) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, "
+            "?, ?, ?)",
+            (path, mtime_ns, size, protocol["project"],
+             protocol["subject"]["number"], protocol["subject"]["type"],
+             protocol["session"]["number"], protocol["session"]["type"],
+             protocol["date"], protocol["time_a"], protocol["time_b"], users,
+             protocol["notes"], "\n".join(protocol["files"])))
+        protocol_id = cursor.lastrowid
+        self.db.executemany(
+            "INSERT INTO checklist (protocol_id, document, checked) "
+            "VALUES (?, ?, ?)",
+            [(protocol_id, x["document"], int(x["checked"]))
+             for x in protocol["checklist"]])
+        self.db.executemany(
+            "INSERT INTO measurements (protocol_id, number, type, vols, name, "
+            "logfiles, comments) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(protocol_id, m["number"], m["type"], m["vols"], m["name"],
+              "\n".join(m["logfiles"]), m["comments"])
+             for m in protocol["measurements"]])
+        general = " ".join(str(x) for x in (
+            protocol["subject"]["type"], protocol["session"]["type"],
+            protocol["date"], users, os.path.split(path)[-1]))
+        measurements = "\n".join(
+            "{0} {1} {2}".format(m["type"], m["name"], m["comments"])
+            for m in protocol["measurements"])
+        self.db.execute(
+            "INSERT INTO search (rowid, {0}) VALUES (?, ?, ?, ?, ?)".format(
+                ", ".join(SEARCH_COLUMNS)),
+            (protocol_id, protocol["project"], general, protocol["notes"],
+             measurements))
+
+    def search(self, text=None, project=None, name=None, type=None,
+               min_vols=None, max_vols=None, checked=None, unchecked=None,
+               limit=None):
+        """Search the index.
+
+        Without any measurement criteria (name, type, min_vols, max_vols),
+        matching sessions are returned; otherwise matching measurements.
+
+        Parameters
+        ----------
+        text : str, optional
+            words to search for in the protocols (full-text search syntax,
+            if supported) (default=None)
+        project : str, optional
+            the project (default=None)
+        name : str, optional
+            the measurement name; can contain wildcards ("*", "?")
+            (default=None)
+        type : str, optional
+            the measurement type (default=None)
+        min_vols : int, optional
+            the minimal number of volumes of the measurement (default=None)
+        max_vols : int, optional
+            the maximal number of volumes of the measurement (default=None)
+        checked : str, optional
+            a document that has to be checked in the checklist (default=None)
+        unchecked : str, optional
+            a document that has to be in the checklist, but unchecked
+            (default=None)
+        limit : int, optional
+            the maximal number of results (default=None)
+
+        Returns
+        -------
+        results : list of sqlite3.Row
+            the matching sessions ("path", "project", "subject",
+            "subject_type", "session", "session_type", "date") or
+            measurements (additionally "number", "type", "vols", "name")
+
+        """
+
+        columns = ["p.path", "p.project", "p.subject", "p.subject_type",
+                   "p.session", "p.session_type", "p.date"]
+        tables = ["protocols p"]
+        where = []
+        args = []
+        if any(x is not None for x in (name, type, min_vols, max_vols)):
+            columns += ["m.number", "m.type", "m.vols", "m.name"]
+            tables.append("JOIN measurements m ON m.protocol_id = p.id")
+            order = "p.project, p.subject, p.session, p.path, m.number"
+        else:
+            order = "p.project, p.subject, p.session, p.path"
+        if text is not None:
+            if self.fts:
+                where.append("p.id IN (SELECT rowid FROM search "
+                             "WHERE search MATCH ?)")
+                args.append(text)
+            else:
+                where.append("p.id IN (SELECT rowid FROM search WHERE " +
+                             " OR ".join("{0} LIKE ?".format(x)
+                                         for x in SEARCH_COLUMNS) + ")")
+                args += ["%{0}%".format(text)] * len(SEARCH_COLUMNS)
+        if project is not None:
+            where.append("p.project = ?")
+            args.append(project)
+        if name is not None:
+            where.append("m.name GLOB ?")
+            args.append(name)
+        if type is not None:
+            where.append("m.type = ?")
+            args.append(type)
+        if min_vols is not None:
+            where.append("m.vols >= ?")
+            args.append(min_vols)
+        if max_vols is not None:
+            where.append("m.vols <= ?")
+            args.append(max_vols)
+        for document, state in ((checked, 1), (unchecked, 0)):
+            if document is not None:
+                where.append("p.id IN (SELECT protocol_id FROM checklist "
+                             "WHERE document = ? AND checked = ?)")
+                args += [document, state]
+
+        query = "SELECT {0} FROM {1}".format(", ".join(columns),
+                                             " ".join(tables))
+        if where:
+            query += " WHERE " + " AND ".join(where)
+        query += " ORDER BY " + order
+        if limit is not None:
+            query += " LIMIT ?"
+            args.append(limit)
+        return self.db.execute(query, args).fetchall()
+
+
+def format_result(row):
+    """Format a search result as a single line."""
+
+    subject = "sub-{0:03d}".format(row["subject"] or 0)
+    if row["subject_type"]:
+        subject += "-" + row["subject_type"]
+    session = "ses-{0:03d}".format(row["session"] or 0)
+    if row["session_type"]:
+        session += "-" + row["session_type"]
+    line = "{0}\t{1}\t{2}\t{3}".format(row["project"], subject, session,
+                                       row["date"])
+    if "number" in row.keys():
+        line += "\t{0:03d}\t{1}\t{2}\t{3}".format(
+            row["number"] or 0, row["type"], row["name"],
+            "" if row["vols"] is None else row["vols"])
+    return line + "\t" + row["path"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="scansessiontool-index",
+        description="Index and search the scan protocols of an archive")
+    parser.add_argument("--index", metavar="FILE",
+                        help="the index database (default: {0} in the "
+                             "cache directory)".format(INDEX_FILENAME))
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    update = subparsers.add_parser(
+        "update", help="add new and changed protocols of an archive")
+    update.add_argument("archives", nargs="+", metavar="ARCHIVE",
+                        help="the root folder of an archive")
+    update.add_argument("-j", "--workers", type=int,
+                        help="the number of worker processes (default: "
+                             "number of CPUs)")
+
+    query = subparsers.add_parser(
+        "query", help="search the index; prints one line per session (or "
+                      "per measurement, if measurement criteria are given)")
+    query.add_argument("text", nargs="?",
+                       help="words to search for (full-text search)")
+    query.add_argument("--project", help="the project")
+    query.add_argument("--name",
+                       help="the measurement name (wildcards allowed)")
+    query.add_argument("--type", choices=("anat", "func", "misc"),
+                       help="the measurement type")
+    query.add_argument("--min-vols", type=int, metavar="N",
+                       help="at least N volumes")
+    query.add_argument("--max-vols", type=int, metavar="N",
+                       help="at most N volumes")
+    query.add_argument("--checked", metavar="DOCUMENT",
+                       help="DOCUMENT is checked in the checklist")
+    query.add_argument("--unchecked", metavar="DOCUMENT",
+                       help="DOCUMENT is unchecked in the checklist")
+    query.add_argument("--limit", type=int, help="the maximal number of "
+                                                 "results")
+    args = parser.parse_args(argv)
+
+    with ProtocolIndex(args.index) as index:
+        if args.command == "update":
+            for archive in args.archives:
+                counts = index.update(archive, args.workers)
+                print("{0}: {1}".format(archive, ", ".join(
+                    "{0} {1}".format(v, k) for k, v in counts.items())))
+        else:
+            try:
+                results = index.search(
+                    args.text, args.project, args.name, args.type,
+                    args.min_vols, args.max_vols, args.checked,
+                    args.unchecked, args.limit)
+            except sqlite3.OperationalError as e:
+                sys.exit("Invalid query: {0}".format(e))
+            for row in results:
+                print(format_result(row))
+
+
+if __name__ == "__main__":
+    main()
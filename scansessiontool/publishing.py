@@ -0,0 +1,161 @@
+"""Publishing.
+
+Sessions are not written into the archive directly, but into a hidden folder
+in the root folder of the archive (`INCOMING_FOLDER`, on the same file
+system), and published with a single atomic rename once they are complete.
+This way, other tools watching the archive never see incomplete sessions.
+
+If archiving fails, the hidden folder is rolled back by renaming it into the
+trash (`TRASH_FOLDER`), which is emptied in the background, rather than
+deleting it while the operator waits.
+
+Folders left in `INCOMING_FOLDER` by an interrupted archiving procedure
+(e.g. after a power loss) are not published and can be removed.
+
+"""
+
+
+import os
+import sys
+import time
+import errno
+import shutil
+import itertools
+import threading
+
+
+INCOMING_FOLDER = ".incoming"
+TRASH_FOLDER = ".trash"
+
+_AT_FDCWD = -100
+_RENAME_NOREPLACE = 1
+
+_trashed = itertools.count()
+
+
+def _make_unique_folder(folder, name):
+    os.makedirs(folder, exist_ok=True)
+    number = 0
+    while True:
+        path = os.path.join(folder, "{0}-{1}-{2}".format(name, os.getpid(),
+                                                         number))
+        try:
+            os.mkdir(path)
+            return path
+        except FileExistsError:
+            number += 1
+
+
+def create_work_folder(root, target):
+    """Create a hidden folder to write a session into before publishing it.
+
+    Parameters
+    ----------
+    root : str
+        the root folder of the archive
+    target : str
+        the session folder (in the archive)
+
+    Returns
+    -------
+    folder : str
+        the hidden folder
+
+    """
+
+    name = os.path.relpath(os.path.abspath(target), os.path.abspath(root))
+    return _make_unique_folder(os.path.join(root, INCOMING_FOLDER),
+                               name.replace(os.sep, "_"))
+
+
+def _rename_noreplace(source, target):
+    """Rename a folder, failing if the target exists (even if empty)."""
+
+    if sys.platform.startswith("linux"):
+        try:
+            import ctypes
+            libc = ctypes.CDLL(None, use_errno=True)
+            if libc.renameat2(_AT_FDCWD, os.fsencode(source), _AT_FDCWD,
+                              os.fsencode(target), _RENAME_NOREPLACE) == 0:
+                return
+            error = ctypes.get_errno()
+            if error not in (errno.EINVAL, errno.ENOSYS):  # not supported
+                raise OSError(error, os.strerror(error), target)
+        except AttributeError:  # no renameat2 in libc
+            pass
+    if os.path.exists(target):
+        raise FileExistsError("{0} already exists!".format(target))
+    os.rename(source, target)
+
+
+def publish(folder, target):
+    """Publish a complete session by renaming it into the archive.
+
+    Parameters
+    ----------
+    folder : str
+        the hidden folder the session was written into (see
+        `create_work_folder`)
+    target : str
+        the session folder (in the archive)
+
+    """
+
+    os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+    _rename_noreplace(folder, target)
+
+
+def move_to_trash(path, root):
+    """Move a file or folder into the trash and empty it in the background.
+
+    Parameters
+    ----------
+    path : str
+        the file or folder (on the file system of `root`)
+    root : str
+        the root folder of the archive
+
+    Returns
+    -------
+    trashed : str
+        the file or folder in the trash
+
+    """
+
+    trash = os.path.join(root, TRASH_FOLDER)
+    os.makedirs(trash, exist_ok=True)
+    trashed = os.path.join(trash, "{0}-{1}-{2}-{3}".format(
+        time.strftime("%Y%m%d-%H%M%S"), os.getpid(), next(_trashed),
+        os.path.basename(path)))
+    os.rename(path, trashed)
+    empty_trash(root)
+    return trashed
+
+
+def _empty(trash):
+    for name in os.listdir(trash):
+        path = os.path.join(trash, name)
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)  # e.g. a container file
+            except OSError:
+                pass
+
+
+def empty_trash(root):
+    """Empty the trash (in the background).
+
+    Parameters
+    ----------
+    root : str
+        the root folder of the archive
+
+    """
+
+    trash = os.path.join(root, TRASH_FOLDER)
+    if os.path.isdir(trash) and os.listdir(trash):
+        thread = threading.Thread(target=_empty, args=(trash,))
+        thread.daemon = True
+        thread.start()
@@ -0,0 +1,297 @@
+"""Report.
+
+Timing and throughput bookkeeping for the archiving procedure of Scan Session
+Tool.
+
+"""
+
+
+import json
+import time
+
+
+def format_bytes(nbytes):
+    """Format a number of bytes in a human readable way.
+
+    Parameters
+    ----------
+    nbytes : int or float
+        the number of bytes
+
+    Returns
+    -------
+    formatted : str
+        the formatted number of bytes (e.g. "12.3 MB")
+
+    """
+
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(nbytes) < 1000:
+            break
+        nbytes /= 1000.0
+    else:
+        unit = "TB"
+    if unit == "B":
+        return "{0} {1}".format(int(nbytes), unit)
+    return "{0:.1f} {1}".format(nbytes, unit)
+
+
+class ArchiveReport:
+    """Timers, file counts and byte counts of an archiving procedure.
+
+    Each stage of the archiving procedure is recorded as a named phase.
+    Phases can be started and stopped several times (e.g. once per
+    measurement); their numbers accumulate. Work done on behalf of a single
+    measurement is additionally recorded per measurement. Phases that only
+    scan the source data (see `SCAN_PHASES`) are not included in the totals,
+    so that each archived byte is counted once.
+
+    Parameters
+    ----------
+    metrics : MetricsSink, optional
+        a metrics sink to forward per-file latencies, queue depths, errors
+        and phase outcomes to (default=None)
+
+    """
+
+    SCAN_PHASES = ("Reading DICOM images",)
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.phases = {}
+        self.measurements = {}
+        self.errors = {}
+        self.devices = {}
+        self.compression = None
+        self.mirrors = {}
+        self.throttle = None
+        self.durability = None
+        self.retries = 0
+        self.failed = []
+        self._running = {}
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+
+    @staticmethod
+    def _new_entry():
+        return {"seconds": 0.0, "files": 0, "bytes": 0}
+
+    def _entries(self, name, measurement):
+        entries = [self.phases.setdefault(name, self._new_entry())]
+        if measurement is not None:
+            m = self.measurements.setdefault(str(measurement), {})
+            entries.append(m.setdefault(name, self._new_entry()))
+        return entries
+
+    def start(self, name, measurement=None):
+        """Start timing a phase of the archiving procedure.
+
+        Parameters
+        ----------
+        name : str
+            the name of the phase
+        measurement : int, optional
+            the measurement number the phase is run for (default=None)
+
+        """
+
+        self._entries(name, measurement)
+        self._running[(name, measurement)] = time.perf_counter()
+
+    def stop(self, name, measurement=None):
+        """Stop timing a phase of the archiving procedure.
+
+        Stopping a phase that is not running has no effect.
+
+        Parameters
+        ----------
+        name : str
+            the name of the phase
+        measurement : int, optional
+            the measurement number the phase is run for (default=None)
+
+        """
+
+        start = self._running.pop((name, measurement), None)
+        if start is not None:
+            elapsed = time.perf_counter() - start
+            for entry in self._entries(name, measurement):
+                entry["seconds"] += elapsed
+
+    def add(self, name, files=0, nbytes=0, measurement=None, latency=None):
+        """Add file and byte counts to a phase.
+
+        Parameters
+        ----------
+        name : str
+            the name of the phase
+        files : int, optional
+            the number of files processed (default=0)
+        nbytes : int, optional
+            the number of bytes processed (default=0)
+        measurement : int, optional
+            the measurement number the files belong to (default=None)
+        latency : float, optional
+            the time in seconds it took to process a single file; only
+            forwarded to the metrics sink (default=None)
+
+        """
+
+        for entry in self._entries(name, measurement):
+            entry["files"] += files
+            entry["bytes"] += nbytes
+        if self.metrics is not None and latency is not None:
+            if name in self.SCAN_PHASES:
+                self.metrics.observe_parse(latency)
+            else:
+                self.metrics.observe_copy(name, latency, nbytes)
+
+    def error(self, name):
+        """Count an error in a phase.
+
+        Parameters
+        ----------
+        name : str
+            the name of the phase
+
+        """
+
+        self.errors[name] = self.errors.get(name, 0) + 1
+        if self.metrics is not None:
+            self.metrics.error(name)
+
+    def queue(self, name, depth):
+        """Record the number of files still waiting to be processed.
+
+        Parameters
+        ----------
+        name : str
+            the name of the phase
+        depth : int
+            the number of waiting files
+
+        """
+
+        if self.metrics is not None:
+            self.metrics.observe_queue(name, depth)
+
+    def finish(self):
+        """Stop the overall timer and export metrics."""
+
+        self.duration = time.perf_counter() - self._start
+        if self.metrics is not None:
+            for name, entry in self.phases.items():
+                self.metrics.phase(name, entry["seconds"], entry["files"],
+                                   entry["bytes"])
+            self.metrics.finish(self)
+
+    @property
+    def total_seconds(self):
+        if self.duration is not None:
+            return self.duration
+        return time.perf_counter() - self._start
+
+    @property
+    def total_files(self):
+        return sum(x["files"] for name, x in self.phases.items()
+                   if name not in self.SCAN_PHASES)
+
+    @property
+    def total_bytes(self):
+        return sum(x["bytes"] for name, x in self.phases.items()
+                   if name not in self.SCAN_PHASES)
+
+    def to_dict(self):
+        """Return the report as a JSON serializable dictionary."""
+
+        def with_throughput(entry):
+            entry = dict(entry)
+            if entry["seconds"] > 0:
+                entry["bytes_per_second"] = entry["bytes"] / entry["seconds"]
+                entry["files_per_second"] = entry["files"] / entry["seconds"]
+            else:
+                entry["bytes_per_second"] = None
+                entry["files_per_second"] = None
+            return entry
+
+        return {
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S",
+                                     time.localtime(self.started)),
+            "total": with_throughput({"seconds": self.total_seconds,
+                                      "files": self.total_files,
+                                      "bytes": self.total_bytes}),
+            "errors": dict(self.errors),
+            "devices": dict(self.devices),
+            "compression": self.compression,
+            "mirrors": dict(self.mirrors),
+            "throttle": self.throttle,
+            "durability": self.durability,
+            "retries": self.retries,
+            "failed": list(self.failed),
+            "phases": {name: with_throughput(entry) for name, entry in
+                       self.phases.items()},
+            "measurements": {number: {name: with_throughput(entry)
+                                      for name, entry in phases.items()}
+                             for number, phases in self.measurements.items()}}
+
+    def save(self, filename):
+        """Save the report as JSON file.
+
+        Parameters
+        ----------
+        filename : str
+            the name of the file to save the report to
+
+        """
+
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    def summary(self):
+        """Return a human readable throughput summary."""
+
+        lines = ["\nThroughput summary:\n"]
+        for name, entry in list(self.phases.items()) + \
+                [("Total", {"seconds": self.total_seconds,
+                            "files": self.total_files,
+                            "bytes": self.total_bytes})]:
+            line = "    {0}: {1} files, {2} in {3:.2f} s".format(
+                name, entry["files"], format_bytes(entry["bytes"]),
+                entry["seconds"])
+            if entry["bytes"] > 0 and entry["seconds"] > 0:
+                line += " ({0}/s)".format(
+                    format_bytes(entry["bytes"] / entry["seconds"]))
+            lines.append(line + "\n")
+        if self.compression and self.compression["bytes_before"] > 0:
+            lines.append(
+                "    DICOM compression: {0} files, {1} -> {2} "
+                "({3:.0f}%)\n".format(
+                    self.compression["encoded"],
+                    format_bytes(self.compression["bytes_before"]),
+                    format_bytes(self.compression["bytes_after"]),
+                    100.0 * self.compression["bytes_after"] /
+                    self.compression["bytes_before"]))
+        if self.throttle and self.throttle["waited"] > 0:
+            lines.append("    Throttled: waited {0:.2f} s\n".format(
+                self.throttle["waited"]))
+        if self.retries:
+            lines.append("    Retried: {0} file operations\n".format(
+                self.retries))
+        if self.failed:
+            lines.append("    Failed: {0} files\n".format(len(self.failed)))
+        if self.durability:
+            lines.append("    Durability: {0} ({1})\n".format(
+                self.durability["mode"], self.durability["guarantee"]))
+            if self.durability["seconds"] > 0:
+                lines.append("    Syncing to disk: {0:.2f} s\n".format(
+                    self.durability["seconds"]))
+        for root, entry in self.mirrors.items():
+            if entry["error"] is None:
+                lines.append("    Mirror {0}: {1} files, {2} in {3:.2f} s"
+                             "\n".format(root, entry["files"],
+                                         format_bytes(entry["bytes"]),
+                                         entry["seconds"]))
+            else:
+                lines.append("    Mirror {0}: failed\n".format(root))
+        return "".join(lines)
@@ -0,0 +1,181 @@
+"""Retrying.
+
+File operations on network storage (e.g. SMB or NFS shares) fail transiently
+every now and then. Errors of the archiving procedure are therefore isolated
+per file (a failing file does not affect the other files of a measurement)
+and classified (see `classify`). Operations that failed transiently (e.g.
+with EIO, or a timeout) are retried, only the failed file, with exponential
+backoff, configured in the "Settings" section of the config file:
+
+    Settings:
+        Retries:
+            Attempts:  4        # including the first one
+            Delay:     0.5      # s, doubled with every retry
+            MaxDelay:  30       # s
+
+Files that still fail are listed in the warnings and in the archive report.
+
+"""
+
+
+import time
+import errno
+import struct
+import tarfile
+import zipfile
+import zlib
+
+
+DEFAULT_ATTEMPTS = 4
+DEFAULT_DELAY = 0.5  # s
+DEFAULT_MAX_DELAY = 30  # s
+
+# Categories of errors
+TRANSIENT = "transient"
+MISSING = "missing"
+PERMISSION = "permission denied"
+NO_SPACE = "no space"
+CORRUPT = "corrupt"
+OTHER = "error"
+
+TRANSIENT_ERRNOS = {getattr(errno, x) for x in (
+    "EIO", "EAGAIN", "EBUSY", "EINTR", "ETIMEDOUT", "ECONNRESET",
+    "ECONNABORTED", "ENETDOWN", "ENETUNREACH", "ENETRESET", "EHOSTDOWN",
+    "EHOSTUNREACH", "ESTALE", "ENOLINK", "ECOMM") if hasattr(errno, x)}
+
+# Network errors on Windows (ERROR_BAD_NETPATH, ERROR_UNEXP_NET_ERR,
+# ERROR_NETNAME_DELETED, ERROR_SEM_TIMEOUT, ERROR_NETWORK_UNREACHABLE)
+TRANSIENT_WINERRORS = {53, 59, 64, 121, 1231}
+
+NO_SPACE_ERRNOS = {getattr(errno, x) for x in ("ENOSPC", "EDQUOT")
+                   if hasattr(errno, x)}
+
+# Errors reading a damaged file
+CORRUPT_ERRORS = (ValueError, EOFError, KeyError, AttributeError,
+                  struct.error, zlib.error, zipfile.BadZipFile,
+                  tarfile.TarError)
+
+
+def classify(error):
+    """Classify an error of a file operation.
+
+    Parameters
+    ----------
+    error : Exception
+        the error
+
+    Returns
+    -------
+    category : str
+        the category (`TRANSIENT`, `MISSING`, `PERMISSION`, `NO_SPACE`,
+        `CORRUPT` or `OTHER`); only transient errors are worth retrying
+
+    """
+
+    if isinstance(error, (TimeoutError, ConnectionError, InterruptedError)):
+        return TRANSIENT
+    if isinstance(error, OSError):
+        if error.errno in TRANSIENT_ERRNOS or \
+                getattr(error, "winerror", None) in TRANSIENT_WINERRORS:
+            return TRANSIENT
+        if isinstance(error, FileNotFoundError):
+            return MISSING
+        if isinstance(error, PermissionError):
+            return PERMISSION
+        if error.errno in NO_SPACE_ERRNOS:
+            return NO_SPACE
+        return OTHER
+    if isinstance(error, CORRUPT_ERRORS) or \
+            type(error).__module__.startswith("pydicom"):
+        return CORRUPT
+    return OTHER
+
+
+def describe(error):
+    """Describe an error of a file operation, with its category (see
+    `classify`)."""
+
+    message = getattr(error, "strerror", None) or str(error) or \
+        type(error).__name__
+    return "{0}: {1}".format(classify(error), message)
+
+
+class RetryPolicy:
+    """Retry operations that failed transiently, with exponential backoff.
+
+    Parameters
+    ----------
+    attempts : int, optional
+        the maximal number of attempts, including the first one (default=4)
+    delay : float, optional
+        the number of seconds to wait before the first retry, doubled with
+        every further retry (default=0.5)
+    max_delay : float, optional
+        the maximal number of seconds to wait before a retry (default=30)
+
+    """
+
+    def __init__(self, attempts=DEFAULT_ATTEMPTS, delay=DEFAULT_DELAY,
+                 max_delay=DEFAULT_MAX_DELAY):
+        self.attempts = max(1, int(attempts))
+        self.delay = float(delay)
+        self.max_delay = float(max_delay)
+
+    @classmethod
+    def from_config(cls, settings):
+        """Create a retry policy with "Retries" of the settings.
+
+        Parameters
+        ----------
+        settings : dict
+            the site-wide settings
+
+        Returns
+        -------
+        policy : RetryPolicy
+            the retry policy
+
+        """
+
+        config = (settings or {}).get("Retries", {})
+        if config in (False, None, "no"):
+            return cls(1)
+        return cls(config.get("Attempts", DEFAULT_ATTEMPTS),
+                   config.get("Delay", DEFAULT_DELAY),
+                   config.get("MaxDelay", DEFAULT_MAX_DELAY))
+
+    def delays(self):
+        """Get the number of seconds to wait before each retry."""
+
+        return [min(self.max_delay, self.delay * 2 ** x)
+                for x in range(self.attempts - 1)]
+
+    def call(self, func, *args, on_retry=None):
+        """Call an operation, retrying it if it fails transiently.
+
+        Parameters
+        ----------
+        func : callable
+            the operation, called with args
+        on_retry : callable, optional
+            a function called with the error and the delay before every
+            retry (default=None)
+
+        Returns
+        -------
+        result : object
+            the return value of the operation
+
+        """
+
+        delays = iter(self.delays())
+        while True:
+            try:
+                return func(*args)
+            except Exception as e:
+                delay = next(delays, None)
+                if delay is None or classify(e) != TRANSIENT:
+                    raise
+                if on_retry is not None:
+                    on_retry(e, delay)
+                time.sleep(delay)
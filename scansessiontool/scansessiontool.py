@@ -8,11 +8,7 @@ A tool for MR scan session documentation and data archiving.
 import os
 import platform
 import time
-import glob
-import json
-import shutil
 import threading
-import multiprocessing
 
 from tkinter import *
 from tkinter.ttk import *
@@ -22,26 +18,29 @@ from tkinter import filedialog as tkFileDialog
 from tkinter import messagebox as tkMessageBox
 from tkinter.scrolledtext import ScrolledText
 
-import yaml
-
 from .__meta__ import __version__, __date__
 from .widgets import (FixedSizeFrame,
                       AutoScrollbarText,
-                      VerticalScrolledFrame,
+                      VirtualScrolledList,
+                      MeasurementRow,
                       AutocompleteCombobox,
                       Spinbox)
 from .dialogues import (ArchiveDialogue,
                         BusyDialogue,
                         MessageDialogue,
                         HelpDialogue)
-from .utilities import (replace,
-                        readdicom)
+from .profiling import Profiler
+from .config import Config, load_config
+from .protocol import Measurement, ScanProtocol
+
+# Heavy dependencies (yaml, pydicom, multiprocessing) and modules only needed
+# for archiving are imported on first use, to keep the time-to-window short
 
 
 class ScanSessionTool(Frame):
     """The main Scan Session Tool Tkinter application."""
 
-    def __init__(self, master, run_actions=None):
+    def __init__(self, master, run_actions=None, profile=None):
         """Initialize the application.
 
         Parameters
@@ -57,6 +56,13 @@ class ScanSessionTool(Frame):
             method needs to specifically implement this feature (and only few
             do); currently this feature is mainly used for implementing
             automated tests; (default=None)
+        profile : str, optional
+            when set, profile archiving and GUI hot paths right from the
+            start and write the profiling bundle into the specified folder
+            when quitting (an empty string means the home directory);
+            profiling can also be toggled with a hidden menu entry, which is
+            revealed with Control-Shift-P (Command-Shift-P on macOS);
+            (default=None)
 
         """
 
@@ -64,6 +70,15 @@ class ScanSessionTool(Frame):
 
         self.run_actions = run_actions
 
+        # Always go through the profiler, so it can be toggled at runtime
+        self.profiler = Profiler(profile or None)
+        for method in ("_archive_runs", "open", "save", "change_callback",
+                       "measurement_callback"):
+            setattr(self, method, self.profiler.wrap(method,
+                                                     getattr(self, method)))
+        if profile is not None:
+            self.profiler.start()
+
         self.master.withdraw()
 
         # Change application icon
@@ -152,6 +167,11 @@ class ScanSessionTool(Frame):
             label="Scan Session Tool Help",
             command=lambda: HelpDialogue(self.master), accelerator="F1")
         self.master.bind("<F1>", lambda x: HelpDialogue(self.master))
+        self.profiling_var = IntVar()
+        self.profiling_var.set(int(self.profiler.active))
+        if self.profiler.active:
+            self.show_profiling_menu()
+        self.master.bind("<{0}-P>".format(modifier), self.show_profiling_menu)
         self.master["menu"] = self.menubar
 
 
@@ -181,11 +201,26 @@ class ScanSessionTool(Frame):
         self.additional_documents_vars = []
         self.additional_documents_widgets = []
         self.measurements = []
-        self.measurements_widgets = []
         self.nofocus_widgets = []
-        self.prt_files = []
-        self.config = {}
-        self.load_config()
+        self.config = Config()
+        self.settings = {}
+        self.flusher = None
+
+        # Field changes are dispatched to handlers registered per field;
+        # changes of text widgets are debounced (in ms) while typing
+        self.handlers = {}
+        self.pending_text_changes = {}
+        self.text_debounce = 150
+        self.dirty = False
+        self.callbacks_suspended = False
+
+        # Changes of measurements are dispatched to handlers per field
+        self.measurement_handlers = {
+            "type": [self.type_changed],
+            "vols": [self.measurement_changed],
+            "name": [self.name_changed, self.measurement_changed],
+            "logfiles": [self.measurement_changed],
+            "comments": [self.measurement_changed]}
         self.create_widgets()
 
         self.set_title()
@@ -196,11 +231,16 @@ class ScanSessionTool(Frame):
         for label in self.nofocus_widgets:
             label.bind('<Button-1>', lambda x: self.master.focus())
         self.master.protocol("WM_DELETE_WINDOW", self.quit_callback)
-        self.master.update()
+        self.master.update_idletasks()
         self.master.deiconify()
         self.master.lift()
         self.master.focus_force()
         self.general_widgets[0].focus()
+        self.master.update()  # first paint
+
+        # Config is only needed once the user starts typing
+        self.load_config()
+        self.apply_config()
         self.disable_save()
         self.mouseover_callback(True)
 
@@ -272,6 +312,8 @@ class ScanSessionTool(Frame):
             elif row in (0, 6, 7):
                 var = StringVar()
                 var.trace("w", self.change_callback)
+                if row == 0:
+                    self.register_handler(var, self.project_changed)
                 self.general_vars.append(var)
                 validate = None
                 vcmd = None
@@ -297,14 +339,13 @@ class ScanSessionTool(Frame):
                         validate=validate, validatecommand=vcmd,
                         font=self.font, width=width)
 
-                if row == 0:
-                    projects = sorted(self.config.keys())
-                    combobox.set_completion_list(projects)
                 combobox.grid(row=row, column=1, sticky="W")
                 self.general_widgets.append(combobox)
             elif row in (3, 4, 5):
                 var = StringVar()
                 var.trace("w", self.change_callback)
+                if row == 3:
+                    self.register_handler(var, self.update_archive)
                 self.general_vars.append(var)
                 if row == 3:
                     validate = "key"
@@ -339,7 +380,7 @@ class ScanSessionTool(Frame):
         notes = AutoScrollbarText(notes_container, wrap=NONE)
         notes.grid(row=0, column=0, sticky="N")
         self.general_widgets.append(notes)
-        notes.bind('<KeyRelease>', self.change_callback)
+        notes.bind('<KeyRelease>', lambda x: self.text_callback(str(notes)))
 
         for label in self.general_labels:
             self.nofocus_widgets.append(label)
@@ -400,6 +441,9 @@ class ScanSessionTool(Frame):
         self.go_button = Button(self.button_frame, text="Archive",
                                 state="disabled", command=self.archive)
         self.go_button.grid(row=2, column=0, sticky="")
+        # State of the flush queue (created once staging is configured)
+        self.staging_var = StringVar()
+        self.staging_label = None
         documents_label = Label(self.top_frame, text="Documents")
         documents_label['font'] = (self.default_font,
                                    self.default_font_size - 2,
@@ -421,7 +465,8 @@ class ScanSessionTool(Frame):
         self.files = AutoScrollbarText(files_container, wrap=NONE,
                                        background=self.orange,
                                        highlightbackground=self.orange)
-        self.files.bind('<KeyRelease>', self.change_callback)
+        self.files.bind('<KeyRelease>',
+                        lambda x: self.text_callback(str(self.files)))
         self.files.grid(sticky="NWES")
         empty_label = Label(self.documents_frame, text="")
         empty_label.grid(row=2, sticky="W", padx=10)
@@ -457,13 +502,12 @@ class ScanSessionTool(Frame):
         self.measurements_frame1.grid_rowconfigure(1, weight=1)
         self.measurements_frame1.grid(row=0, sticky="WENS")
         self.nofocus_widgets.append(self.measurements_frame1)
-        self.measurements_frame = VerticalScrolledFrame(
-            self.measurements_frame1, height=295, width=989) #989
-        self.measurements_frame.interior.grid_columnconfigure(0, weight=1)
-        self.measurements_frame.interior.grid_rowconfigure(0, weight=1)
+        # Only the visible measurements get widgets (recycled on scrolling)
+        self.measurements_frame = VirtualScrolledList(
+            self.measurements_frame1, 59, self.create_measurement_row,
+            self.show_measurement_row, height=295, width=989) #989
         self.measurements_frame.grid(row=1, sticky="WENS")
         self.nofocus_widgets.append(self.measurements_frame)
-        self.nofocus_widgets.append(self.measurements_frame.interior)
         self.nofocus_widgets.append(self.measurements_frame.canvas)
         add_del_frame = Frame(self.measurements_frame1)
         add_del_frame.grid(row=2, pady=(10, 10))
@@ -528,142 +572,173 @@ class ScanSessionTool(Frame):
 
 
     def new_measurement(self, *args):
-        value = repr(len(self.measurements) + 1).zfill(3)
-        scanning_vars = []
-        scanning_widgets = []
-        var1 = StringVar()
-        scanning_vars.append(var1)
-        var1.set(value)
-        var1.trace("w", self.change_callback)
-        spinbox = Spinbox(self.measurements_frame.interior, from_=1, to=99,
-                          format="%03.0f",width=3, justify="right",
-                          state="readonly", textvariable=var1, font=self.font,
-                          style="Orange.TSpinbox")
+        idx = len(self.measurements)
+        self.measurements.append(
+            Measurement(number=repr(len(self.measurements) + 1).zfill(3)))
+        self.measurements_frame.set_count(len(self.measurements))
+        self.mark_dirty()
+        self.type_changed(idx)  # Update Names
+        self.update_minus()
+
+    def del_measurement(self, *args):
+        idx = len(self.measurements) - 1
+        self.measurements.pop()
+        for field in ("logfiles", "comments"):
+            try:
+                self.after_cancel(self.pending_text_changes.pop(
+                    (idx, field)))
+            except KeyError:
+                pass
+        self.measurements_frame.set_count(len(self.measurements))
+        self.mark_dirty()
+        self.update_minus()
+
+    def create_measurement_row(self, parent):
+        """Create the (empty) widgets of a measurement row."""
 
-        spinbox.grid(row=int(value), column=0, sticky="W", padx=(10, 2))
+        row = MeasurementRow(parent, self.measurement_callback,
+                             style="Grey.TFrame")
+        row.grid_columnconfigure(0, weight=1)
+        see = lambda event: self.measurements_frame.see(row.index)
+
+        spinbox = Spinbox(row, from_=1, to=99,
+                          format="%03.0f",width=3, justify="right",
+                          state="readonly", textvariable=row.add_var("number"),
+                          font=self.font, style="Orange.TSpinbox")
+        spinbox.grid(row=0, column=0, sticky="W", padx=(10, 2))
         spinbox.bind('<Enter>',
                      lambda event: self.mouseover_callback(True))
         spinbox.bind('<Leave>',
                      lambda event: self.mouseover_callback(False))
         spinbox.bind('<MouseWheel>', lambda x: 'break')
-        scanning_widgets.append(spinbox)
-        var2 = StringVar()
-        var2.trace("w", self.change_callback)
-        scanning_vars.append(var2)
+        spinbox.bind('<FocusIn>', see)
 
         width = 9
         if platform.system() == "Windows":
             width += 2
         if platform.system() == "Linux":
             width += 5
-        combobox = AutocompleteCombobox(self.measurements_frame.interior,
-                            textvariable=var2, width=width, state="readonly",
-                            font=self.font, style="Orange.TCombobox")
+        combobox = AutocompleteCombobox(row, textvariable=row.add_var("type"),
+                                        width=width, state="readonly",
+                                        font=self.font,
+                                        style="Orange.TCombobox")
         combobox.set_completion_list(["anat", "func", "misc"])
-        combobox.current(0)
-        combobox.grid(row=int(value), column=1, sticky="", padx=2)
+        combobox.grid(row=0, column=1, sticky="", padx=2)
         combobox.bind('<Enter>',
                       lambda event: self.mouseover_callback(True))
         combobox.bind('<Leave>',
                       lambda event: self.mouseover_callback(False))
         combobox.bind('<MouseWheel>', lambda x: 'break')
-        scanning_widgets.append(combobox)
+        combobox.bind('<FocusIn>', see)
 
-        var3 = StringVar()
-        var3.trace("w", self.change_callback)
-        scanning_vars.append(var3)
         validate = "key"
         vcmd = (self.master.register(self.validate),
                 "0123456789", 4, '%S', '%P')
-
-        vols = Entry(self.measurements_frame.interior, width=4,
-                       justify="right", textvariable=var3,
-                       validate=validate, validatecommand=vcmd,
-                       font=self.font, style="Red.TEntry")
+        vols = Entry(row, width=4, justify="right",
+                     textvariable=row.add_var("vols"), validate=validate,
+                     validatecommand=vcmd, font=self.font, style="Red.TEntry")
         vols.bind('<MouseWheel>', lambda x: 'break')
-        vols.grid(row=int(value), column=2, sticky="", padx=2)
-        scanning_widgets.append(vols)
-        var4 = StringVar()
-        var4.trace("w", self.change_callback)
-        scanning_vars.append(var4)
-        validate = None
-        vcmd = None
+        vols.bind('<FocusIn>', see)
+        vols.grid(row=0, column=2, sticky="", padx=2)
+
         width = 20
         if platform.system() == "Windows":
             width += 3
-        name = AutocompleteCombobox(self.measurements_frame.interior,
-                                    textvariable=var4, validate=validate,
-                                    validatecommand=vcmd, font=self.font,
-                                    style="Red.TCombobox", width=width)
-        name.grid(row=int(value), column=3, sticky="", padx=2)
-        name.bind('<Enter>',
-                  lambda event: self.mouseover_callback(True))
-        name.bind('<Leave>',
-                        lambda event: self.mouseover_callback(False))
-        name.bind('<MouseWheel>', lambda x: 'break')
-        scanning_widgets.append(name)
-        container2 = FixedSizeFrame(self.measurements_frame.interior, 299, 53)
-        container2.grid(row=int(value), column=4, sticky="NSE", pady=3, padx=2)
-        scanning_widgets.append(container2)
+        row.name = AutocompleteCombobox(row, textvariable=row.add_var("name"),
+                                        font=self.font, style="Red.TCombobox",
+                                        width=width)
+        row.name.grid(row=0, column=3, sticky="", padx=2)
+        row.name.bind('<Enter>',
+                      lambda event: self.mouseover_callback(True))
+        row.name.bind('<Leave>',
+                      lambda event: self.mouseover_callback(False))
+        row.name.bind('<MouseWheel>', lambda x: 'break')
+        row.name.bind('<FocusIn>', see)
+
+        container2 = FixedSizeFrame(row, 299, 53)
+        container2.grid(row=0, column=4, sticky="NSE", pady=3, padx=2)
         logfiles = AutoScrollbarText(container2, wrap=NONE,
                                      background=self.orange,
                                      highlightbackground=self.orange)
-        logfiles.bind('<KeyRelease>', self.change_callback)
         logfiles.frame.bind('<Enter>',
-                        lambda event: self.mouseover_callback(True))
+                            lambda event: self.mouseover_callback(True))
         logfiles.frame.bind('<Leave>',
-                        lambda event: self.mouseover_callback(False))
-        scanning_vars.append(logfiles)  # Needs to be called with START, END!
+                            lambda event: self.mouseover_callback(False))
+        logfiles.bind('<FocusIn>', see)
         logfiles.grid()
-        scanning_widgets.append(logfiles)
-        container3 = FixedSizeFrame(self.measurements_frame.interior, 299, 53)
-        container3.grid(row=int(value), column=5, sticky="NSE", pady=3,
-                        padx=(2, 10))
-        scanning_widgets.append(container3)
+        row.add_text("logfiles", logfiles)
+
+        container3 = FixedSizeFrame(row, 299, 53)
+        container3.grid(row=0, column=5, sticky="NSE", pady=3, padx=(2, 10))
         text = AutoScrollbarText(container3, wrap=NONE)
-        text.bind('<KeyRelease>', self.change_callback)
         text.frame.bind('<Enter>',
                         lambda event: self.mouseover_callback(True))
         text.frame.bind('<Leave>',
                         lambda event: self.mouseover_callback(False))
-        scanning_vars.append(text)  # Needs to be called with START, END!
+        text.bind('<FocusIn>', see)
         text.grid()
-        scanning_widgets.append(text)
-        self.measurements.append(scanning_vars)
-        self.measurements_widgets.append(scanning_widgets)
-        self.change_callback(str(var2))  # Update Names
-        self.prt_files.append("")
+        row.add_text("comments", text)
+        return row
 
-    def del_measurement(self, *args):
-        for s in self.measurements_widgets[-1]:
-            s.grid_remove()
-            del s
-        self.measurements_widgets.pop()
-        self.measurements.pop()
-        self.change_callback(None)
+    def show_measurement_row(self, row, idx):
+        """Show a measurement in a (possibly recycled) row."""
+
+        row.show(idx, self.measurements[idx])
+        self.type_changed(idx)
+
+    def measurement_callback(self, idx, field, value):
+        """Store a change of a measurement and dispatch it to its handlers.
+
+        Changes of multi-line fields are dispatched debounced while typing.
+
+        """
+
+        if self.callbacks_suspended:
+            return
+        setattr(self.measurements[idx], field, value)
+        self.mark_dirty()
+        if field in ("logfiles", "comments"):
+            key = (idx, field)
+            try:
+                self.after_cancel(self.pending_text_changes[key])
+            except KeyError:
+                pass
+            self.pending_text_changes[key] = self.after(
+                self.text_debounce,
+                lambda: self._flush_measurement_change(idx, field))
+        else:
+            self._flush_measurement_change(idx, field)
+
+    def _flush_measurement_change(self, idx, field):
+        self.pending_text_changes.pop((idx, field), None)
+        if idx < len(self.measurements):
+            for handler in self.measurement_handlers.get(field, ()):
+                handler(idx)
 
     def add_additional_documents(self):
-        current_project = self.general_widgets[0].get()
+        project = self.config.get(self.general_widgets[0].get())
         try:
-            for x in self.config[current_project]["Checklist"]:
+            for x in project.checklist:
                 if not x in self.documents:
-                    var = IntVar()
-                    var.trace("w", self.change_callback)
-                    check = Checkbutton(self.documents_frame, text=x,
-                                        variable=var)
-                    check.grid(sticky="W", padx=10)
-                    self.documents.append(x)
-                    self.documents_vars.append(var)
-                    self.additional_documents.append(x)
-                    self.additional_documents_vars.append(var)
-                    self.additional_documents_widgets.append(check)
+                    self.add_document(x)
         except:
             pass
 
+    def add_document(self, x):
+        var = IntVar()
+        var.trace("w", self.change_callback)
+        check = Checkbutton(self.documents_frame, text=x, variable=var)
+        check.grid(sticky="W", padx=10)
+        self.documents.append(x)
+        self.documents_vars.append(var)
+        self.additional_documents.append(x)
+        self.additional_documents_vars.append(var)
+        self.additional_documents_widgets.append(check)
+
     def add_files(self):
-        current_project = self.general_widgets[0].get()
+        project = self.config.get(self.general_widgets[0].get())
         try:
-            for x in self.config[current_project]["Files"]:
+            for x in project.files:
                 if not x in self.files.get(1.0, END).strip("\n"):
                     self.files.insert(END, x + '\n')
         except:
@@ -675,9 +750,6 @@ class ScanSessionTool(Frame):
         self.general_widgets[6].set_completion_list([])
         self.general_widgets[7].set_completion_list([])
         self.files.delete(1.0, END)
-        for index, m in enumerate(self.measurements_widgets):
-            t = self.measurements[index][1].get()
-            m[3].set_completion_list([])
         for w in self.additional_documents_widgets:
             w.grid_remove()
         for v in self.additional_documents_vars:
@@ -721,6 +793,7 @@ class ScanSessionTool(Frame):
             self.master.bind("<Command-s>", self.save)
         else:
             self.master.bind("<Control-s>", self.save)
+        self.dirty = True
 
     def disable_save(self):
         self.save_button["state"] = "disabled"
@@ -729,6 +802,7 @@ class ScanSessionTool(Frame):
             self.master.unbind("<Command-s>")
         else:
             self.master.unbind("<Control-s>")
+        self.dirty = False
 
     def enable_archive(self):
         self.go_button["state"] = "enabled"
@@ -766,67 +840,135 @@ class ScanSessionTool(Frame):
         if self.save_button["state"] == "enabled":
             if tkMessageBox.askyesno("Save?", "Save before quitting?"):
                 self.save()
+        if self.flusher is not None and self.flusher.current is not None:
+            if not tkMessageBox.askyesno(
+                    "Quit?", "Sessions are still being flushed to the "
+                    "archive; flushing continues when the Scan Session Tool "
+                    "is started next.\n\nQuit anyway?"):
+                return
+        if self.profiler.active:
+            tkMessageBox.showinfo(
+                "Profiling",
+                "Profile written to: {0}".format(self.profiler.stop()),
+                parent=self.master)
         self.master.destroy()
 
-    def change_callback(self, *args):
+    def show_profiling_menu(self, *args):
         try:
-            self.enable_save()
-        except:
-            pass
+            self.help_menu.index("Profiling")
+        except TclError:
+            self.help_menu.add_separator()
+            self.help_menu.add_checkbutton(label="Profiling",
+                                           variable=self.profiling_var,
+                                           command=self.toggle_profiling)
+
+    def toggle_profiling(self, *args):
+        if self.profiling_var.get():
+            self.profiler.start()
+            self.set_title("Profiling")
+        else:
+            filename = self.profiler.stop()
+            self.set_title()
+            MessageDialogue(self.master,
+                            "Profile written to: {0}".format(filename))
 
-        current_project = self.general_vars[0].get()
+    def register_handler(self, key, handler):
+        """Register a handler to be called when a field changes.
 
-        # Update project
-        if args[0] == str(self.general_vars[0]):
-            self.del_additional_documents()
-            try:
-                if self.config[current_project]["SubjectTypes"] is not None:
-                    self.general_widgets[1][1].set_completion_list(
-                        self.config[current_project]["SubjectTypes"])
-            except:
-                pass
+        Parameters
+        ----------
+        key : str
+            the name of the Tkinter variable or text widget of the field
+        handler : callable
+            the handler to call (without arguments)
+
+        """
+
+        self.handlers.setdefault(str(key), []).append(handler)
+
+    def unregister_handlers(self, key):
+        key = str(key)
+        self.handlers.pop(key, None)
+        try:
+            self.after_cancel(self.pending_text_changes.pop(key))
+        except KeyError:
+            pass
+
+    def mark_dirty(self):
+        if not self.dirty:
             try:
-                if self.config[current_project]["SessionTypes"] is not None:
-                    self.general_widgets[2][1].set_completion_list(
-                        self.config[current_project]["SessionTypes"])
-            except:
+                self.enable_save()
+            except AttributeError:  # save button not created yet
                 pass
+
+    def change_callback(self, *args):
+        """Dispatch a change of a field to its registered handlers."""
+
+        if self.callbacks_suspended:
+            return
+        self.mark_dirty()
+        for handler in self.handlers.get(args[0], ()):
+            handler()
+
+    def text_callback(self, key):
+        """Dispatch a change of a text widget, debounced while typing."""
+
+        if self.callbacks_suspended:
+            return
+        self.mark_dirty()
+        if key in self.handlers:
             try:
-                if self.config[current_project]["Users"] is not None:
-                    self.general_widgets[6].set_completion_list(
-                        self.config[current_project]["Users"])
-            except:
+                self.after_cancel(self.pending_text_changes[key])
+            except KeyError:
                 pass
+            self.pending_text_changes[key] = self.after(
+                self.text_debounce, lambda: self._flush_text_change(key))
+
+    def _flush_text_change(self, key):
+        self.pending_text_changes.pop(key, None)
+        self.change_callback(key)
+
+    def project_changed(self):
+        current_project = self.general_vars[0].get()
+        project = self.config.get(current_project)
+        error = getattr(self.config, "errors", {}).get(current_project)
+        if project is None and error is not None:
+            tkMessageBox.showerror(
+                "Config Error",
+                "Could not load the config of project {0}:\n\n{1}".format(
+                    current_project, error), parent=self.master)
+        self.del_additional_documents()
+        self.update_completions()
+        self.add_additional_documents()
+        self.add_files()
+
+        # Update notes
+        if project is not None:
             try:
-                if self.config[current_project]["Users"] is not None:
-                    self.general_widgets[7].set_completion_list(
-                        self.config[current_project]["Users"])
+                notes = project.notes
+                if notes is not None:
+                    self.general_widgets[-1].delete(1.0, END)
+                    self.general_widgets[-1].insert(END, notes)
             except:
                 pass
-            for index, m in enumerate(self.measurements_widgets):
-                try:
-                    t = self.measurements[index][1].get()
-                    m[3].set_completion_list(
-                        [x["Name"] for x in self.config[current_project]["Measurements " + t]])
-                except:
-                    pass
-            self.add_additional_documents()
-            self.add_files()
-
-            # Update notes
-            if current_project != "":
-                try:
-                    notes = self.config[current_project]["Notes"]
-                    if notes is not None:
-                        self.general_widgets[-1].delete(1.0, END)
-                        self.general_widgets[-1].insert(END, notes)
-                except:
-                    pass
-
+        self.update_archive()
+
+    def update_completions(self):
+        # Adapt completions according to Project
+        project = self.config.get(self.general_vars[0].get())
+        if project is not None:
+            self.general_widgets[1][1].set_completion_list(
+                project.subject_types)
+            self.general_widgets[2][1].set_completion_list(
+                project.session_types)
+            self.general_widgets[6].set_completion_list(project.users)
+            self.general_widgets[7].set_completion_list(project.users)
+        self.measurements_frame.refresh_rows()
+
+    def update_archive(self):
         # Check if archving is possible
         try:
-            if current_project != "" and \
-                            self.general_vars[0].get() != "" and \
+            if self.general_vars[0].get() != "" and \
                             self.general_vars[3].get()!= "":
                 self.enable_archive()
             else:
@@ -834,122 +976,117 @@ class ScanSessionTool(Frame):
         except:
             pass
 
+    def update_minus(self):
         # Check if deleting measurement is possible
         try:
             if len(self.measurements) > 1 and \
-                self.measurements[-1][2].get() == "" and \
-                self.measurements[-1][3].get() == "" and \
-                self.measurements_widgets[-1][5].get(
-                        1.0, END).strip("\n") == "" and \
-                self.measurements_widgets[-1][-1].get(
-                        1.0, END).strip("\n") == "":
+                    self.measurements[-1].is_empty():
                 self.enable_minus()
             else:
                 self.disable_minus()
         except:
             pass
 
+    def measurement_changed(self, idx):
+        if idx == len(self.measurements) - 1:
+            self.update_minus()
+
+    def type_changed(self, idx):
         # Adapt Measurement Names according to Type
-        types = [str(x[1]) for x in self.measurements]
-        try:
-            idx = types.index(args[0])
-        except:
-            idx = None
-        if idx is not None and current_project != "":
-            try:
-                t = self.measurements[idx][1].get()
-                self.measurements_widgets[idx][3].set_completion_list(
-                    [x["Name"] for x in self.config[current_project]["Measurements " + t]])
-            except:
-                pass
+        row = self.measurements_frame.get_row(idx)
+        if row is not None:
+            project = self.config.get(self.general_vars[0].get())
+            if project is not None:
+                t = self.measurements[idx].type
+                row.name.set_completion_list(project.get_completions(t))
+            else:
+                row.name.set_completion_list([])
+
+    def get_prt_file(self, measurement):
+        # The protocol file of a measurement (added to its logfiles)
+        if measurement.type == "anat" or measurement.name == "":
+            return ""
+        return "_".join(self.get_filename().split("_")[1:4]) + \
+            "_" + measurement.name + ".*"
 
+    def name_changed(self, idx):
         # Adapt Vols, Protocol and Comments according to Measurement Name
-        names = [str(x[3]) for x in self.measurements]
-        try:
-            idx = names.index(args[0])
-        except:
-            idx = None
-        if idx is not None and current_project != "":
+        current_project = self.general_vars[0].get()
+        project = self.config.get(current_project)
+        m = self.measurements[idx]
+        if current_project != "":
             try:
-                t = self.measurements[idx][1].get()
-                n = self.measurements[idx][3].get()
+                t = m.type
+                n = m.name
                 if n != "":
                     try:
-                        id = [name for name in self.config[current_project]["Measurements " + t] if name["Name"] == n]
+                        config = project.get_measurement(t, n)
                         try:
-                            vols = id[0]["Vols"]
+                            vols = config["Vols"]
                             if vols is not None:
-                                self.measurements[idx][2].set(vols)
+                                m.vols = str(vols)
                         except:
                             pass
                         try:
-                            comments = id[0]["Comments"]
+                            comments = config["Comments"]
                             if comments is not None:
-                                self.measurements_widgets[idx][-1].delete(1.0,
-                                                                          END)
-                                self.measurements_widgets[idx][-1].insert(
-                                    END, comments)
+                                m.comments = str(comments)
                         except:
                             pass
                     except:
                         pass
-                    if t != "anat":
-                        e = "*"
-
-                        prt = "_".join(self.get_filename().split("_")[1:4]) + \
-                            "_" + n + "." + e
-                        if prt != self.prt_files[idx]:
-                            if self.prt_files[idx] == "":
-                                start = 1.0
-                            elif self.prt_files[idx] != "":
-                                start = self.measurements[idx][4].search(
-                                    self.prt_files[idx], 1.0, stopindex=END)
-                                end = ".".join([start.split(".")[0],
-                                            repr(len(self.prt_files[idx]))])
-                                self.measurements[idx][4].delete(start, end)
-                            self.measurements[idx][4].insert(start, prt)
-                            self.prt_files[idx] = prt
+                    prt = self.get_prt_file(m)
+                    if prt != "" and prt != m.prt_file:
+                        if m.prt_file == "":
+                            m.logfiles = prt + m.logfiles
+                        else:
+                            start = m.logfiles.index(m.prt_file)
+                            m.logfiles = m.logfiles[:start] + prt + \
+                                m.logfiles[start+len(m.prt_file):]
+                        m.prt_file = prt
 
             except:
                 pass
+        self.measurements_frame.refresh_row(idx)
 
     def load_config(self):
         """Load the config file."""
 
-        path = None
-        if os.path.exists("sst.yaml"):
-            path = os.path.curdir
-        elif os.path.exists(os.path.join(os.path.expanduser("~"), "sst.yaml")):
-            path = os.path.expanduser("~")
-        else:
-            if os.path.isfile(os.path.join(os.path.split(__file__)[0], "sst.yaml")):
-                path = os.path.split(__file__)[0]
-        if path is not None:
-            with open(os.path.join(path, "sst.yaml")) as f:
-                self.config = yaml.safe_load(f)
+        self.config = load_config()
+        self.settings = self.config.settings
+        from .staging import Flusher
+        if self.flusher is None:
+            self.flusher = Flusher.from_config(self.settings)
+            if self.flusher is not None:
+                self.flusher.start()  # resumes sessions not flushed yet
+                self.update_staging()
+
+    def update_staging(self):
+        """Show the state of the flush queue (and keep it up to date)."""
+
+        if self.staging_label is None:
+            self.staging_label = Label(self.button_frame,
+                                       textvariable=self.staging_var,
+                                       style="Grey.TLabel")
+            self.staging_label['font'] = (self.default_font,
+                                          self.default_font_size - 2)
+            self.staging_label.grid(row=3, column=0, sticky="")
+            self.staging_label.bind("<Button-1>", self.show_flush_queue)
+        self.staging_var.set(self.flusher.status())
+        self.master.after(1000, self.update_staging)
+
+    def show_flush_queue(self, *args):
+        if self.flusher is not None:
+            tkMessageBox.showinfo("Flush Queue", self.flusher.details(),
+                                  parent=self.master)
+
+    def apply_config(self):
+        """Apply the loaded config to the form."""
+
+        self.general_widgets[0].set_completion_list(self.config.projects)
 
     def get_filename(self):
-        proj = self.general_vars[0].get()
-        if proj == "":
-            proj = "Project"
-        subj_nr = self.general_vars[1][0].get()
-        subj = "sub-" + repr(int(subj_nr)).zfill(3)
-        subj_type = self.general_vars[1][1].get()
-        if subj_type != "":
-            subj = "{0}-{1}".format(subj, subj_type)
-        ses_nr = self.general_vars[2][0].get()
-        ses = "ses-" + repr(int(ses_nr)).zfill(3)
-        ses_type = self.general_vars[2][1].get()
-        if ses_type != "":
-            ses = "{0}-{1}".format(ses, ses_type)
-        date = self.general_vars[3].get()
-        if date == "":
-            date = "Date"
-        else:
-            date = "".join(date.split("-"))
-        filename = "ScanProtocol_{0}_{1}_{2}_{3}".format(proj, subj, ses,
-                                                         date)
-        return filename
+        return self.get_protocol().get_filename()
 
     def save(self, filename=None, *args):
         """Save a protocol file."""
@@ -968,124 +1105,36 @@ class ScanSessionTool(Frame):
         if f is None:
             return
 
-        f.write("General Information\n")
-        f.write("===================\n")
-        f.write("\n")
-        for pos, label in enumerate(self.general):
-            if pos in (1,2):
-                try:
-                    value1 = self.general_vars[pos][0].get().zfill(3)
-                    value2 = " " + self.general_vars[pos][1].get()
-                    if pos == 1:
-                        value2 = value2.lstrip(" ")
-                except:
-                    value1 = "000"
-                    value2 = ""
-                f.write("{0}{1}{2}\n".format(label, " "*(24-len(label)),
-                                             value1 + value2))
-            else:
-                try:
-                    value = self.general_vars[pos].get()
-                except:
-                    value = ""
-                if value == "":
-                    f.write("{0}\n".format(label))
-                else:
-                    f.write("{0}{1}{2}\n".format(label, " "*(24-len(label)),
-                                                 value))
+        protocol = self.get_protocol()
+        f.write(protocol.format())
+        f.close()
+        if self.settings.get("ProtocolSidecar"):
+            protocol.write_json(os.path.splitext(f.name)[0] + ".json")
+        self.disable_save()
 
-        f.write("\nNotes:")
-        notes = self.general_widgets[-1].get(1.0, END)
-        if notes.strip() != "":
-            notes_lines = [x.strip() for x in notes.split("\n")]
-            try:
-                for line_nr, line in enumerate(notes_lines[:-1]):
-                    if line_nr == 0:
-                        f.write("{0}{1}".format(" "*(24-len("Notes:")), line))
-                    else:
-                        f.write("\n{0}{1}".format(" "*24, line))
-            except:
-                pass
-        f.write("\n")
-        f.write("\n")
-        f.write("\n")
-        f.write("Documents\n")
-        f.write("=========\n")
-
-        f.write("\nFiles:")
-        files = self.files.get(1.0, END).split("\n")
-        file_lines = [x.strip() for x in files if x != ""]
-        try:
-            for line_nr, line in enumerate(file_lines):
-                if line_nr == 0:
-                    f.write("{0}{1}".format(" "*(24-len("Files:")), line))
-                else:
-                    f.write("\n{0}{1}".format(" "*24, line))
-        except:
-            pass
+    def get_protocol(self):
+        """Get the scan protocol filled in in the form.
+
+        Returns
+        -------
+        protocol : ScanProtocol
+            the scan protocol
 
-        f.write("\n\nChecklist:")
-        states = ("[ ]", "[x]")
+        """
+
+        protocol = ScanProtocol()
+        protocol.general = [[x[0].get(), x[1].get()] if isinstance(x, list)
+                            else x.get() for x in self.general_vars]
+        protocol.notes = self.general_widgets[-1].get(1.0, "end-1c")
+        protocol.files = self.files.get(1.0, "end-1c")
         for pos, label in enumerate(self.documents):
             try:
                 value = int(self.documents_vars[pos].get())
             except:
                 value = 0
-            if pos == 0:
-                f.write("{0}{1} {2}".format(" "*(24-len("Checklist:")),
-                                            states[value], label))
-            else:
-                f.write("\n{0}{1} {2}".format(" "*24, states[value], label))
-
-        f.write("\n")
-        f.write("\n")
-        f.write("\n")
-        f.write("Measurements\n")
-        f.write("============")
-        f.write("\n")
-        for m in self.measurements:
-            f.write("\nNo. {0}\n".format(int(m[0].get())))
-            f.write("-----\n\n")
-            for elem in range(1, len(self.measurement)-1):
-                if elem == 4:
-                    try:
-                        logfiles = m[elem].get(1.0, END).split("\n")
-                        logfile_lines = [x.strip() for x in logfiles if x != ""]
-                        l = [" "*24 + x if index > 0 \
-                                 else x for index, x in enumerate(logfile_lines)]
-                        value = "\n".join(l)
-                    except:
-                        value = ""
-                else:
-                    try:
-                        value = m[elem].get()
-                    except:
-                        value = ""
-                if value == "":
-                    f.write("{0}:\n".format(self.measurement[elem]))
-                else:
-                    f.write("{0}:{1}{2}\n".format(
-                        self.measurement[elem],
-                        " "*(23-len(self.measurement[elem])),
-                        value))
-
-            f.write("\nComments:")
-
-            comments = m[-1].get(1.0, END)
-            if comments.strip("\n") != "":
-                comment_lines = [x.strip() for x in comments.split("\n")]
-                try:
-                    for line_nr, line in enumerate(comment_lines[:-1]):
-                        if line_nr == 0:
-                            f.write("{0}{1}".format(" "*(24-len("Comments:")),
-                                                    line))
-                        else:
-                            f.write("\n{0}{1}".format(" "*24, line))
-                except:
-                    pass
-            f.write("\n\n")
-        f.close()
-        self.disable_save()
+            protocol.documents.append([label, bool(value)])
+        protocol.measurements = self.measurements
+        return protocol
 
     def open(self, *args):
         """Open a protocol file."""
@@ -1095,135 +1144,66 @@ class ScanSessionTool(Frame):
         else:
             f = tkFileDialog.askopenfile("r", filetypes=[("text files", ".txt")])
         if f is not None:
-            current_document = 0
-            measurement = False
-            measurement_starts = []
-            notes_block = False
-            comments_block = False
-            files_block = False
-            if len(self.measurements) == 0:
-                self.new_measurement()
-            while len(self.measurements) > 1:
-                self.del_measurement()
-            for m in self.measurements:
-                m[-1].delete(1.0, END)
-            for linenr, line in enumerate(f):
-                if 3 <= linenr <= 10:
-                    if linenr in (4,5):
-                        self.general_vars[linenr-3][0].set((line[24:27]))
-                        self.general_vars[linenr-3][1].set(line[28:].strip())
-                    else:
-                        self.general_vars[linenr-3].set(line[24:].strip())
-                    if linenr == 3:
-                        self.del_additional_documents()
-                elif not measurement:
-                    if line.startswith("Notes:"):
-                        notes_block = True
-                        self.general_widgets[-1].delete(1.0, END)
-                    if line.startswith("Files:"):
-                        files_block = True
-                        self.files.delete(1.0, END)
-                    if line.startswith("Checklist:"):
-                        files_block = False
-                    if notes_block:
-                        if line.startswith("Documents"):
-                            notes_block = False
-                        else:
-                            if self.general_widgets[-1].get(
-                                1.0, END).strip("\n") == "":
-                                self.general_widgets[-1].insert(
-                                    END, line[24:].strip())
-                            elif line != "\n":
-                                self.general_widgets[-1].insert(
-                                    END, "\n" + line[24:].strip())
-                    elif files_block:
-                        if self.files.get(1.0, END).strip("\n") == "":
-                            self.files.insert(END, line[24:].strip())
-                        else:
-                            self.files.insert(END, "\n" + line[24:].strip())
-                    elif line.startswith("Measurements"):
-                        measurement = True
-                    else:
-                        try:
-                            check = line[25]
-                            if check == " ":
-                                value = 0
-                            elif check == "x":
-                                value = 1
-
-                            x = line[27:].strip()
-                            if line[24:].startswith("[") and not x in \
-                                    self.documents:
-                                var = IntVar()
-                                var.trace("w", self.change_callback)
-                                check = Checkbutton(self.documents_frame,
-                                                    text=x, variable=var)
-                                check.grid(sticky="W", padx=10)
-                                self.documents.append(x)
-                                self.documents_vars.append(var)
-                                self.additional_documents.append(x)
-                                self.additional_documents_vars.append(var)
-                                self.additional_documents_widgets.append(check)
-
-                            self.documents_vars[current_document].set(value)
-                            current_document += 1
-                        except:
-                            pass
-
-                elif measurement:
-                    if line.startswith("===") or line.strip() == "":
-                        pass
-                    elif line.startswith("No. "):
-                        if measurement_starts != []:
-                            self.new_measurement()
-                        self.measurements[len(measurement_starts)][0].set(
-                            line[4:].strip().zfill(3))
-                        measurement_starts.append(linenr)
-                        comments_block = False
-                    elif linenr >= measurement_starts[-1]+3:
-                        if line.startswith("Type:") or\
-                                line.startswith("Vols:") or\
-                                line.startswith("Name:"):
-                            self.measurements[
-                                len(measurement_starts)-
-                                1][linenr-measurement_starts[-1]-
-                                   2].set(line[24:].strip())
-                        elif line.startswith("Logfiles:"):
-                            widget = self.measurements[
-                                len(measurement_starts)-
-                                1][-2]
-                            widget.delete(1.0, END)
-                            widget.insert(END, line[24:].strip())
-                        elif line.startswith(" " * 24) and \
-                            comments_block == False:
-                            widget = self.measurements[
-                                len(measurement_starts)-
-                                1][-2]
-                            widget.insert(END, "\n" + line[24:].strip())
-                    if line.startswith("Comments:"):
-                        if comments_block is False:
-                            comments_block = True
-                            self.measurements[len(measurement_starts)-
-                                              1][-1].delete(1.0, END)
-
-                    if comments_block:
-                        if self.measurements[len(measurement_starts)-
-                                1][-1].get( 1.0, END).strip("\n") == "":
-                            self.measurements[len(measurement_starts)-
-                                              1][-1].insert(END,
-                                                            line[24:].strip())
-                        elif line != "\n":
-                            self.measurements[len(measurement_starts)-
-                                              1][-1].insert(
-                                                  END,
-                                                  "\n" + line[24:].strip())
-
-            self.disable_save()
+            self.load_protocol(ScanProtocol.parse(f))
         try:
             f.close()
         except:
             pass
 
+    def load_protocol(self, protocol):
+        """Load a scan protocol into the form.
+
+        All fields are filled in at once, with callbacks suspended, and
+        handlers run once at the end.
+
+        Parameters
+        ----------
+        protocol : ScanProtocol
+            the scan protocol to load
+
+        """
+
+        self.callbacks_suspended = True
+        self.grid_propagate(False)
+        try:
+            for key in list(self.pending_text_changes):
+                self.after_cancel(self.pending_text_changes.pop(key))
+            self.del_additional_documents()
+
+            for var, value in zip(self.general_vars, protocol.general):
+                if isinstance(var, list):
+                    var[0].set(value[0])
+                    var[1].set(value[1])
+                else:
+                    var.set(value)
+            self.general_widgets[-1].delete(1.0, END)
+            self.general_widgets[-1].insert(END, protocol.notes)
+            self.files.delete(1.0, END)
+            self.files.insert(END, protocol.files)
+
+            for position, (x, checked) in enumerate(protocol.documents):
+                if not x in self.documents:
+                    self.add_document(x)
+                try:
+                    self.documents_vars[position].set(int(checked))
+                except IndexError:
+                    pass
+
+            self.measurements = protocol.measurements or [Measurement()]
+            for m in self.measurements:
+                prt = self.get_prt_file(m)
+                m.prt_file = prt if prt != "" and prt in m.logfiles else ""
+            self.measurements_frame.set_count(len(self.measurements))
+            self.measurements_frame.refresh_rows()
+        finally:
+            self.grid_propagate(True)
+            self.callbacks_suspended = False
+
+        self.update_completions()
+        self.update_archive()
+        self.update_minus()
+        self.disable_save()
+
     def set_title(self, status=None):
         if status is None:
             self.master.title('Scan Session Tool')
@@ -1231,409 +1211,43 @@ class ScanSessionTool(Frame):
             self.master.title('Scan Session Tool ({0})'.format(status))
 
     def _archive_runs(self, archiving, dialogue):
+        from .archiving import SessionArchiver
+
         if self.run_actions is not None and "archive" in self.run_actions:
             run_as_action = True
         else:
             run_as_action = False
 
-        d, folder, bv_links, tbv_links, tbv_files, tbv_prefix = archiving
-        warnings = "\n\n\n"
-        project = self.general_vars[0].get()
-        subject_no = int(self.general_vars[1][0].get())
-        subject_type = self.general_vars[1][1].get()
-        session_no = int(self.general_vars[2][0].get())
-        session_type = self.general_vars[2][1].get()
-
-        project_folder = os.path.join(folder, project)
-        if subject_type == "":
-            subject_folder = os.path.join(project_folder,
-                                          "sub-" + repr(
-                                              subject_no).zfill(3))
-        else:
-            subject_folder = os.path.join(
-                project_folder, "sub-" + repr(
-                    subject_no).zfill(3) + "-" + subject_type)
-
-        if session_type == "":
-            session_folder = os.path.join(
-                subject_folder, "ses-" + repr(session_no).zfill(3))
-        else:
-            session_folder = os.path.join(
-                subject_folder,
-                "ses-" + repr(session_no).zfill(3) + "-" + session_type)
-
-        if os.path.exists(session_folder):
-            self.message = \
-                "Archiving failed: {0} already exists!".format(session_folder)
-            return
-        else:
-            try:
-                os.makedirs(session_folder)
-            except:
-                self.message = \
-                    "Archiving failed: Could not create target directory!"
-                return
-
-        dialogue.update(status=["Preparation", "Reading DICOM images..."])
-        if run_as_action:
-            while self.master.tk.dooneevent(_tkinter.DONT_WAIT):
-                pass
-
-        all_dicoms = []
-        for root, _, files in os.walk(d):
-            for f in files:
-                if os.path.splitext(f)[-1] in (".dcm", ".IMA"):
-                    all_dicoms.append(os.path.join(root, f))
-
-        pool = multiprocessing.Pool()
-        imap = pool.imap_unordered
-
-        scans = {}  # scans[RUN][VOLUME][ECHO]["protocolname"|"acquisition_nr"|"filename"]
-        for counter, dicom in enumerate(imap(readdicom, all_dicoms)):
-            percentage = int(
-                round((float(counter) + 1) / len(all_dicoms) * 100))
-            dialogue.update(
-                status=["Preparation",
-                        "Reading DICOM images...{0}%".format(percentage)])
+        def progress(status, flush):
+            dialogue.update(status=status)
             if run_as_action:
-                self.master.tk.dooneevent(_tkinter.DONT_WAIT)
-
-            try:
-                scans[dicom[1]]
-            except KeyError:
-                scans[dicom[1]] = {}
-
-            try:
-                scans[dicom[1]][dicom[3]]
-            except KeyError:
-                scans[dicom[1]][dicom[3]] = {}
-
-            scans[dicom[1]][dicom[3]][dicom[5]] = \
-                {"protocolname": dicom[4],
-                    "acquisition_nr": dicom[2],
-                    "filename": dicom[0]}
-        pool.close()
-
-        for meas_counter, measurement in enumerate(self.measurements):
-            number = int(measurement[0].get())
-            type = measurement[1].get()
-            try:
-                vols = int(measurement[2].get())
-            except:
-                vols = 0
-            name = measurement[3].get()
-
-            if name == "":
-                warnings += "\nError copying images for measurement {0}:\n" \
-                           "    'Name' not specified\n".format(number)
-            elif vols == 0:
-                warnings += "\nError copying images for measurement {0}:\n" \
-                           "    'Vols' not specified\n".format(number)
-            elif scans == {}:
-                warnings += "\nError copying images for measurement {0}:\n" \
-                            "    No images found\n".format(number)
-#            elif len(scans[number]) != vols:
-#                warnings += "\nError copying images for measurement {0}:" \
-#                            "    'Vols' unequals number of images\n".format(
-#                                number)
-            else:
-                try:
-                    type_folder = os.path.join(session_folder, type)
-                    if not os.path.exists(type_folder):
-                        os.makedirs(type_folder)
-                    name_folder = os.path.join(
-                        type_folder, repr(number).zfill(3) + "-" + name)
-                    if not os.path.exists(name_folder):
-                        os.makedirs(name_folder)
-                except:
-                    warnings += "\nError creating directory structure for " \
-                                "measurement {0}\n".format(number)
-                    shutil.rmtree(dicom_folder)
-
-                # DICOMs
-                dialogue.update(status=["Measurement {0} ({1} of {2})".format(
-                    number, meas_counter+1, len(self.measurements)),
-                                        "Copying DICOM files..."])
-                if run_as_action:
+                if flush:
                     while self.master.tk.dooneevent(_tkinter.DONT_WAIT):
                         pass
-
-                try:
-                    dicom_folder = os.path.join(name_folder, "DICOM")
-                    if not os.path.exists(dicom_folder):
-                        os.makedirs(dicom_folder)
-
-                    for counter, image in enumerate(scans[number]):
-                        for echo in scans[number][image]:
-                            percentage = int(round(
-                                (float(counter) + 1) / len(scans[number]) * 100))
-                            dialogue.update(
-                                status=["Measurement {0} ({1} of {2})".format(
-                                    number, meas_counter + 1,
-                                    len(self.measurements)),
-                                        "Copying DICOM files...{0}%".format(
-                                            percentage)])
-                            if run_as_action:
-                                self.master.tk.dooneevent(_tkinter.DONT_WAIT)
-
-                            shutil.copyfile(
-                                scans[number][image][echo]["filename"],
-                                os.path.join(dicom_folder, os.path.split(
-                                    scans[number][image][echo]["filename"])[-1]))
-                except:
-                    warnings += "\nError copying images for measurement " \
-                                "{0}:\n    Filesystem error\n".format(number)
-                    shutil.rmtree(dicom_folder)
-
-                # BV Files                       
-                if bv_links == True:
-                    dialogue.update(
-                        status=["Measurement {0} ({1} of {2})".format(
-                            number, meas_counter+1, len(self.measurements)),
-                                "Creating BrainVoyager links..."])
-                    if run_as_action:
-                        while self.master.tk.dooneevent(_tkinter.DONT_WAIT):
-                            pass
-
-                    try:
-                        bv_folder = os.path.join(session_folder, "BV")
-                        if not os.path.exists(bv_folder):
-                            os.makedirs(bv_folder)
-
-                        for counter, image in enumerate(scans[number]):
-                            for echo in scans[number][image]:
-                                percentage = int(round((float(counter) + 1) / len(
-                                    scans[number]) * 100))
-                                dialogue.update(
-                                    status=["Measurement {0} ({1} of {2})".format(
-                                        number, meas_counter + 1,
-                                        len(self.measurements)),
-                                            "Creating BrainVoyager links...{0}%".format(
-                                                percentage)])
-                                if run_as_action:
-                                    self.master.tk.dooneevent(_tkinter.DONT_WAIT)
-
-                                prefix = "{}_{:03d}{}".format(
-                                    "_".join(self.get_filename().split(
-                                        "_")[1:-1]).replace("-", ""),
-                                    number, name)
-                                if len(scans[number][image]) > 1:
-                                    prefix += "_{}".format(echo)
-                                target_name = "{}-{:04d}-{:04d}-{:05d}.dcm".format(
-                                    prefix, number,
-                                    scans[number][image][echo]["acquisition_nr"],
-                                    image)
-                                if tbv_files not in scans[number][image][echo]["filename"]:
-                                    os.link(os.path.join(
-                                        dicom_folder,
-                                        os.path.split(
-                                            scans[number][image][echo]["filename"])[-1]),
-                                            os.path.join(bv_folder, target_name))
-
-                    except:
-                        warnings += "\nError creating Brain Voyager links "
-
-            # Logfiles
-            if type != "anat":
-                dialogue.update(
-                    status=["Measurement {0} ({1} of {2})".format(
-                        number, meas_counter+1, len(self.measurements)),
-                        "Copying logfiles..."])
-                if run_as_action:
-                    while self.master.tk.dooneevent(_tkinter.DONT_WAIT):
-                        pass
-
-                try:
-                    warning = measurement[4].copy_logfiles(d, name_folder)
-                    if warning != None:
-                        warnings += warning
-
-                except:
-                    warnings += "\nError copying logfiles " \
-                        "for measurement {0}\n".format(number)
-
-        # TBV Files
-        if tbv_links == True:
-            dialogue.update(status=["Finalization",
-                                    "Copying Turbo-BrainVoyager files..."])
-            if run_as_action:
-                while self.master.tk.dooneevent(_tkinter.DONT_WAIT):
-                    pass
-
-            try:
-                tbv_folder = os.path.join(session_folder, "TBV")
-
-                tbv_file_list = []
-                for path, dirs, files in os.walk(os.path.abspath(
-                        os.path.join(d, tbv_files))):
-                    for name in files:
-                        tbv_file_list.append(os.path.join(path, name))
-
-                for counter, src in enumerate(tbv_file_list):
-                    rel_dst = os.path.relpath(src, (os.path.abspath(d)))
-                    dst = os.path.abspath(os.path.join(tbv_folder, rel_dst))
-
-                    if not os.path.exists(os.path.split(dst)[0]):
-                        os.makedirs(os.path.split(dst)[0])
-
-                    percentage = int(round(
-                            (float(counter) + 1) / len(tbv_file_list) * 100))
-                    dialogue.update(
-                        status=[
-                            "Finalization",
-                            "Copying Turbo-BrainVoyager files...{0}%".format(
-                                percentage)])
-                    if run_as_action:
-                        self.master.tk.dooneevent(_tkinter.DONT_WAIT)
-
-                    shutil.copyfile(src, dst)
-
-            except:
-                warnings += "\nError copying Turbo Brain Voyager files "
-
-            # Create dcm links
-            dialogue.update(status=["Finalization",
-                                    "Creating Turbo-BrainVoyager links..."])
-            if run_as_action:
-                while self.master.tk.dooneevent(_tkinter.DONT_WAIT):
-                    pass
-
-            try:
-                tbv_runs = []
-                files = glob.glob(os.path.join(tbv_folder, tbv_files, "*.tbv"))
-                tbvj = False
-                if files == []:
-                    files = glob.glob(os.path.join(tbv_folder, tbv_files,
-                                                   "*.tbvj"))
-                    tbvj = True
-
-                for filename in files:
-                    with open(filename) as f:
-                        if tbvj:
-                            data = json.loads(f.read())
-                            run_nr = int(
-                                data["DataFormatInfo"]["DicomFirstVolumeNr"])
-                            run_folder_name = data["Title"]
-                        else:
-                            for line in f.readlines():
-                                # if line.startswith("DicomFirstVolumeNr"):
-                                #     run_nr = int(line.split()[-1])
-                                if "DicomFirstVolumeNr" in line:
-                                    run_nr = int(line.split()[-1].strip(','))
-                                # if line.startswith("Title:"):
-                                #     run_folder_name = line.split()[-1].replace('"',
-                                #                                                '')
-                                if "Title" in line:
-                                    run_folder_name = line.split()[-1].strip(
-                                        ',').replace('"', '')
-
-                        tbv_runs.append([run_folder_name, run_nr])
-
-                tbv_runs.sort(key = lambda x: x[1])
-                session_func = os.path.join(session_folder, "func")
-
-                links = []
-                for run_nr, run in enumerate(tbv_runs):
-                    run_folder = glob.glob(os.path.join(
-                        session_func, '{:03d}-{}*'.format(run[1], tbv_prefix)))
-                    if run_folder != []:
-                        run_folder = run_folder[0]
-                        source_folder = os.path.abspath(os.path.join(
-                                        run_folder, "DICOM"))
-
-                        for volume, image in enumerate(sorted(os.listdir(
-                                source_folder))):
-                            target_name = "001_{:06d}_{:06d}.dcm".format(
-                                run[1], volume + 1)
-                            links.append(
-                                [os.path.join(source_folder, image),
-                                 os.path.join(tbv_folder, target_name)])
-
-                        # Change absolute path for prt file to relative path in fmr file
-                    try:
-                        if run[0] in os.listdir(os.path.join(tbv_folder,
-                                                             tbv_files)):
-                            fmr_file = os.path.abspath(
-                                os.path.join(tbv_folder, tbv_files, run[0],
-                                             "{}.fmr").format(
-                                                 run[0]))
-                            with open(fmr_file) as f:
-                                for line in f.readlines():
-                                    if line.startswith("ProtocolFile"):
-                                        prt_path = line.split()[-1]
-
-                            replace(fmr_file, prt_path,
-                                    '"./../{}.prt"'.format(run[0]))
-                    except:
-                        warnings += "\nError adjusting the protocol path in fmr file for Turbo Brain Voyager "
-
-                for counter, link in enumerate(links):
-                    percentage = int(round((float(counter)) / len(links) * 100))
-                    dialogue.update(
-                        status=["Finalization",
-                                "Creating Turbo-BrainVoyager links...{0}%".format(
-                                    percentage)])
-                    if run_as_action:
-                        self.master.tk.dooneevent(_tkinter.DONT_WAIT)
-
-                    os.link(link[0], link[1])
-
-            except:
-                warnings += "\nError creating dcm links for Turbo Brain Voyager "
-
-        # Session Files
-        dialogue.update(status=["Finalization", "Copying files..."])
-        if run_as_action:
-            while self.master.tk.dooneevent(_tkinter.DONT_WAIT):
-                pass
-
-        try:
-            warning = self.files.copy_logfiles(d, session_folder)
-            if warning != None:
-                warnings += warning
-        except:
-            warnings += "\nError copying Files "
-
-        # Try general documents
-        try:
-            all_documents = 0
-            total_logs = []
-
-            for measurement in self.measurements:
-                original = measurement[4].get(1.0, END)
-                logfiles = original.split("\n")
-                logfiles = [x.strip() for x in logfiles if x != ""]
-                total_logs.extend(logfiles)
-            for file in glob.glob(os.path.join(d, "*")):
-                if os.path.split(file)[-1] not in total_logs and \
-                    os.path.splitext(file)[-1] in (".txt",
-                                                   ".pdf",
-                                                   ".odt"
-                                                   ".doc",
-                                                   ".docx"):
-                    dialogue.update()
-                    if run_as_action:
-                        while self.master.tk.dooneevent(_tkinter.DONT_WAIT):
-                            pass
-
-                    all_documents += 1
-                    shutil.copy(os.path.abspath(file), session_folder)
-
-            if all_documents == 0:
-                warnings += "\nNo general documents found\n"
-        except:
-            warnings += "\nError copying general documents\n"
-
-        # Save scan protocol
-        try:
-            path = os.path.join(session_folder, self.get_filename() + ".txt")
-            self.save(path)
-        except:
-            warnings += "\nError saving scan protocol\n"
-
-        # Confirm archiving
-        self.message = "Archived to: {0}".format(os.path.abspath(folder))
-        self.message += warnings
+                else:
+                    self.master.tk.dooneevent(_tkinter.DONT_WAIT)
+
+        d, folder, bv_links, tbv_links, tbv_files, tbv_prefix = archiving[:6]
+        # Backups chosen in the dialogue (otherwise the configured mirrors)
+        mirrors = archiving[6] if len(archiving) > 6 and archiving[6] \
+            else None
+        throttle = archiving[7] if len(archiving) > 7 else None
+        protocol = self.get_protocol()
+        project = self.config.get(protocol.project)
+        archiver = SessionArchiver(
+            protocol, d, folder, bv_links, tbv_links, tbv_files, tbv_prefix,
+            settings=self.settings, progress=progress, profiler=self.profiler,
+            deidentification=None if project is None
+            else project.deidentification, mirrors=mirrors,
+            throttle=throttle)
+        self.message = archiver.run()
+        if self.flusher is not None:
+            self.flusher.wake()
+        if archiver.success:
+            if protocol.files != self.files.get(1.0, "end-1c"):
+                self.files.delete(1.0, END)
+                self.files.insert(1.0, protocol.files)
+            self.disable_save()
 
     def archive(self, *args):
         """Archive the data."""
@@ -1647,7 +1261,9 @@ class ScanSessionTool(Frame):
             archiving = dialogue.get()
             run_as_action = False
         if archiving[0]:
-            if os.path.isdir(archiving[1]) and os.path.isdir(archiving[2]):
+            from .exports import is_export
+            if (os.path.isdir(archiving[1]) or is_export(archiving[1])) \
+                    and os.path.isdir(archiving[2]):
                 self.set_title("Busy")
                 self.measurements_frame.unbind_mouse_wheel()
                 self.busy_dialogue = BusyDialogue(self)
@@ -1655,6 +1271,7 @@ class ScanSessionTool(Frame):
                 self.message = ""
                 if run_as_action:
                     self._archive_runs(archiving[1:], self.busy_dialogue)
+                    self.measurements_frame.refresh_rows()
                 else:
                     thread = threading.Thread(target=self._archive_runs,
                                               args=[archiving[1:],
@@ -1669,5 +1286,6 @@ class ScanSessionTool(Frame):
         else:
             self.busy_dialogue.destroy()
             self.set_title()
+            self.measurements_frame.refresh_rows()  # expanded logfiles
             MessageDialogue(self.master, self.message)
             self.measurements_frame.bind_mouse_wheel()
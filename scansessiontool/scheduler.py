@@ -0,0 +1,499 @@
+"""Scheduler.
+
+A device-aware scheduler for the file operations of the archiving procedure.
+Every operation (copying or linking a file) occupies a slot on the device
+(`st_dev`) of its source and on the device of its target, and each device
+only has a limited number of slots. This way, many operations can be in
+flight on fast or networked storage, while a spinning disk only serves one
+(or a few) at a time.
+
+The number of slots per device can be configured in the "Settings" section of
+the config file, or is tuned automatically during archiving (by increasing
+it as long as the throughput on the device increases), e.g.:
+
+    Settings:
+        IO:
+            Default:         auto
+            MaxConcurrency:  32
+            Order:           locality
+            Devices:
+                /mnt/archive:  16
+                /data/scanner: 1
+
+"Devices" maps a path on a device to the number of slots of that device
+(or "auto"); all other devices get "Default" slots (default: "auto").
+
+"Order" is the order in which the files of a measurement are copied (see
+`ORDERS`, default: "inode"). Reading files in the order they are laid out on
+disk avoids seeking on spinning disks and tape-backed (HSM) storage.
+
+All operations are additionally subject to the bandwidth limits configured
+in "Throttle" (see `throttling`), their targets are synced to disk as
+configured in "Durability" (see `durability`), and they are retried if they
+fail transiently, as configured in "Retries" (see `retrying`).
+
+"""
+
+
+import os
+import sys
+import time
+import struct
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .throttling import Throttle
+from .durability import Durability
+from .retrying import RetryPolicy
+
+
+AUTO = "auto"
+
+# Copy orders: as given (i.e. the order the headers were read in), by file
+# name, by inode number, or by physical position on disk (if the file system
+# supports FIEMAP; by inode number otherwise)
+ORDERS = ("given", "name", "inode", "locality")
+
+_FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_FLAG_SYNC = 0x1
+_FIEMAP = struct.Struct("=QQLLLL")
+_FIEMAP_EXTENT = struct.Struct("=QQQQQLLLL")
+
+
+def get_physical_offset(filename):
+    """Get the physical position of the first extent of a file on disk.
+
+    This uses the FIEMAP ioctl, which is only available on Linux (and not
+    supported by all file systems).
+
+    Parameters
+    ----------
+    filename : str
+        the file
+
+    Returns
+    -------
+    offset : int or None
+        the physical offset in bytes (None if unknown)
+
+    """
+
+    if not sys.platform.startswith("linux"):
+        return None
+    import fcntl
+
+    request = bytearray(_FIEMAP.size + _FIEMAP_EXTENT.size)
+    _FIEMAP.pack_into(request, 0, 0, 0xFFFFFFFFFFFFFFFF, _FIEMAP_FLAG_SYNC,
+                      0, 1, 0)
+    try:
+        with open(filename, 'rb') as f:
+            fcntl.ioctl(f.fileno(), _FS_IOC_FIEMAP, request)
+    except OSError:
+        return None
+    if _FIEMAP.unpack_from(request)[3] == 0:  # no mapped extents
+        return None
+    return _FIEMAP_EXTENT.unpack_from(request, _FIEMAP.size)[1]
+
+
+def order_operations(operations, order):
+    """Order file operations by their source files.
+
+    Parameters
+    ----------
+    operations : list of tuple
+        the operations, starting with their source file
+    order : str
+        the order (see `ORDERS`)
+
+    Returns
+    -------
+    operations : list of tuple
+        the ordered operations
+
+    """
+
+    if order == "given" or len(operations) < 2:
+        return list(operations)
+    if order == "name":
+        return sorted(operations, key=lambda x: x[0])
+
+    def inode(operation):
+        try:
+            stat = os.stat(operation[0])
+            return (stat.st_dev, stat.st_ino)
+        except OSError:
+            return (0, 0)
+
+    if order == "locality":
+        offsets = []
+        for operation in operations:
+            offset = get_physical_offset(operation[0])
+            if offset is None:  # not supported: fall back to inodes
+                break
+            offsets.append(offset)
+        else:
+            return [x for _, x in sorted(zip(offsets, operations),
+                                         key=lambda x: x[0])]
+    return sorted(operations, key=inode)
+
+
+class DeviceLimiter:
+    """Limit the number of concurrent operations on a single device.
+
+    Parameters
+    ----------
+    device : int
+        the device (`st_dev`)
+    limit : int or "auto"
+        the number of concurrent operations, or "auto" to tune it
+        automatically
+    max_limit : int, optional
+        the maximal number of concurrent operations when tuning
+        automatically (default=32)
+    window : float, optional
+        the duration in seconds of a measurement window when tuning
+        automatically (default=0.5)
+
+    """
+
+    def __init__(self, device, limit, max_limit=32, window=0.5):
+        self.device = device
+        self.auto = limit == AUTO
+        self.limit = min(2, max_limit) if self.auto else max(1, int(limit))
+        self.max_limit = max(self.limit, max_limit)
+        self.window = window
+        self.active = 0
+        self.ops = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self._condition = threading.Condition()
+        self._best = None  # (throughput, limit)
+        self._settled = False
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.perf_counter()
+        self._window_ops = 0
+        self._window_bytes = 0
+
+    def acquire(self):
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait()
+            self.active += 1
+
+    def release(self, nbytes=0, seconds=0.0):
+        with self._condition:
+            self.active -= 1
+            self.ops += 1
+            self.bytes += nbytes
+            self.seconds += seconds
+            self._window_ops += 1
+            self._window_bytes += nbytes
+            if self.auto:
+                self._tune()
+            self._condition.notify_all()
+
+    def _tune(self):
+        elapsed = time.perf_counter() - self._window_start
+        if elapsed < self.window or self._window_ops < 2 * self.limit:
+            return
+        # Bytes per second, or operations per second (for links)
+        if self._window_bytes > 0:
+            throughput = self._window_bytes / elapsed
+        else:
+            throughput = self._window_ops / elapsed
+        self._reset_window()
+
+        if self._best is None or throughput > self._best[0] * 1.1:
+            # Still improving: keep probing upwards
+            self._best = (throughput, self.limit)
+            if not self._settled and self.limit < self.max_limit:
+                self.limit = min(self.limit * 2, self.max_limit)
+        elif not self._settled:
+            # No improvement: go back to the best limit
+            self.limit = self._best[1]
+            self._settled = True
+        elif throughput < self._best[0] * 0.5:
+            # Conditions changed (e.g. other load): start over
+            self._best = (throughput, self.limit)
+            self._settled = False
+
+    def stats(self):
+        return {"limit": self.limit, "auto": self.auto, "operations": self.ops,
+                "bytes": self.bytes, "seconds": self.seconds}
+
+
+class IOScheduler:
+    """Run file operations concurrently, limited per device.
+
+    Parameters
+    ----------
+    limits : dict, optional
+        the number of concurrent operations (or "auto") per device, given as
+        a path on that device (default=None)
+    default : int or "auto", optional
+        the number of concurrent operations of all other devices
+        (default="auto")
+    max_limit : int, optional
+        the maximal number of concurrent operations overall (default=32)
+    order : str, optional
+        the order to copy files in (see `ORDERS`) (default="inode")
+    throttle : Throttle, optional
+        the bandwidth limits of all operations (default=None, meaning no
+        limits)
+    durability : Durability, optional
+        how the targets of all operations are synced to disk (default=None,
+        meaning not at all)
+    retry : RetryPolicy, optional
+        how operations that failed transiently are retried (default=None,
+        meaning not at all)
+
+    Attributes
+    ----------
+    retries : int
+        the number of operations retried
+
+    """
+
+    def __init__(self, limits=None, default=AUTO, max_limit=32,
+                 order="inode", throttle=None, durability=None, retry=None):
+        if order not in ORDERS:
+            raise ValueError("Unknown order: {0}".format(order))
+        self.default = default
+        self.max_limit = max(1, max_limit)
+        self.order = order
+        self.throttle = throttle
+        self.durability = durability
+        self.retry = retry
+        self.retries = 0
+        self.devices = {}
+        self._lock = threading.Lock()
+        self._folders = {}
+        self._executor = ThreadPoolExecutor(self.max_limit)
+        for path, limit in (limits or {}).items():
+            try:
+                device = os.stat(os.path.expanduser(path)).st_dev
+            except OSError:
+                continue
+            self.devices[device] = DeviceLimiter(device, limit,
+                                                 self.max_limit)
+
+    @classmethod
+    def from_config(cls, settings):
+        """Create a scheduler from the "IO" (and "Throttle", "Durability"
+        and "Retries") section of the settings.
+
+        Parameters
+        ----------
+        settings : dict
+            the site-wide settings
+
+        Returns
+        -------
+        scheduler : IOScheduler
+            the scheduler
+
+        """
+
+        config = (settings or {}).get("IO") or {}
+        return cls(config.get("Devices"), config.get("Default", AUTO),
+                   config.get("MaxConcurrency", 32),
+                   config.get("Order", "inode"),
+                   Throttle.from_config(settings),
+                   Durability.from_config(settings),
+                   RetryPolicy.from_config(settings))
+
+    def get_limiter(self, path):
+        """Get the limiter of the device a file is (to be) stored on."""
+
+        folder = os.path.dirname(os.path.abspath(path))
+        with self._lock:
+            device = self._folders.get(folder)
+            if device is None:
+                # Files in a scanner export (see `exports`) are on the
+                # device of the export
+                existing = folder
+                while not os.path.isdir(existing) and \
+                        os.path.dirname(existing) != existing:
+                    existing = os.path.dirname(existing)
+                device = os.stat(existing).st_dev
+                self._folders[folder] = device
+            limiter = self.devices.get(device)
+            if limiter is None:
+                limiter = DeviceLimiter(device, self.default, self.max_limit)
+                self.devices[device] = limiter
+        return limiter
+
+    def call(self, func, source, target, *args):
+        """Call a file operation, as soon as both devices are available.
+
+        If the operation fails transiently, it is retried (see `retrying`);
+        the devices are available to other operations in the meantime.
+
+        Parameters
+        ----------
+        func : callable
+            the operation, called with source, target and args; if it
+            returns a tuple starting with an integer, that is taken as the
+            number of bytes processed
+        source : str
+            the source file
+        target : str
+            the target file
+
+        Returns
+        -------
+        result : object
+            the return value of the operation
+
+        """
+
+        if self.retry is None:
+            return self._call(func, source, target, *args)
+        return self.retry.call(self._call, func, source, target, *args,
+                               on_retry=self._on_retry)
+
+    def _on_retry(self, error, delay):
+        with self._lock:
+            self.retries += 1
+
+    def _call(self, func, source, target, *args):
+        limiters = {x.device: x for x in (self.get_limiter(source),
+                                          self.get_limiter(target))}
+        limiters = [limiters[x] for x in sorted(limiters)]
+        reserved = 0
+        if self.throttle is not None:
+            try:
+                expected = os.path.getsize(source)
+            except OSError:
+                expected = 0  # e.g. in a scanner export
+            reserved = self.throttle.acquire(expected)
+        for limiter in limiters:
+            limiter.acquire()
+        nbytes = 0
+        start = time.perf_counter()
+        try:
+            result = func(source, target, *args)
+            if isinstance(result, tuple) and result and \
+                    isinstance(result[0], int):
+                nbytes = result[0]
+            if self.durability is not None:
+                self.durability.written(target)
+            return result
+        finally:
+            seconds = time.perf_counter() - start
+            for limiter in reversed(limiters):
+                limiter.release(nbytes, seconds)
+            if self.throttle is not None:
+                self.throttle.release(nbytes, reserved)
+
+    def sort(self, operations):
+        """Sort file operations in the configured order (see `ORDERS`).
+
+        Parameters
+        ----------
+        operations : list of tuple
+            the operations, starting with their source file
+
+        Returns
+        -------
+        operations : list of tuple
+            the sorted operations
+
+        """
+
+        return order_operations(operations, self.order)
+
+    def submit(self, func, source, target, *args):
+        """Schedule a file operation (see `call`).
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            the future of the result of the operation
+
+        """
+
+        return self._executor.submit(self.call, func, source, target, *args)
+
+    def map(self, func, operations):
+        """Schedule several file operations and yield their results.
+
+        Parameters
+        ----------
+        func : callable
+            the operation (see `call`)
+        operations : list of tuple
+            the source and target of each operation (further items are only
+            passed back with the result)
+
+        Yields
+        ------
+        operation : tuple
+            the operation
+        result : object
+            its result
+        error : Exception
+            the error raised by the operation (None on success)
+
+        Notes
+        -----
+        The operations are handed to the workers in the given order (e.g.
+        sorted, see `sort`), each as soon as fewer operations on its source
+        device are in flight than the device can run at once, so that they
+        are also started (about) in that order.
+
+        """
+
+        from concurrent.futures import wait, FIRST_COMPLETED
+
+        pending = deque(operations)
+        futures = {}
+        in_flight = {}
+
+        def dispatch():
+            while pending:
+                limiter = self.get_limiter(pending[0][0])
+                if in_flight.get(limiter.device, 0) >= limiter.limit:
+                    break
+                operation = pending.popleft()
+                future = self.submit(func, operation[0], operation[1])
+                futures[future] = (operation, limiter.device)
+                in_flight[limiter.device] = \
+                    in_flight.get(limiter.device, 0) + 1
+
+        try:
+            dispatch()
+            while futures:
+                done = wait(futures, return_when=FIRST_COMPLETED)[0]
+                for future in done:
+                    operation, device = futures.pop(future)
+                    in_flight[device] -= 1
+                    dispatch()
+                    try:
+                        yield operation, future.result(), None
+                    except Exception as e:
+                        yield operation, None, e
+        finally:
+            # On early exit, wait for running operations to finish
+            for future in futures:
+                future.cancel()
+            wait(futures)
+
+    def stats(self):
+        """Get the limits and totals per device.
+
+        Returns
+        -------
+        stats : dict
+            "limit", "auto", "operations", "bytes" and "seconds" per device
+
+        """
+
+        return {str(device): limiter.stats()
+                for device, limiter in self.devices.items()}
+
+    def shutdown(self):
+        self._executor.shutdown()
@@ -0,0 +1,562 @@
+"""Staging.
+
+Two-tier archiving: sessions are archived at full speed into a local spool
+(e.g. on an SSD) first, in the same layout as in the archive, and are then
+flushed to the (slow, e.g. network) archive in the background, so that the
+operator does not have to wait for the archive. Staging is enabled in the
+"Settings" section of the config file:
+
+    Settings:
+        Staging:
+            Spool:  /ssd/spool
+            Retry:  300
+
+Every file is copied from the spool to the archive (into a hidden folder,
+published once complete, see `publishing`), read back and its SHA-256 hash
+compared to the spool copy; only a completely verified session
+that was synced to disk (in any "Durability" mode but "none", see
+`durability`) is removed from the spool, and only then recorded in the
+archive catalog (see `catalog`). Flushing a session that failed is
+retried after "Retry" seconds (default: 300).
+
+The flush queue is kept in the spool (one JSON file per session, in the
+folder `QUEUE_FOLDER`), so that it survives restarts: sessions that were not
+(completely) flushed are flushed when the Scan Session Tool is started next,
+or with `scansessiontool-flush`. Each session is locked while it is flushed,
+so that several processes (e.g. the Scan Session Tool and
+`scansessiontool-flush`) can flush the same queue. The copy and link
+operations are subject to the "IO" and "Throttle" settings (see `scheduler`
+and `throttling`).
+
+"""
+
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import warnings
+import threading
+
+from .scheduler import IOScheduler
+from .utilities import copy_file, hash_file
+from .publishing import create_work_folder, publish, move_to_trash
+
+
+QUEUE_FOLDER = ".queue"
+DEFAULT_RETRY = 300  # s
+
+# States of a session in the queue
+PENDING = "pending"
+FLUSHING = "flushing"
+FAILED = "failed"
+
+
+def get_spool(settings):
+    """Get the spool configured in the settings.
+
+    Parameters
+    ----------
+    settings : dict
+        the site-wide settings
+
+    Returns
+    -------
+    spool : str
+        the spool folder (None if staging is disabled)
+
+    """
+
+    config = (settings or {}).get("Staging") or {}
+    if not config.get("Spool"):
+        return None
+    return os.path.abspath(os.path.expanduser(str(config["Spool"])))
+
+
+class FlushQueue:
+    """The queue of sessions to flush from the spool to the archive.
+
+    Parameters
+    ----------
+    spool : str
+        the spool folder
+
+    """
+
+    def __init__(self, spool):
+        self.spool = spool
+        self.folder = os.path.join(spool, QUEUE_FOLDER)
+
+    def put(self, staged, target, root=None, catalog=None):
+        """Queue a session (archived completely into the spool).
+
+        Parameters
+        ----------
+        staged : str
+            the session folder in the spool
+        target : str
+            the session folder in the archive
+        root : str, optional
+            the root folder of the archive (default=None, meaning the
+            parent folder of `target`)
+        catalog : dict, optional
+            the update of the archive catalog to apply once the session is
+            flushed (see `catalog.apply_update`) (default=None)
+
+        Returns
+        -------
+        job : dict
+            the queued session ("id", "staged", "target", "root", "queued",
+            "state", "error", "attempts" and "catalog", whether there is a
+            catalog update)
+
+        """
+
+        if root is None:
+            root = os.path.dirname(target)
+
+        os.makedirs(self.folder, exist_ok=True)
+        # Reserve the id (also against other processes sharing the spool);
+        # the empty job file is skipped until the job is saved
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        number = 0
+        while True:
+            job_id = "{0}-{1}".format(timestamp, number)
+            try:
+                os.close(os.open(os.path.join(self.folder, job_id + ".json"),
+                                 os.O_WRONLY | os.O_CREAT | os.O_EXCL))
+                break
+            except FileExistsError:
+                number += 1
+        job = {"id": job_id,
+               "staged": os.path.abspath(staged),
+               "target": os.path.abspath(target),
+               "root": os.path.abspath(root),
+               "queued": time.time(), "state": PENDING, "error": None,
+               "attempts": 0, "catalog": catalog is not None}
+        if catalog is not None:
+            # Apart from the job (which is read whenever the queue is
+            # listed)
+            filename = os.path.join(self.folder, job_id + ".catalog")
+            with open(filename, 'w') as f:
+                json.dump(catalog, f)
+        self.save(job)
+        return job
+
+    def save(self, job):
+        """Save the state of a queued session."""
+
+        filename = os.path.join(self.folder, job["id"] + ".json")
+        tmp = "{0}.{1}-{2}.tmp".format(filename, os.getpid(),
+                                       threading.get_ident())
+        with open(tmp, 'w') as f:
+            json.dump(job, f, indent=4)
+        os.replace(tmp, filename)
+
+    def load(self, job_id):
+        """Load the current state of a queued session.
+
+        Returns
+        -------
+        job : dict
+            the queued session (None if it is no longer queued)
+
+        """
+
+        try:
+            with open(os.path.join(self.folder, job_id + ".json")) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def lock(self, job):
+        """Lock a queued session exclusively (across processes), without
+        waiting.
+
+        The lock is released by `unlock`, or when the process exits.
+
+        Returns
+        -------
+        lock : int
+            the lock (None if the session is locked already, e.g. while
+            another process flushes it)
+
+        """
+
+        fd = os.open(os.path.join(self.folder, job["id"] + ".lock"),
+                     os.O_RDWR | os.O_CREAT)
+        try:
+            if sys.platform == "win32":
+                import msvcrt
+                msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return None
+        return fd
+
+    def unlock(self, job, lock):
+        """Release the lock of a queued session (see `lock`)."""
+
+        os.close(lock)
+        if not os.path.exists(os.path.join(self.folder, job["id"] + ".json")):
+            try:
+                os.remove(os.path.join(self.folder, job["id"] + ".lock"))
+            except OSError:
+                pass  # locked by another process meanwhile
+
+    def remove(self, job):
+        """Remove a (flushed) session from the queue."""
+
+        os.remove(os.path.join(self.folder, job["id"] + ".json"))
+        if job.get("catalog"):
+            try:
+                os.remove(os.path.join(self.folder, job["id"] + ".catalog"))
+            except FileNotFoundError:
+                pass
+
+    def get_catalog(self, job):
+        """Get the update of the archive catalog of a queued session.
+
+        Returns
+        -------
+        catalog : dict
+            the update of the archive catalog (None if there is none)
+
+        """
+
+        if not job.get("catalog"):
+            return None
+        with open(os.path.join(self.folder, job["id"] + ".catalog")) as f:
+            return json.load(f)
+
+    def jobs(self):
+        """Get all queued sessions, in the order they were queued."""
+
+        if not os.path.isdir(self.folder):
+            return []
+        jobs = []
+        for name in sorted(os.listdir(self.folder)):
+            if name.endswith(".json"):
+                try:
+                    with open(os.path.join(self.folder, name)) as f:
+                        jobs.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return jobs
+
+    def get_targets(self):
+        """Get the session folders in the archive of all queued sessions."""
+
+        return [x["target"] for x in self.jobs()]
+
+
+class Flusher:
+    """Flush the sessions in the spool to the archive (in a thread).
+
+    Parameters
+    ----------
+    spool : str
+        the spool folder
+    settings : dict, optional
+        the site-wide settings (default=None)
+
+    Attributes
+    ----------
+    queue : FlushQueue
+        the flush queue
+    current : dict
+        the session being flushed (None if idle)
+    progress : (int, int)
+        the number of files of the current session flushed and in total
+
+    """
+
+    def __init__(self, spool, settings=None):
+        self.spool = spool
+        self.settings = settings or {}
+        config = self.settings.get("Staging") or {}
+        self.retry = float(config.get("Retry", DEFAULT_RETRY))
+        self.queue = FlushQueue(spool)
+        self.current = None
+        self.progress = (0, 0)
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._woken = False
+        self._thread = None
+
+    @classmethod
+    def from_config(cls, settings):
+        """Create a flusher with the "Staging" section of the settings.
+
+        Returns
+        -------
+        flusher : Flusher
+            the flusher (None if staging is disabled)
+
+        """
+
+        spool = get_spool(settings)
+        if spool is None:
+            return None
+        return cls(spool, settings)
+
+    def start(self):
+        """Start flushing in the background."""
+
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def wake(self):
+        """Flush newly queued sessions right away."""
+
+        with self._condition:
+            self._woken = True
+            self._condition.notify_all()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                self._woken = False
+            flushed = self.flush_all()
+            with self._condition:
+                if self._stopped:
+                    return
+                if not flushed and not self._woken:
+                    self._condition.wait(
+                        self.retry if self.queue.jobs() else None)
+
+    def flush_all(self, retry_failed=False):
+        """Flush all sessions that are due.
+
+        Parameters
+        ----------
+        retry_failed : bool, optional
+            whether to retry failed sessions right away (default=False)
+
+        Returns
+        -------
+        flushed : int
+            the number of sessions flushed successfully
+
+        """
+
+        flushed = 0
+        for job in self.queue.jobs():
+            if self._stopped:
+                break
+            if job["state"] == FAILED and not retry_failed and \
+                    time.time() - job.get("failed", 0) < self.retry:
+                continue
+            if self.flush(job):
+                flushed += 1
+        return flushed
+
+    def flush(self, job):
+        """Flush a single session to the archive.
+
+        Parameters
+        ----------
+        job : dict
+            the queued session (see `FlushQueue.put`)
+
+        Returns
+        -------
+        success : bool
+            whether the session was flushed and verified (and removed from
+            the spool); False if another process is flushing it
+
+        """
+
+        lock = self.queue.lock(job)
+        if lock is None:
+            return False
+        try:
+            # As changed (or flushed) by other processes meanwhile
+            current = self.queue.load(job["id"])
+            return current is not None and self._flush(current)
+        finally:
+            self.queue.unlock(job, lock)
+
+    def _flush(self, job):
+        staged, target = job["staged"], job["target"]
+        root = job.get("root") or os.path.dirname(target)
+        self.current = job
+        self.progress = (0, 0)
+        try:
+            if os.path.exists(target):
+                raise IOError("{0} already exists!".format(target))
+            if job.get("partial") and os.path.exists(job["partial"]):
+                # Interrupted (e.g. by a restart; the lock would still be
+                # held otherwise) or failed: start over
+                move_to_trash(job["partial"], root)
+            job["state"] = FLUSHING
+            job["partial"] = create_work_folder(root, target)
+            job["attempts"] += 1
+            self.queue.save(job)
+            self._copy(staged, job["partial"], target, root)
+        except Exception as e:
+            if job.get("partial") and os.path.exists(job["partial"]):
+                try:
+                    move_to_trash(job["partial"], root)
+                except OSError:
+                    pass  # moved when retrying
+            job["state"] = FAILED
+            job["error"] = str(e)
+            job["failed"] = time.time()
+            self.queue.save(job)
+            return False
+        finally:
+            self.current = None
+
+        # Verified: record in the catalog, and remove from the spool
+        self._update_catalog(job)
+        shutil.rmtree(staged, ignore_errors=True)
+        folder = os.path.dirname(staged)
+        while folder != self.spool and folder.startswith(self.spool) and \
+                os.path.isdir(folder) and not os.listdir(folder):
+            os.rmdir(folder)
+            folder = os.path.dirname(folder)
+        self.queue.remove(job)
+        return True
+
+    def _copy(self, staged, folder, target, root):
+        """Copy a session into a hidden folder (see `publishing`), and
+        publish it once complete and verified."""
+
+        folders = []
+        files = []
+        for path, dirs, names in os.walk(staged):
+            folders.extend(os.path.join(path, x) for x in dirs)
+            files.extend(os.path.join(path, x) for x in names)
+        if not files and not folders and not os.path.isdir(staged):
+            raise IOError("{0} does not exist!".format(staged))
+        for path in folders:
+            os.makedirs(os.path.join(folder, os.path.relpath(path, staged)),
+                        exist_ok=True)
+
+        # Hard links (e.g. BrainVoyager links) are recreated as such
+        copies = []
+        links = []
+        inodes = {}
+        for filename in files:
+            stat = os.stat(filename)
+            destination = os.path.join(folder,
+                                       os.path.relpath(filename, staged))
+            key = (stat.st_dev, stat.st_ino)
+            if stat.st_nlink > 1 and key in inodes:
+                links.append((inodes[key], destination))
+            else:
+                inodes[key] = destination
+                copies.append((filename, destination))
+        self.progress = (0, len(files))
+
+        scheduler = IOScheduler.from_config(self.settings)
+        try:
+            for operation, result, error in scheduler.map(
+                    _copy_verified, scheduler.sort(copies)):
+                if error is not None:
+                    raise error
+                self.progress = (self.progress[0] + 1, self.progress[1])
+        finally:
+            scheduler.shutdown()
+        for source, destination in links:
+            os.link(source, destination)
+            self.progress = (self.progress[0] + 1, self.progress[1])
+
+        # On disk before the spool copy is removed
+        scheduler.durability.finish(folder, root)
+        publish(folder, target)
+        scheduler.durability.sync_parents(target, root)
+
+    def _update_catalog(self, job):
+        from .catalog import apply_update
+
+        try:
+            catalog = self.queue.get_catalog(job)
+            if catalog is not None:
+                apply_update(catalog)
+        except Exception as e:
+            # The session is in the archive anyway
+            warnings.warn("Error updating archive catalog for {0}: "
+                          "{1}".format(job["target"], e))
+
+    def status(self):
+        """Get the state of the flush queue, as short text (empty if the
+        queue is empty)."""
+
+        jobs = self.queue.jobs()
+        if not jobs:
+            return ""
+        failed = len([x for x in jobs if x["state"] == FAILED])
+        parts = []
+        if self.current is not None:
+            done, total = self.progress
+            parts.append("Flushing{0}".format(
+                " {0}%".format(100 * done // total) if total else "..."))
+        queued = len(jobs) - failed - (self.current is not None)
+        if queued > 0:
+            parts.append("{0} queued".format(queued))
+        if failed:
+            parts.append("{0} failed".format(failed))
+        return ", ".join(parts)
+
+    def details(self):
+        """Get the state of all queued sessions, as text."""
+
+        lines = []
+        for job in self.queue.jobs():
+            line = "{0} -> {1}: {2}".format(job["staged"], job["target"],
+                                            job["state"])
+            if job["state"] == FAILED:
+                line += " ({0})".format(job["error"])
+            lines.append(line)
+        return "\n".join(lines) or "No sessions to flush"
+
+
+def _copy_verified(source, target):
+    """Copy a file and verify the copy (by reading it back)."""
+
+    size, sha256 = copy_file(source, target)
+    shutil.copystat(source, target)
+    if hash_file(target) != (size, sha256):
+        raise IOError("Verification failed: {0}".format(target))
+    return size, sha256
+
+
+def main(argv=None):
+    from .config import load_config
+
+    parser = argparse.ArgumentParser(
+        prog="scansessiontool-flush",
+        description="Flush the sessions staged in the spool to the archive")
+    parser.add_argument("--config", metavar="PATH",
+                        help="the config file or directory (for the site-wide "
+                             "settings)")
+    parser.add_argument("--status", action="store_true",
+                        help="only show the flush queue")
+    args = parser.parse_args(argv)
+
+    settings = load_config(args.config).settings
+    flusher = Flusher.from_config(settings)
+    if flusher is None:
+        sys.exit("Staging is not configured")
+    if not args.status:
+        flusher.flush_all(retry_failed=True)
+    print(flusher.details())
+    if any(x["state"] == FAILED for x in flusher.queue.jobs()):
+        sys.exit(1)
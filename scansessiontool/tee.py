@@ -0,0 +1,432 @@
+"""Tee.
+
+Archiving a session to several targets at once: the primary archive and any
+number of mirrors (e.g. a backup on another storage system), configured in
+the "Settings" section of the config file, or given when archiving:
+
+    Settings:
+        Mirrors:
+            Targets:
+                - /mnt/backup
+            Buffer:   64
+            Timeout:  300
+
+The DICOM images are read from the source once, and every byte written to
+the primary archive is also handed to the mirrors, each of which writes in
+its own thread. Each mirror has a bounded buffer ("Buffer", in MB): a slow
+mirror can fall behind by that much before the primary archive has to wait
+for it, and a mirror that does not make any progress for "Timeout" seconds
+is given up. A failing mirror never affects the primary archive or the other
+mirrors.
+
+All other (small) files, folders and links of the session are replicated
+from the primary archive once it is complete, so that each mirror ends up an
+exact copy of it. Like the primary archive, each mirror is written into a
+hidden folder first, and only published once the primary archive was
+published (or rolled back with it, see `publishing`).
+
+"""
+
+
+import io
+import os
+import time
+import shutil
+import itertools
+import threading
+from collections import deque
+
+from .publishing import (create_work_folder, publish, move_to_trash,
+                         empty_trash)
+
+
+DEFAULT_BUFFER = 64  # MB
+DEFAULT_TIMEOUT = 300  # s
+
+
+class _Mirror:
+    """A mirror of the session folder, written in a thread of its own (into
+    a hidden folder, `session_folder`, until it is published to `target`)."""
+
+    def __init__(self, root, target, buffer_size, timeout):
+        self.root = root
+        self.target = target
+        self.session_folder = None
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+        self.error = None
+        self.files = 0
+        self.bytes = 0
+        self.submitted = 0
+        self.seconds = 0.0
+        self._queue = deque()
+        self._queued = 0
+        self._condition = threading.Condition()
+        self._handles = {}
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        if os.path.exists(self.target):
+            self.fail("{0} already exists!".format(self.target))
+        else:
+            try:
+                self.session_folder = create_work_folder(self.root,
+                                                         self.target)
+                empty_trash(self.root)  # left over from earlier rollbacks
+            except Exception as e:
+                self.fail(e)
+        self._thread.start()
+
+    def fail(self, error):
+        with self._condition:
+            if self.error is None:
+                self.error = str(error)
+            self._queue.clear()
+            self._queued = 0
+            self._condition.notify_all()
+
+    def put(self, operation, nbytes=0):
+        """Queue an operation, waiting while the buffer is full."""
+
+        with self._condition:
+            start = time.perf_counter()
+            while self.error is None and self._queue and \
+                    self._queued + nbytes > self.buffer_size:
+                remaining = self.timeout - (time.perf_counter() - start)
+                if remaining <= 0:
+                    self.fail("Stalled for {0} s".format(self.timeout))
+                    break
+                self._condition.wait(remaining)
+            if self.error is not None:
+                return
+            self._queue.append((operation, nbytes))
+            self._queued += nbytes
+            self.submitted += nbytes
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._queue:
+                    self._condition.wait()
+                operation, nbytes = self._queue[0]
+            if operation is None:
+                break
+            if self.error is None:
+                start = time.perf_counter()
+                try:
+                    self._apply(operation)
+                except Exception as e:
+                    self.fail(e)
+                self.seconds += time.perf_counter() - start
+            with self._condition:
+                if self._queue and self._queue[0][0] is operation:
+                    self._queue.popleft()
+                    self._queued -= nbytes
+                self._condition.notify_all()
+        for f in self._handles.values():
+            f.close()
+        self._handles.clear()
+
+    def _apply(self, operation):
+        kind, key = operation[:2]
+        if kind == "open":
+            filename = os.path.join(self.session_folder, operation[2])
+            folder = os.path.dirname(filename)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            self._handles[key] = open(filename, 'wb')
+        elif kind == "write":
+            self._handles[key].write(operation[2])
+            self.bytes += len(operation[2])
+        elif kind == "close":
+            self._handles.pop(key).close()
+            self.files += 1
+
+    def close(self):
+        """Wait until all queued operations are done."""
+
+        with self._condition:
+            self._queue.append((None, 0))
+            self._condition.notify_all()
+        self._thread.join()
+
+    def publish(self):
+        """Publish the (complete) mirror, or roll it back if it failed."""
+
+        if self.error is None:
+            try:
+                publish(self.session_folder, self.target)
+                self.session_folder = self.target
+                return
+            except Exception as e:
+                self.fail(e)
+        self.rollback()
+
+    def rollback(self):
+        """Move the (incomplete) mirror into the trash."""
+
+        if self.session_folder is not None and \
+                self.session_folder != self.target and \
+                os.path.exists(self.session_folder):
+            try:
+                move_to_trash(self.session_folder, self.root)
+            except OSError:
+                pass  # left in the hidden folder
+
+    def status(self):
+        if self.error is not None:
+            return "failed"
+        if self.submitted == 0:
+            return "100%"
+        return "{0}%".format(int(100.0 * self.bytes / self.submitted))
+
+    def stats(self):
+        return {"session_folder": self.target, "files": self.files,
+                "bytes": self.bytes, "seconds": self.seconds,
+                "error": self.error}
+
+
+class TeeFile(io.RawIOBase):
+    """A file written to the primary archive and all mirrors (see
+    `Tee.open`)."""
+
+    def __init__(self, tee, filename):
+        self._file = open(filename, 'wb')
+        self._mirrors = tee.mirrors
+        self._key = next(tee._keys)
+        self._position = 0
+        relative = os.path.relpath(filename, tee.session_folder)
+        for mirror in self._mirrors:
+            mirror.put(("open", self._key, relative))
+
+    def writable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def write(self, data):
+        self._file.write(data)
+        chunk = bytes(data)  # the caller may reuse its buffer
+        for mirror in self._mirrors:
+            mirror.put(("write", self._key, chunk), len(chunk))
+        self._position += len(chunk)
+        return len(chunk)
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        if not self.closed:
+            super().close()  # flushes
+            self._file.close()
+            for mirror in self._mirrors:
+                mirror.put(("close", self._key))
+
+
+class Tee:
+    """Write a session folder to the primary archive and to mirrors.
+
+    Parameters
+    ----------
+    session_folder : str
+        the session folder in the primary archive
+    mirrors : list of (str, str)
+        the root folder of each mirror and the session folder in it (to
+        publish the mirror to, see `publish`)
+    buffer_size : int, optional
+        the maximal number of bytes a mirror can fall behind (default=64 MB)
+    timeout : float, optional
+        the number of seconds after which a mirror that does not make
+        progress is given up (default=300)
+
+    """
+
+    def __init__(self, session_folder, mirrors, buffer_size=None,
+                 timeout=None):
+        if buffer_size is None:
+            buffer_size = DEFAULT_BUFFER * 1000 * 1000
+        if timeout is None:
+            timeout = DEFAULT_TIMEOUT
+        self.session_folder = session_folder
+        self.mirrors = [_Mirror(root, folder, buffer_size, timeout)
+                        for root, folder in mirrors]
+        self._keys = itertools.count()
+
+    @classmethod
+    def from_config(cls, settings, session_folder, mirrors):
+        """Create a tee with the "Mirrors" section of the settings.
+
+        Parameters
+        ----------
+        settings : dict
+            the site-wide settings
+        session_folder : str
+            the session folder in the primary archive
+        mirrors : list of (str, str)
+            the root folder of each mirror and the session folder in it
+
+        Returns
+        -------
+        tee : Tee
+            the tee
+
+        """
+
+        config = (settings or {}).get("Mirrors") or {}
+        return cls(session_folder, mirrors,
+                   float(config.get("Buffer", DEFAULT_BUFFER)) * 1000 * 1000,
+                   float(config.get("Timeout", DEFAULT_TIMEOUT)))
+
+    def start(self):
+        """Create the hidden session folder in all mirrors."""
+
+        for mirror in self.mirrors:
+            mirror.start()
+
+    def open(self, filename):
+        """Open a file in the primary session folder for writing, to be
+        written to all mirrors as well.
+
+        Parameters
+        ----------
+        filename : str
+            the file (in the primary session folder)
+
+        Returns
+        -------
+        f : TeeFile
+            the (binary) file object
+
+        """
+
+        return TeeFile(self, filename)
+
+    def status(self):
+        """Get the progress of all mirrors, as text (e.g. " [/mnt/backup:
+        97%]")."""
+
+        return "".join(" [{0}: {1}]".format(x.root, x.status())
+                       for x in self.mirrors)
+
+    def finish(self, exclude=()):
+        """Wait for all mirrors and replicate the rest of the session folder.
+
+        Parameters
+        ----------
+        exclude : list of str, optional
+            files (relative to the session folder) not to replicate yet
+
+        """
+
+        for mirror in self.mirrors:
+            mirror.close()
+            if mirror.error is None:
+                try:
+                    self._replicate(mirror, exclude)
+                except Exception as e:
+                    mirror.fail(e)
+
+    def publish(self):
+        """Publish all (complete) mirrors, and roll back those that failed.
+
+        To be called once the primary session folder was published.
+
+        """
+
+        for mirror in self.mirrors:
+            mirror.publish()
+
+    def rollback(self):
+        """Give up all mirrors and move them into the trash."""
+
+        for mirror in self.mirrors:
+            mirror.fail("Rolled back")
+            mirror.close()
+            mirror.rollback()
+
+    def replicate_file(self, relative):
+        """Copy a single file of the primary session folder to all (healthy)
+        mirrors.
+
+        Parameters
+        ----------
+        relative : str
+            the file (relative to the session folder)
+
+        """
+
+        for mirror in self.mirrors:
+            if mirror.error is None:
+                try:
+                    shutil.copy2(
+                        os.path.join(self.session_folder, relative),
+                        os.path.join(mirror.session_folder, relative))
+                except Exception as e:
+                    mirror.fail(e)
+
+    def _replicate(self, mirror, exclude):
+        primary = {}
+        for root, folders, files in os.walk(self.session_folder):
+            for name in folders + files:
+                path = os.path.join(root, name)
+                primary[os.path.relpath(path, self.session_folder)] = path
+
+        # Remove what is not (or no longer) in the primary session folder
+        # (e.g. the images of a measurement that could not be copied)
+        for root, folders, files in os.walk(mirror.session_folder,
+                                            topdown=False):
+            for name in files + folders:
+                path = os.path.join(root, name)
+                if os.path.relpath(path, mirror.session_folder) \
+                        not in primary:
+                    if os.path.isdir(path):
+                        shutil.rmtree(path)
+                    else:
+                        os.remove(path)
+
+        # Files written already, by inode (to replicate hard links)
+        written = {}
+        for relative, path in primary.items():
+            target = os.path.join(mirror.session_folder, relative)
+            if os.path.isfile(path) and os.path.isfile(target) and \
+                    os.path.getsize(target) == os.path.getsize(path):
+                stat = os.stat(path)
+                written[(stat.st_dev, stat.st_ino)] = target
+
+        for relative in sorted(primary):
+            path = primary[relative]
+            target = os.path.join(mirror.session_folder, relative)
+            if relative in exclude:
+                continue
+            if os.path.isdir(path):
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                continue
+            stat = os.stat(path)
+            existing = written.get((stat.st_dev, stat.st_ino))
+            if existing == target:
+                continue
+            if os.path.exists(target):
+                os.remove(target)
+            if existing is not None and stat.st_nlink > 1:
+                os.link(existing, target)
+            else:
+                shutil.copy2(path, target)
+                mirror.files += 1
+                mirror.bytes += stat.st_size
+
+    def stats(self):
+        """Get the outcome per mirror.
+
+        Returns
+        -------
+        stats : dict
+            "session_folder", "files", "bytes", "seconds" and "error" per
+            mirror (root folder)
+
+        """
+
+        return {x.root: x.stats() for x in self.mirrors}
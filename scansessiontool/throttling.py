@@ -0,0 +1,301 @@
+"""Throttling.
+
+Limits on the throughput of the archiving procedure (e.g. to not saturate a
+network link shared with the scanner's own transfers), in bytes per second
+and files per second, configured in the "Settings" section of the config
+file:
+
+    Settings:
+        Throttle:
+            Bytes:  20          # MB/s
+            Files:  200         # files/s
+            Burst:  1           # s
+            Schedule:
+                "18:00-07:00":  no
+                "12:00-13:00":
+                    Bytes:  50
+
+Each limit is a token bucket that holds the tokens of "Burst" seconds
+(default: 1): short bursts pass at full speed, while the average is kept at
+the limit. Every file operation takes a file token before it starts, and
+reserves the bytes it is expected to copy (the size of its source), so that
+the operations after it wait until the bucket has refilled before they
+start; the reservation is corrected by the bytes actually copied once it is
+done.
+
+"Schedule" overrides the limits at certain times of the day ("HH:MM-HH:MM",
+possibly across midnight): "no" means full speed, otherwise the given limits
+apply (limits not given are lifted).
+
+"""
+
+
+import time
+import threading
+
+
+DEFAULT_BURST = 1  # s
+
+
+def parse_window(window):
+    """Parse a time window of the day.
+
+    Parameters
+    ----------
+    window : str
+        the time window ("HH:MM-HH:MM")
+
+    Returns
+    -------
+    start : int
+        the start, in minutes after midnight
+    end : int
+        the end, in minutes after midnight (smaller than `start`, if the
+        window spans midnight)
+
+    """
+
+    try:
+        start, end = [x.strip().split(":") for x in str(window).split("-")]
+        start = int(start[0]) * 60 + int(start[1])
+        end = int(end[0]) * 60 + int(end[1])
+    except (ValueError, IndexError):
+        raise ValueError("Invalid time window: {0}".format(window))
+    return start, end
+
+
+def in_window(window, minute):
+    """Check whether a minute of the day is in a time window (see
+    `parse_window`)."""
+
+    start, end = window
+    if start <= end:
+        return start <= minute < end
+    return minute >= start or minute < end
+
+
+def share_config(config, shares):
+    """Divide the limits of a "Throttle" section of the settings into
+    equal shares (e.g. for several sessions archived at once).
+
+    Parameters
+    ----------
+    config : dict
+        the "Throttle" section of the settings
+    shares : int
+        the number of shares
+
+    Returns
+    -------
+    config : dict
+        the "Throttle" section with the limits of a single share
+
+    """
+
+    def share(entry):
+        if not entry:
+            return entry
+        entry = dict(entry)
+        for key in ("Bytes", "Files"):
+            if entry.get(key):
+                entry[key] = float(entry[key]) / shares
+        return entry
+
+    config = share(config)
+    if config and config.get("Schedule"):
+        config["Schedule"] = {window: share(entry) for window, entry in
+                              config["Schedule"].items()}
+    return config
+
+
+class TokenBucket:
+    """A token bucket.
+
+    Parameters
+    ----------
+    rate : float
+        the number of tokens added per second
+    burst : float, optional
+        the number of seconds worth of tokens the bucket holds
+        (default=1)
+
+    """
+
+    def __init__(self, rate, burst=DEFAULT_BURST):
+        self.rate = float(rate)
+        self.capacity = self.rate * burst
+        self.tokens = self.capacity
+        self._last = time.perf_counter()
+
+    def _refill(self):
+        now = time.perf_counter()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def take(self, amount):
+        """Take tokens (the bucket may go into debt).
+
+        Returns
+        -------
+        delay : float
+            the number of seconds until the bucket is out of debt
+
+        """
+
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+        return max(0.0, -self.tokens / self.rate)
+
+    def delay(self):
+        """Get the number of seconds until the bucket is out of debt."""
+
+        self._refill()
+        return max(0.0, -self.tokens / self.rate)
+
+
+class Throttle:
+    """Limit the bytes and files per second of file operations.
+
+    Parameters
+    ----------
+    bytes_rate : float, optional
+        the number of bytes per second (default=None, meaning no limit)
+    files_rate : float, optional
+        the number of files per second (default=None, meaning no limit)
+    burst : float, optional
+        the number of seconds worth of bytes or files that may pass at once
+        (default=1)
+    schedule : list of ((int, int), float, float), optional
+        the time windows (see `parse_window`) with different limits (bytes
+        and files per second, None meaning no limit) (default=None)
+
+    Attributes
+    ----------
+    waited : float
+        the total number of seconds operations waited
+
+    """
+
+    def __init__(self, bytes_rate=None, files_rate=None, burst=DEFAULT_BURST,
+                 schedule=None):
+        self.limits = (bytes_rate, files_rate)
+        self.burst = burst
+        self.schedule = list(schedule or [])
+        self.waited = 0.0
+        self._lock = threading.Lock()
+        self._current = None
+        self._buckets = (None, None)
+
+    @classmethod
+    def from_config(cls, settings):
+        """Create a throttle from the "Throttle" section of the settings.
+
+        Parameters
+        ----------
+        settings : dict
+            the site-wide settings
+
+        Returns
+        -------
+        throttle : Throttle
+            the throttle (None if there are no limits)
+
+        """
+
+        config = (settings or {}).get("Throttle") or {}
+        if not config:
+            return None
+
+        def limits(entry, scale):
+            value = entry.get("Bytes")
+            bytes_rate = float(value) * scale if value else None
+            value = entry.get("Files")
+            files_rate = float(value) if value else None
+            return bytes_rate, files_rate
+
+        schedule = []
+        for window, entry in (config.get("Schedule") or {}).items():
+            schedule.append((parse_window(window),) +
+                            limits(entry or {}, 1000 * 1000))
+        return cls(*limits(config, 1000 * 1000),
+                   burst=float(config.get("Burst", DEFAULT_BURST)),
+                   schedule=schedule)
+
+    def current_limits(self):
+        """Get the limits that apply now (bytes and files per second)."""
+
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        for window, bytes_rate, files_rate in self.schedule:
+            if in_window(window, minute):
+                return bytes_rate, files_rate
+        return self.limits
+
+    def _get_buckets(self):
+        limits = self.current_limits()
+        if limits != self._current:
+            self._current = limits
+            self._buckets = tuple(None if x is None else
+                                  TokenBucket(x, self.burst) for x in limits)
+        return self._buckets
+
+    def _wait(self, delay):
+        if delay > 0:
+            time.sleep(delay)
+            with self._lock:
+                self.waited += delay
+
+    def acquire(self, nbytes=0):
+        """Wait until a file operation may start, and reserve the bytes it
+        is expected to copy.
+
+        Parameters
+        ----------
+        nbytes : int, optional
+            the number of bytes the operation is expected to copy
+            (default=0)
+
+        Returns
+        -------
+        reserved : int
+            the number of bytes reserved (to be passed to `release`)
+
+        """
+
+        with self._lock:
+            files_bucket = self._get_buckets()[1]
+            delay = 0.0 if files_bucket is None else files_bucket.take(1)
+        self._wait(delay)
+        while True:
+            with self._lock:
+                bytes_bucket = self._get_buckets()[0]
+                if bytes_bucket is None:
+                    return 0
+                delay = bytes_bucket.delay()
+                if delay <= 0:
+                    bytes_bucket.take(nbytes)
+                    return nbytes
+            self._wait(delay)
+
+    def release(self, nbytes, reserved=0):
+        """Account for the bytes a file operation copied.
+
+        Parameters
+        ----------
+        nbytes : int
+            the number of bytes the operation copied
+        reserved : int, optional
+            the number of bytes reserved for it (see `acquire`) (default=0)
+
+        """
+
+        with self._lock:
+            bytes_bucket = self._get_buckets()[0]
+            if bytes_bucket is not None:
+                bytes_bucket.take(nbytes - reserved)
+
+    def stats(self):
+        return {"bytes_per_second": self.limits[0],
+                "files_per_second": self.limits[1],
+                "waited": self.waited}
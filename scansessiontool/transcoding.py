@@ -0,0 +1,107 @@
+"""Transcoding.
+
+Lossless re-encoding of DICOM images into a compressed transfer syntax while
+archiving, enabled with "DicomCompression" in the "Settings" section of the
+config file:
+
+    Settings:
+        DicomCompression:  deflate
+
+"deflate" (Deflated Explicit VR Little Endian) only requires pydicom; the
+other transfer syntaxes (see `TRANSFER_SYNTAXES`) require numpy and a
+pydicom encoder plugin for them (e.g. pylibjpeg or GDCM).
+
+Every re-encoded image is read back and its pixel data compared to the
+original. Images that cannot be re-encoded (e.g. because they are compressed
+already, or their pixel data does not round-trip), or that would not get
+smaller, are archived unchanged.
+
+"""
+
+
+import io
+
+
+TRANSFER_SYNTAXES = {"deflate": "1.2.840.10008.1.2.1.99",
+                     "rle": "1.2.840.10008.1.2.5",
+                     "jpeg-ls": "1.2.840.10008.1.2.4.80",
+                     "jpeg2000": "1.2.840.10008.1.2.4.90"}
+
+# Transfer syntaxes images are re-encoded from (Implicit and Explicit VR
+# Little Endian)
+SOURCE_SYNTAXES = ("1.2.840.10008.1.2", "1.2.840.10008.1.2.1")
+
+# Outcomes of `encode`
+ENCODED = "encoded"
+UNCHANGED = "unchanged"
+FAILED = "failed"
+
+
+def _save(dataset):
+    import pydicom
+
+    buffer = io.BytesIO()
+    if int(pydicom.__version__.split(".")[0]) < 3:
+        dataset.is_little_endian = True
+        dataset.is_implicit_VR = False
+        dataset.save_as(buffer, write_like_original=False)
+    else:
+        dataset.save_as(buffer, enforce_file_format=True)
+    return buffer.getvalue()
+
+def encode(data, compression):
+    """Re-encode a DICOM file losslessly in a compressed transfer syntax.
+
+    Parameters
+    ----------
+    data : bytes
+        the content of the DICOM file
+    compression : str
+        the transfer syntax to encode in (see `TRANSFER_SYNTAXES`)
+
+    Returns
+    -------
+    data : bytes
+        the content of the re-encoded DICOM file (or the original content,
+        if it was not re-encoded)
+    outcome : str
+        `ENCODED`, `UNCHANGED` (not an uncompressed DICOM image, or not
+        smaller when re-encoded) or `FAILED` (the encoder failed, or the
+        pixel data did not round-trip)
+
+    """
+
+    import pydicom  # imported on first use, as it is slow to import
+
+    transfer_syntax = TRANSFER_SYNTAXES[compression]
+    try:
+        dataset = pydicom.dcmread(io.BytesIO(data))
+    except Exception:
+        return data, UNCHANGED
+    if dataset.file_meta.get("TransferSyntaxUID") not in SOURCE_SYNTAXES \
+            or "PixelData" not in dataset:
+        return data, UNCHANGED
+
+    try:
+        original = dataset.PixelData
+        if compression == "deflate":
+            dataset.file_meta.TransferSyntaxUID = transfer_syntax
+        else:
+            pixels = dataset.pixel_array
+            dataset.compress(transfer_syntax)
+        encoded = _save(dataset)
+
+        # Verify
+        check = pydicom.dcmread(io.BytesIO(encoded))
+        if compression == "deflate":
+            identical = check.PixelData == original
+        else:
+            import numpy
+            identical = numpy.array_equal(check.pixel_array, pixels)
+    except Exception:
+        return data, FAILED
+    if not identical:
+        return data, FAILED
+    if len(encoded) >= len(data):  # e.g. noise
+        return data, UNCHANGED
+    return encoded, ENCODED
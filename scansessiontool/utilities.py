@@ -6,11 +6,12 @@ A set of utility functions used in Scan Session Tool.
 
 
 import os
+import glob
+import time
 import shutil
+import hashlib
 from tempfile import mkstemp
 
-import pydicom
-
 
 def replace(file_path, pattern, subst):
     """Replace text in a file.
@@ -42,7 +43,7 @@ def replace(file_path, pattern, subst):
     shutil.move(abs_path, file_path)
 
 def readdicom(filename):
-    """Read metadata from a DICOM file.
+    """Read metadata from a DICOM file (or file object).
 
     Returns
     -------
@@ -61,6 +62,214 @@ def readdicom(filename):
 
     """
 
-    dicom = pydicom.filereader.read_file(filename, stop_before_pixels=True)
+    import pydicom  # imported on first use, as it is slow to import
+
+    dicom = pydicom.dcmread(filename, stop_before_pixels=True)
     return [filename, dicom.SeriesNumber, dicom.AcquisitionNumber,
             dicom.InstanceNumber, dicom.ProtocolName, dicom.EchoNumbers]
+
+def readdicom_timed(filename):
+    """Read metadata from a DICOM file and measure how long that took.
+
+    Returns
+    -------
+    metadata : list
+        the metadata as returned by `readdicom`
+    latency : float
+        the time in seconds it took to read the metadata
+
+    """
+
+    start = time.perf_counter()
+    metadata = readdicom(filename)
+    return metadata, time.perf_counter() - start
+
+def copy_file(source, destination, chunk_size=1024*1024):
+    """Copy the content of a file and compute its SHA-256 hash in one pass.
+
+    Parameters
+    ----------
+    source : str
+        the file to copy
+    destination : str
+        the file to copy to
+    chunk_size : int, optional
+        the number of bytes to read at once (default=1048576)
+
+    Returns
+    -------
+    size : int
+        the number of bytes copied
+    sha256 : str
+        the SHA-256 hash of the content (hexadecimal)
+
+    """
+
+    with open(source, 'rb') as fsrc:
+        return copy_fileobj(fsrc, destination, chunk_size)
+
+def copy_fileobj(fsrc, destination, chunk_size=1024*1024, open_target=None):
+    """Copy the content of a file object into a file and compute its SHA-256
+    hash in one pass.
+
+    Parameters
+    ----------
+    fsrc : file object
+        the (binary) file object to copy
+    destination : str
+        the file to copy to
+    chunk_size : int, optional
+        the number of bytes to read at once (default=1048576)
+    open_target : callable, optional
+        the function to open the destination for writing with
+        (default=None, meaning `open(destination, 'wb')`)
+
+    Returns
+    -------
+    size : int
+        the number of bytes copied
+    sha256 : str
+        the SHA-256 hash of the content (hexadecimal)
+
+    """
+
+    digest = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    size = 0
+    if open_target is None:
+        fdst = open(destination, 'wb')
+    else:
+        fdst = open_target(destination)
+    with fdst:
+        while True:
+            length = fsrc.readinto(buffer)
+            if not length:
+                break
+            digest.update(view[:length])
+            fdst.write(view[:length])
+            size += length
+    return size, digest.hexdigest()
+
+def hash_file(filename, chunk_size=1024*1024):
+    """Compute the SHA-256 hash of a file.
+
+    Returns
+    -------
+    size : int
+        the size of the file in bytes
+    sha256 : str
+        the SHA-256 hash of the content (hexadecimal)
+
+    """
+
+    digest = hashlib.sha256()
+    size = 0
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+def copy_logfiles(text, source, destination, report=None,
+                  phase="Copying logfiles", measurement=None, archived=None,
+                  scheduler=None):
+    """Copy the logfiles listed in a text (one per line).
+
+    Lines can be file names, wildcard patterns or folder names, relative to
+    the source folder.
+
+    Parameters
+    ----------
+    text : str
+        the list of logfiles
+    source : str
+        the folder to copy the logfiles from
+    destination : str
+        the folder to copy the logfiles to
+    report : ArchiveReport, optional
+        the report to add the copied files to (default=None)
+    phase : str, optional
+        the phase of the report to add the copied files to
+        (default="Copying logfiles")
+    measurement : str, optional
+        the measurement of the report to add the copied files to
+        (default=None)
+    archived : list, optional
+        a list to append a catalog record (see `ArchiveCatalog`) of every
+        copied file to (default=None)
+    scheduler : IOScheduler, optional
+        the scheduler to run copy operations with (default=None)
+
+    Returns
+    -------
+    warning : str
+        a warning listing the logfiles that could not be copied
+    text : str
+        the list of logfiles, with wildcard patterns replaced by the names
+        of the matching files
+
+    """
+
+    def copy(src, dst):
+        if scheduler is not None:
+            size, sha256 = scheduler.call(copy_file, src, dst)
+        else:
+            size, sha256 = copy_file(src, dst)
+        if archived is not None:
+            archived.append({"phase": phase, "measurement": measurement,
+                             "source": os.path.abspath(src),
+                             "target": os.path.abspath(dst), "size": size,
+                             "sha256": sha256})
+
+    def copy_tree(src, dst):
+        copy(src, dst)
+        shutil.copystat(src, dst)
+
+    logfiles = text.split("\n")
+    logfiles = [x.strip() for x in logfiles if x != ""]
+    warning = ""
+    new = text
+    for logfile in logfiles:
+        if "*" in logfile:
+            replaced = []
+        try:
+            if logfile != "" and not os.path.isdir(logfile):
+                files = glob.glob(os.path.join(source, logfile))
+                if files == []:
+                    raise Exception
+                for file_ in files:
+                    if not os.path.isdir(file_):
+                        if "*" in logfile:
+                            replaced.append(
+                                os.path.split(file_)[-1])
+                        target = os.path.join(destination,
+                                              os.path.split(file_)[-1])
+                        copy(file_, target)
+                        if report is not None:
+                            report.add(phase, files=1,
+                                       nbytes=os.path.getsize(file_),
+                                       measurement=measurement)
+                if "*" in logfile:
+                    new = new.replace(
+                        logfile, "\n".join(sorted(replaced)))
+
+            if logfile != "" and os.path.isdir(os.path.join(source,
+                                                            logfile)):
+                shutil.copytree(os.path.abspath(os.path.join(source,
+                                                             logfile)),
+                                os.path.abspath(os.path.join(destination,
+                                                             logfile)),
+                                copy_function=copy_tree)
+                if report is not None:
+                    for root, _, files in os.walk(
+                            os.path.join(destination, logfile)):
+                        report.add(phase, files=len(files),
+                                   nbytes=sum(os.path.getsize(
+                                       os.path.join(root, x))
+                                              for x in files),
+                                   measurement=measurement)
+        except:
+           warning += "\nError copying logfiles " \
+               "'{}' not found\n".format(logfile)
+    return warning, new
@@ -5,10 +5,7 @@ A set of custom Tkinter widgets used in Scan Session Tool.
 """
 
 
-import os
 import sys
-import glob
-import shutil
 import platform
 
 from tkinter import *
@@ -81,46 +78,6 @@ class AutoScrollbarText(Text):
     def __str__(self):
         return str(self.frame)
 
-    def copy_logfiles(self, source, destination):
-        original = self.get(1.0, END)
-        logfiles = original.split("\n")
-        logfiles = [x.strip() for x in logfiles if x != ""]
-        warning = ""
-        new = original
-        for logfile in logfiles:
-            if "*" in logfile:
-                replaced = []
-            try:
-                if logfile != "" and not os.path.isdir(logfile):
-                    files = glob.glob(os.path.join(source, logfile))
-                    if files == []:
-                        raise Exception
-                    for file_ in files:
-                        if not os.path.isdir(file_):
-                            if "*" in logfile:
-                                replaced.append(
-                                    os.path.split(file_)[-1])
-                            shutil.copyfile(
-                                file_,
-                                os.path.join(destination,
-                                             os.path.split(file_)[-1]))
-                    if "*" in logfile:
-                        new = new.replace(
-                            logfile, "\n".join(sorted(replaced)))
-                        self.delete(1.0, END)
-                        self.insert(1.0, new)
-
-                if logfile != "" and os.path.isdir(os.path.join(source,
-                                                                logfile)):
-                    shutil.copytree(os.path.abspath(os.path.join(source,
-                                                                 logfile)),
-                                    os.path.abspath(os.path.join(destination,
-                                                                 logfile)))
-            except:
-               warning += "\nError copying logfiles " \
-                   "'{}' not found\n".format(logfile)
-        return warning
-
 
 class VerticalScrolledFrame(Frame):
     """A pure Tkinter scrollable frame that actually works!
@@ -221,6 +178,187 @@ class VerticalScrolledFrame(Frame):
                 self.canvas.yview_scroll(-2*(event.delta/120), "units")
 
 
+class VirtualScrolledList(VerticalScrolledFrame):
+    """A vertically scrolling list that only creates widgets for visible rows.
+
+    * All rows have the same (fixed) height
+    * Rows are created with `create_row(parent)`, which returns a widget
+    * Items are shown in rows with `show_row(row, index)`; rows scrolled out
+      of view are recycled to show other items
+    * Set the number of items with `set_count`
+
+    """
+
+    def __init__(self, parent, row_height, create_row, show_row, *args,
+                 **kw):
+        VerticalScrolledFrame.__init__(self, parent, *args, **kw)
+
+        # Rows are placed on the canvas directly, not in the interior frame
+        self.canvas.delete(self.interior_id)
+        self.interior.unbind('<Configure>')
+        self.canvas.config(yscrollcommand=self._on_scroll)
+        self.canvas.bind('<Configure>', self._configure_canvas)
+
+        self.row_height = row_height
+        self.create_row = create_row
+        self.show_row = show_row
+        self.count = 0
+        self.rows = {}
+        self.free_rows = []
+        self.scroll_height = 0
+
+    def _canvas_size(self):
+        width = self.canvas.winfo_width()
+        height = self.canvas.winfo_height()
+        if width <= 1 or height <= 1:  # not mapped yet
+            width = int(self.canvas["width"])
+            height = int(self.canvas["height"])
+        return width, height
+
+    def _configure_canvas(self, event):
+        for row in list(self.rows.values()) + self.free_rows:
+            self.canvas.itemconfigure(row.window_id, width=event.width)
+        self.set_count(self.count)
+
+    def _on_scroll(self, lo, hi):
+        self.vscrollbar.set(lo, hi)
+        self.refresh()
+
+    def set_count(self, count):
+        """Set the number of items in the list."""
+
+        self.count = count
+        width, height = self._canvas_size()
+        self.scroll_height = max(count * self.row_height, height)
+        self.canvas.config(scrollregion=(0, 0, width, self.scroll_height))
+        self.refresh()
+
+    def refresh(self):
+        """Show the visible items, recycling rows that went out of view."""
+
+        width, height = self._canvas_size()
+        top = int(self.canvas.canvasy(0))
+        first = max(0, top // self.row_height)
+        last = min(self.count, (top + height) // self.row_height + 1)
+        try:
+            focus = str(self.focus_get())
+        except KeyError:
+            focus = ""
+        for index in [x for x in self.rows if not first <= x < last]:
+            row = self.rows.pop(index)
+            if focus.startswith(str(row) + "."):
+                # Keep typing from going into the recycled row
+                self.canvas.focus_set()
+            self.canvas.itemconfigure(row.window_id, state=HIDDEN)
+            self.free_rows.append(row)
+        for index in range(first, last):
+            if index in self.rows:
+                continue
+            if self.free_rows:
+                row = self.free_rows.pop()
+            else:
+                row = self.create_row(self.canvas)
+                row.window_id = self.canvas.create_window(
+                    0, 0, window=row, anchor=NW, width=width,
+                    height=self.row_height)
+            self.canvas.coords(row.window_id, 0, index * self.row_height)
+            self.canvas.itemconfigure(row.window_id, state=NORMAL)
+            self.rows[index] = row
+            self.show_row(row, index)
+
+    def refresh_row(self, index):
+        """Show an item again (if visible), e.g. after it changed."""
+
+        if index in self.rows:
+            self.show_row(self.rows[index], index)
+
+    def refresh_rows(self):
+        """Show all visible items again."""
+
+        for index, row in self.rows.items():
+            self.show_row(row, index)
+
+    def get_row(self, index):
+        """Get the row showing an item, or None if it is not visible."""
+
+        return self.rows.get(index)
+
+    def see(self, index):
+        """Scroll the list so that an item is visible."""
+
+        if index is None or self.scroll_height == 0:
+            return
+        height = self._canvas_size()[1]
+        top = self.canvas.canvasy(0)
+        y = index * self.row_height
+        if y < top:
+            self.canvas.yview_moveto(y / self.scroll_height)
+        elif y + self.row_height > top + height:
+            self.canvas.yview_moveto(
+                (y + self.row_height - height) / self.scroll_height)
+
+
+class MeasurementRow(Frame):
+    """A row of widgets showing a single measurement.
+
+    A row can be recycled to show other measurements. Changes made in the
+    widgets are passed on as callback(index, field, value), with the index
+    of the measurement shown.
+
+    * Create the widgets of the fields with `add_var` and `add_text`
+    * Show a measurement with `show`
+
+    """
+
+    def __init__(self, master, callback, **kw):
+        Frame.__init__(self, master, **kw)
+        self.callback = callback
+        self.index = None
+        self.vars = {}
+        self.texts = {}
+
+    def add_var(self, field):
+        """Create the Tkinter variable of a single-line field."""
+
+        var = StringVar()
+        var.trace("w", lambda *args: self._var_changed(field))
+        self.vars[field] = var
+        return var
+
+    def add_text(self, field, text):
+        """Add the text widget of a multi-line field."""
+
+        text.bind('<KeyRelease>', lambda x: self._text_changed(field))
+        self.texts[field] = text
+
+    def show(self, index, measurement):
+        """Show a measurement in the row."""
+
+        recycled = index != self.index
+        self.index = None  # changes made here are not passed on
+        for field, var in self.vars.items():
+            value = getattr(measurement, field)
+            if var.get() != value:
+                var.set(value)
+        for field, text in self.texts.items():
+            value = getattr(measurement, field)
+            if text.get(1.0, "end-1c") != value:
+                text.delete(1.0, END)
+                text.insert(1.0, value)
+            if recycled:
+                text.edit_reset()
+        self.index = index
+
+    def _var_changed(self, field):
+        if self.index is not None:
+            self.callback(self.index, field, self.vars[field].get())
+
+    def _text_changed(self, field):
+        if self.index is not None:
+            self.callback(self.index, field,
+                          self.texts[field].get(1.0, "end-1c"))
+
+
 class AutocompleteCombobox(Combobox):
     """A Tkinter combobox widget with an autocompletion feature."""
 
@@ -44,6 +44,12 @@ setup(
     entry_points = {
         'gui_scripts': [
             'scansessiontool = scansessiontool.__main__:run'
+        ],
+        'console_scripts': [
+            'scansessiontool-index = scansessiontool.protocolindex:main',
+            'scansessiontool-catalog = scansessiontool.catalog:main',
+            'scansessiontool-batch = scansessiontool.batch:main',
+            'scansessiontool-flush = scansessiontool.staging:main'
         ]
     }
 )
@@ -1,10 +1,18 @@
 import os
+import io
 import glob
+import time
+import shutil
+import json
 import platform
 import unittest
 import tempfile
+import threading
+import multiprocessing
 import filecmp
+import tarfile
 import zipfile
+import tkinter
 
 from tkinter import *
 from tkinter import _tkinter
@@ -13,6 +21,30 @@ from tkinter.ttk import *
 from dataintegrityfingerprint import DataIntegrityFingerprint
 
 from scansessiontool.scansessiontool import ScanSessionTool
+from scansessiontool.config import load_config
+from scansessiontool.protocol import ScanProtocol
+from scansessiontool.protocolindex import ProtocolIndex, find_protocols
+from scansessiontool.catalog import ArchiveCatalog
+from scansessiontool.batch import BatchArchiver
+from scansessiontool.archiving import SessionArchiver
+from scansessiontool.scheduler import IOScheduler, order_operations
+from scansessiontool.throttling import Throttle, parse_window, in_window
+from scansessiontool.retrying import (RetryPolicy, classify, TRANSIENT,
+                                      MISSING, CORRUPT)
+from scansessiontool.utilities import hash_file, copy_file
+from scansessiontool.containers import (ContainerWriter, list_members,
+                                        read_member)
+from scansessiontool.exports import ExportArchive, is_export
+from scansessiontool.deidentification import Deidentifier
+from scansessiontool.tee import Tee
+from scansessiontool.staging import Flusher, FlushQueue
+from scansessiontool.durability import Durability
+from scansessiontool.metrics import MetricsSink
+from scansessiontool.profiling import Profiler
+from scansessiontool.report import ArchiveReport
+from scansessiontool.publishing import (create_work_folder, publish,
+                                        move_to_trash, INCOMING_FOLDER,
+                                        TRASH_FOLDER)
 
 
 DATA_DIR = None
@@ -45,6 +77,21 @@ def change_eol_win2unix(path):
         with open(file, 'wb') as f:
             f.write(content)
 
+def remove_archive_report(testcase, path):
+    reports = glob.glob(os.path.join(path, "*", "*", "archive_report.json"))
+    testcase.assertEqual(len(reports), 1, "Archive report missing.")
+    with open(reports[0]) as f:
+        report = json.load(f)
+    testcase.assertIn("Reading DICOM images", report["phases"])
+    os.remove(reports[0])
+
+def queue_sessions(spool, name, number=20):
+    # Queue sessions (e.g. from a batch worker process) all at once
+    queue = FlushQueue(spool)
+    for x in range(number):
+        staged = os.path.join(spool, name, str(x))
+        queue.put(staged, staged + ".target", catalog={"staged": staged})
+
 
 class TestScanSessionDocumentation(unittest.TestCase):
     def setUp(self):
@@ -70,6 +117,75 @@ class TestScanSessionDocumentation(unittest.TestCase):
                     "(Re)saved scan protocol file differs from original.")
 
 
+class TestScanProtocol(unittest.TestCase):
+    def setUp(self):
+        global DATA_DIR
+        self.test_protocol = os.path.join(
+            DATA_DIR.name,
+            "ScanProtocol_TestData_sub-001_ses-007-Transfer_20211203.txt")
+
+    def test_parse_format_scan_protocol(self):
+        with open(self.test_protocol, 'r') as f:
+            content = f.read()
+        protocol = ScanProtocol.parse(content.splitlines(True))
+        self.assertEqual(protocol.project, "TestData")
+        self.assertEqual(protocol.session, ["007", "Transfer"])
+        self.assertEqual(
+            protocol.format(), content,
+            "Formatted scan protocol differs from original.")
+
+    def test_json_sidecar(self):
+        global DATA_DIR
+        with open(self.test_protocol, 'r') as f:
+            protocol = ScanProtocol.parse(f)
+        sidecar = os.path.join(DATA_DIR.name, "newprotocol.json")
+        protocol.write_json(sidecar)
+        with open(sidecar) as f:
+            data = json.load(f)
+        self.assertEqual(data["session"], {"number": 7, "type": "Transfer"})
+        self.assertEqual(len(data["measurements"]),
+                         len(protocol.measurements))
+        self.assertEqual([x["name"] for x in data["measurements"]],
+                         [x.name for x in protocol.measurements])
+
+
+class TestProtocolIndex(unittest.TestCase):
+    def setUp(self):
+        global DATA_DIR
+        self.test_protocol = os.path.join(
+            DATA_DIR.name,
+            "ScanProtocol_TestData_sub-001_ses-007-Transfer_20211203.txt")
+        with open(self.test_protocol) as f:
+            self.protocol = ScanProtocol.parse(f)
+        self.archive = tempfile.TemporaryDirectory()
+        self.index = ProtocolIndex(os.path.join(self.archive.name,
+                                                "index.sqlite"))
+
+    def tearDown(self):
+        self.index.close()
+        self.archive.cleanup()
+
+    def test_update_search_index(self):
+        session = os.path.join(self.archive.name, "TestData", "sub-001",
+                               "ses-007-Transfer")
+        os.makedirs(session)
+        copy = os.path.join(session, os.path.split(self.test_protocol)[-1])
+        shutil.copyfile(self.test_protocol, copy)
+        self.assertEqual(self.index.update(self.archive.name)["added"], 1)
+        self.assertEqual(self.index.update(self.archive.name)["unchanged"], 1)
+
+        measurement = self.protocol.measurements[0]
+        results = self.index.search(project="TestData",
+                                    name=measurement.name)
+        self.assertEqual([x["path"] for x in results], [copy])
+        self.assertEqual(results[0]["number"], int(measurement.number))
+        self.assertEqual(self.index.search(project="Project 3"), [])
+
+        os.remove(copy)
+        self.assertEqual(self.index.update(self.archive.name)["removed"], 1)
+        self.assertEqual(self.index.search(), [])
+
+
 class TestDataArchiving(unittest.TestCase):
     def setUp(self):
         global DATA_DIR
@@ -79,10 +195,14 @@ class TestDataArchiving(unittest.TestCase):
         self.checksums_dif = DataIntegrityFingerprint(
             os.path.join(DATA_DIR.name, "TestData.sha256"),
             from_checksums_file=True)
+        self.cache_dir = tempfile.TemporaryDirectory()
+        os.environ["SST_CACHE_DIR"] = self.cache_dir.name
         self.root = Tk()
 
     def tearDown(self):
         self.root.destroy()
+        del os.environ["SST_CACHE_DIR"]
+        self.cache_dir.cleanup()
 
     def test_archive_data_single_folder(self):
         global DATA_DIR
@@ -94,6 +214,7 @@ class TestDataArchiving(unittest.TestCase):
                                                            output, 1, 1,
                                                            "TBVFiles",
                                                            "TBV_"]})
+            remove_archive_report(self, os.path.join(output, "TestData"))
             if platform.system() == "Windows":
                 change_eol_win2unix(os.path.join(output, "TestData"))
             dif = DataIntegrityFingerprint(os.path.join(output, "TestData"))
@@ -111,6 +232,7 @@ class TestDataArchiving(unittest.TestCase):
                                                            output, 1, 1,
                                                            "TBVFiles",
                                                            "TBV_"]})
+            remove_archive_report(self, os.path.join(output, "TestData"))
             if platform.system() == "Windows":
                 change_eol_win2unix(os.path.join(output, "TestData"))
             dif = DataIntegrityFingerprint(os.path.join(output, "TestData"))
@@ -118,6 +240,885 @@ class TestDataArchiving(unittest.TestCase):
                 dif.dif, self.checksums_dif.dif,
                 "Archived data fingerprint differs from checksums file.")
 
+    def test_archive_catalog(self):
+        global DATA_DIR
+        with tempfile.TemporaryDirectory(dir=DATA_DIR.name) as output:
+            test_data = os.path.join(DATA_DIR.name, "TestData_1")
+            app = ScanSessionTool(self.root,
+                                  run_actions={"open": [self.test_protocol],
+                                               "archive": [True, test_data,
+                                                           output, 1, 1,
+                                                           "TBVFiles",
+                                                           "TBV_"]})
+            dicoms = glob.glob(os.path.join(output, "TestData", "*", "*",
+                                            "*", "*", "DICOM", "*"))
+            with ArchiveCatalog() as catalog:
+                files = catalog.files(target=os.path.join(
+                    os.path.abspath(output), "*", "DICOM", "*"))
+                self.assertEqual(sorted(x["target"] for x in files),
+                                 sorted(os.path.abspath(x) for x in dicoms))
+                for row in files:
+                    self.assertEqual(hash_file(row["target"]),
+                                     (row["size"], row["sha256"]))
+                    self.assertEqual(hash_file(row["source"]),
+                                     (row["size"], row["sha256"]))
+                series = catalog.series(files[0]["protocol_name"])
+                self.assertIn(files[0]["series"],
+                              [x["series"] for x in series])
+                totals = catalog.totals()
+                self.assertEqual([x["project"] for x in totals],
+                                 ["TestData"])
+                self.assertEqual(totals[0]["bytes"], sum(
+                    os.path.getsize(x["target"])
+                    for x in catalog.files()))
+
+    def test_dicom_compression(self):
+        import pydicom
+        global DATA_DIR
+        with tempfile.TemporaryDirectory(dir=DATA_DIR.name) as output:
+            test_data = os.path.join(DATA_DIR.name, "TestData_1")
+            with open(self.test_protocol) as f:
+                protocol = ScanProtocol.parse(f.readlines())
+            archiver = SessionArchiver(protocol, test_data, output,
+                                       dicom_compression="deflate")
+            archiver.run()
+            self.assertTrue(archiver.success)
+            self.assertEqual(archiver.compression["failed"], 0)
+            self.assertGreater(archiver.compression["encoded"], 0)
+            dicoms = [x for x in archiver.archived
+                      if x["phase"] == "Copying DICOM files"]
+            self.assertGreater(len(dicoms), 0)
+            for record in dicoms:
+                source = pydicom.dcmread(record["source"])
+                target = pydicom.dcmread(record["target"])
+                self.assertEqual(target.PixelData, source.PixelData)
+                self.assertEqual(target.SeriesNumber, source.SeriesNumber)
+
+    def test_deidentification(self):
+        import pydicom
+        global DATA_DIR
+        with tempfile.TemporaryDirectory(dir=DATA_DIR.name) as output:
+            test_data = os.path.join(DATA_DIR.name, "TestData_1")
+            with open(self.test_protocol) as f:
+                protocol = ScanProtocol.parse(f.readlines())
+            archiver = SessionArchiver(protocol, test_data, output,
+                                       deidentification=True)
+            archiver.run()
+            self.assertTrue(archiver.success)
+            pseudonym = archiver.deidentifier.pseudonym
+            self.assertEqual(pseudonym, "TestData-sub-001")
+            dicoms = [x for x in archiver.archived
+                      if x["phase"] == "Copying DICOM files"]
+            self.assertGreater(len(dicoms), 0)
+            for record in dicoms:
+                source = pydicom.dcmread(record["source"])
+                target = pydicom.dcmread(record["target"])
+                self.assertEqual(target.PatientName, pseudonym)
+                self.assertEqual(target.PatientID, pseudonym)
+                self.assertEqual(target.get("PatientBirthDate", ""), "")
+                self.assertEqual(target.PixelData, source.PixelData)
+            with open(os.path.join(self.cache_dir.name,
+                                   "deidentification_log.jsonl")) as f:
+                log = json.loads(f.readline())
+            self.assertEqual(log["pseudonym"], pseudonym)
+            self.assertGreater(len(log["originals"]), 0)
+
+
+class TestBatchArchiving(unittest.TestCase):
+    def setUp(self):
+        global DATA_DIR
+        self.test_protocol = os.path.join(
+            DATA_DIR.name,
+            "ScanProtocol_TestData_sub-001_ses-007-Transfer_20211203.txt")
+        self.checksums_dif = DataIntegrityFingerprint(
+            os.path.join(DATA_DIR.name, "TestData.sha256"),
+            from_checksums_file=True)
+        self.cache_dir = tempfile.TemporaryDirectory()
+        os.environ["SST_CACHE_DIR"] = self.cache_dir.name
+
+    def tearDown(self):
+        del os.environ["SST_CACHE_DIR"]
+        self.cache_dir.cleanup()
+
+    def test_batch_archive_data(self):
+        global DATA_DIR
+        with tempfile.TemporaryDirectory(dir=DATA_DIR.name) as output:
+            sessions = [(self.test_protocol,
+                         os.path.join(DATA_DIR.name, "TestData_1")),
+                        (self.test_protocol,
+                         os.path.join(DATA_DIR.name, "TestData_2"))]
+            archiver = BatchArchiver(sessions, output, True, True,
+                                     "TBVFiles", "TBV_", jobs=2)
+            report = archiver.run()
+            self.assertEqual(report["total"]["archived"], 1)
+            self.assertEqual(report["total"]["failed"], 1)
+            failed = [x for x in report["sessions"]
+                      if x["status"] == "failed"]
+            self.assertTrue(failed[0]["message"].startswith(
+                "Archiving failed"))
+            remove_archive_report(self, os.path.join(output, "TestData"))
+            if platform.system() == "Windows":
+                change_eol_win2unix(os.path.join(output, "TestData"))
+            dif = DataIntegrityFingerprint(os.path.join(output, "TestData"))
+            self.assertEqual(
+                dif.dif, self.checksums_dif.dif,
+                "Archived data fingerprint differs from checksums file.")
+
+
+class TestIOScheduler(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.folder.name, "source")
+        self.target = os.path.join(self.folder.name, "target")
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def operation(self, source, target):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        time.sleep(0.005)
+        with self.lock:
+            self.active -= 1
+        return 0, None
+
+    def test_device_limit(self):
+        scheduler = IOScheduler({self.folder.name: 1})
+        operations = [(self.source, self.target)] * 20
+        results = list(scheduler.map(self.operation, operations))
+        scheduler.shutdown()
+        self.assertEqual(len(results), 20)
+        self.assertTrue(all(x[2] is None for x in results))
+        self.assertEqual(self.max_active, 1)
+
+    def test_dispatch_order(self):
+        started = []
+
+        def operation(source, target):
+            started.append(target)
+            time.sleep(0.001)
+            return 0, None
+
+        scheduler = IOScheduler({self.folder.name: 1})
+        operations = [(self.source, os.path.join(self.target, str(x)))
+                      for x in range(100)]
+        results = list(scheduler.map(operation, operations))
+        scheduler.shutdown()
+        self.assertTrue(all(x[2] is None for x in results))
+        self.assertEqual(started, [x[1] for x in operations])
+
+    def test_auto_tuning(self):
+        scheduler = IOScheduler(max_limit=16)
+        limiter = scheduler.get_limiter(self.source)
+        limiter.window = 0.05
+        operations = [(self.source, self.target)] * 400
+        list(scheduler.map(self.operation, operations))
+        scheduler.shutdown()
+        self.assertTrue(limiter.auto)
+        self.assertGreater(limiter.limit, 2)
+        self.assertGreater(self.max_active, 2)
+
+    def test_throttle(self):
+        # 20 operations of 50 kB each, with a burst of 0.1 s: 0.9 MB have
+        # to wait at 1 MB/s, 15 files at 50 files/s
+        for throttle, minimum in ((Throttle(1e6, burst=0.1), 0.9),
+                                  (Throttle(files_rate=50, burst=0.1), 0.3)):
+            scheduler = IOScheduler(throttle=throttle)
+            operations = [(self.source, self.target)] * 20
+            start = time.perf_counter()
+            list(scheduler.map(lambda x, y: (50000, None), operations))
+            seconds = time.perf_counter() - start
+            scheduler.shutdown()
+            self.assertGreater(seconds, minimum * 0.9)
+            self.assertLess(seconds, minimum * 2)
+            self.assertGreater(throttle.waited, 0)
+
+    def test_throttle_reservation(self):
+        # At 1 MB/s with a burst of 0.1 s, only about 2 of 20 copies of
+        # 50 kB each may start right away, rather than all at once
+        with open(self.source, 'wb') as f:
+            f.write(os.urandom(50000))
+        started = []
+
+        def operation(source, target):
+            started.append(time.perf_counter())
+            time.sleep(0.05)  # still copying
+            return 50000, None
+
+        scheduler = IOScheduler({self.folder.name: 32},
+                                throttle=Throttle(1e6, burst=0.1))
+        start = time.perf_counter()
+        list(scheduler.map(operation, [(self.source, self.target)] * 20))
+        scheduler.shutdown()
+        self.assertLess(len([x for x in started if x - start < 0.2]), 8)
+        self.assertGreater(max(started) - start, 0.8)
+
+    def test_throttle_schedule(self):
+        self.assertEqual(parse_window("18:00-07:30"), (1080, 450))
+        self.assertTrue(in_window((1080, 450), 23 * 60))
+        self.assertTrue(in_window((1080, 450), 60))
+        self.assertFalse(in_window((1080, 450), 12 * 60))
+        throttle = Throttle.from_config({"Throttle": {
+            "Bytes": 10, "Schedule": {"00:00-23:59": False}}})
+        self.assertEqual(throttle.limits, (10e6, None))
+        self.assertIsNone(Throttle.from_config({}))
+        if time.localtime().tm_hour * 60 + time.localtime().tm_min < 1439:
+            self.assertEqual(throttle.current_limits(), (None, None))
+
+    def test_order_operations(self):
+        operations = []
+        for name in ("b", "c", "a"):
+            with open(os.path.join(self.folder.name, name), 'w') as f:
+                f.write(name)
+            operations.append((os.path.join(self.folder.name, name), name))
+        self.assertEqual(order_operations(operations, "given"), operations)
+        self.assertEqual([x[1] for x in order_operations(operations, "name")],
+                         ["a", "b", "c"])
+        for order in ("inode", "locality"):
+            self.assertEqual(sorted(order_operations(operations, order)),
+                             sorted(operations))
+
+
+class TestRetrying(unittest.TestCase):
+    def test_classify(self):
+        import errno
+        self.assertEqual(classify(OSError(errno.EIO, "I/O error")),
+                         TRANSIENT)
+        self.assertEqual(classify(TimeoutError()), TRANSIENT)
+        self.assertEqual(classify(FileNotFoundError(errno.ENOENT, "")),
+                         MISSING)
+        self.assertEqual(classify(EOFError()), CORRUPT)
+
+    def test_retry(self):
+        import errno
+        policy = RetryPolicy(attempts=3, delay=0.01)
+        self.assertEqual(policy.delays(), [0.01, 0.02])
+        calls = []
+
+        def flaky(error, failures):
+            calls.append(error)
+            if len(calls) <= failures:
+                raise error
+            return len(calls)
+
+        # Transient errors are retried
+        self.assertEqual(policy.call(flaky, OSError(errno.EIO, ""), 2), 3)
+        calls.clear()
+        self.assertRaises(OSError, policy.call, flaky,
+                          OSError(errno.EIO, ""), 3)
+        self.assertEqual(len(calls), 3)
+        # Others are not
+        calls.clear()
+        self.assertRaises(PermissionError, policy.call, flaky,
+                          PermissionError(errno.EACCES, ""), 1)
+        self.assertEqual(len(calls), 1)
+
+    def test_scheduler(self):
+        import errno
+        folder = tempfile.TemporaryDirectory()
+        source = os.path.join(folder.name, "source")
+        with open(source, 'wb') as f:
+            f.write(os.urandom(1000))
+        failures = []
+
+        def flaky_copy(source, target):
+            if len(failures) < 2:
+                failures.append(target)
+                raise OSError(errno.EIO, "I/O error")
+            return copy_file(source, target)
+
+        scheduler = IOScheduler(default=1,
+                                retry=RetryPolicy(delay=0.01))
+        operations = [(source, os.path.join(folder.name, "1")),
+                      (source, os.path.join(folder.name, "2"))]
+        results = list(scheduler.map(flaky_copy, operations))
+        scheduler.shutdown()
+        self.assertEqual([x[2] for x in results], [None, None])
+        self.assertEqual(scheduler.retries, 2)
+        folder.cleanup()
+
+
+class TestDeidentification(unittest.TestCase):
+    def test_nested(self):
+        import pydicom
+        from pydicom.dataset import Dataset, FileMetaDataset
+        from pydicom.uid import (ExplicitVRLittleEndian, MRImageStorage,
+                                 generate_uid)
+        protocol = ScanProtocol()
+        protocol.project = "Test"
+        deidentifier = Deidentifier(True, protocol)
+
+        dataset = Dataset()
+        dataset.file_meta = FileMetaDataset()
+        dataset.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+        dataset.SOPClassUID = MRImageStorage
+        dataset.SOPInstanceUID = generate_uid()
+        dataset.PatientName = "Doe^Jane"
+        dataset.PatientID = "12345"
+        patient = Dataset()
+        patient.PatientName = "Doe^Jane"
+        patient.PatientBirthDate = "19700101"
+        patient.InstitutionName = "Hospital"
+        patient.SeriesNumber = 1
+        dataset.ReferencedPatientSequence = [patient]
+        request = Dataset()
+        request.RequestAttributesSequence = [Dataset()]
+        request.RequestAttributesSequence[0].PatientID = "12345"
+        dataset.RequestAttributesSequence = [request]
+        buffer = io.BytesIO()
+        dataset.save_as(buffer, enforce_file_format=True)
+        buffer.seek(0)
+
+        header = deidentifier.header(buffer)
+        self.assertNotIn(b"Doe^Jane", header)
+        target = pydicom.dcmread(io.BytesIO(header))
+        self.assertEqual(target.PatientName, "Test-sub-001")
+        patient = target.ReferencedPatientSequence[0]
+        self.assertEqual(patient.PatientName, "Test-sub-001")
+        self.assertEqual(patient.PatientBirthDate, "")
+        self.assertNotIn("InstitutionName", patient)
+        self.assertEqual(patient.SeriesNumber, 1)
+        self.assertNotIn("PatientName", target.RequestAttributesSequence[0])
+        self.assertEqual(target.RequestAttributesSequence[0]
+                         .RequestAttributesSequence[0].PatientID,
+                         "Test-sub-001")
+
+
+class TestContainers(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.files = {"MR.{0}.IMA".format(x): os.urandom(1000 * x)
+                      for x in range(1, 6)}
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_round_trip(self):
+        for format in ("tar", "tar.gz", "zip"):
+            filename = os.path.join(self.folder.name, "DICOM." + format)
+            writer = ContainerWriter(filename, format)
+            for name, data in self.files.items():
+                writer.write(writer.pack(name, data, time.time()))
+            writer.close()
+            self.assertEqual(sorted(list_members(filename)),
+                             sorted(self.files))
+            for name, data in self.files.items():
+                self.assertEqual(read_member(filename, name), data)
+            if format != "zip":
+                with tarfile.open(filename) as f:
+                    for name, data in self.files.items():
+                        self.assertEqual(f.extractfile(name).read(), data)
+
+    def test_abort(self):
+        filename = os.path.join(self.folder.name, "DICOM.tar.gz")
+        writer = ContainerWriter(filename, "tar.gz")
+        writer.write(writer.pack("MR.1.IMA", self.files["MR.1.IMA"]))
+        writer.abort()
+        self.assertEqual(os.listdir(self.folder.name), [])
+
+
+class TestExports(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.files = {"DICOM/MR.{0}.IMA".format(x): os.urandom(1000 * x)
+                      for x in range(1, 6)}
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_read_members(self):
+        filename = os.path.join(self.folder.name, "export.zip")
+        with zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED) as f:
+            for name, data in self.files.items():
+                f.writestr(name, data)
+        with tarfile.open(filename[:-4] + ".tar", 'w') as f:
+            for name, data in self.files.items():
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                f.addfile(info, io.BytesIO(data))
+        for filename in (filename, filename[:-4] + ".tar"):
+            self.assertTrue(is_export(filename))
+            with ExportArchive(filename) as export:
+                paths = export.paths()
+                self.assertEqual([export.get_name(x) for x in paths],
+                                 list(self.files))
+                for path in paths:
+                    data = self.files[export.get_name(path)]
+                    self.assertEqual(export.getsize(path), len(data))
+                    with export.open(path) as f:
+                        self.assertEqual(f.read(10), data[:10])
+                        f.seek(-10, os.SEEK_END)
+                        self.assertEqual(f.read(), data[-10:])
+                operations = [(x, None) for x in reversed(paths)]
+                self.assertEqual([x[0] for x in export.sort(operations)],
+                                 paths)
+        self.assertFalse(is_export(self.folder.name))
+
+
+class TestTee(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.session_folder = os.path.join(self.folder.name, "primary", "ses")
+        self.mirrors = [(os.path.join(self.folder.name, x),
+                         os.path.join(self.folder.name, x, "ses"))
+                        for x in ("mirror1", "mirror2")]
+        os.makedirs(self.session_folder)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_mirrors(self):
+        tee = Tee(self.session_folder, self.mirrors, buffer_size=5000)
+        tee.start()
+        os.makedirs(os.path.join(self.session_folder, "DICOM"))
+        for x in range(1, 6):
+            filename = os.path.join(self.session_folder, "DICOM",
+                                    "MR.{0}.IMA".format(x))
+            with tee.open(filename) as f:
+                for _ in range(x):
+                    f.write(os.urandom(1000))
+        with open(os.path.join(self.session_folder, "notes.txt"), 'w') as f:
+            f.write("notes")
+        os.link(os.path.join(self.session_folder, "DICOM", "MR.1.IMA"),
+                os.path.join(self.session_folder, "MR.1.IMA"))
+        tee.finish()
+        for root, session_folder in self.mirrors:
+            self.assertFalse(os.path.exists(session_folder))  # not yet
+        tee.publish()
+        for root, session_folder in self.mirrors:
+            comparison = filecmp.dircmp(self.session_folder, session_folder)
+            self.assertEqual(comparison.left_only + comparison.right_only +
+                             comparison.diff_files, [])
+            self.assertEqual(filecmp.dircmp(
+                os.path.join(self.session_folder, "DICOM"),
+                os.path.join(session_folder, "DICOM")).diff_files, [])
+            self.assertEqual(os.stat(os.path.join(session_folder,
+                                                  "MR.1.IMA")).st_nlink, 2)
+            self.assertIsNone(tee.stats()[root]["error"])
+            self.assertEqual(tee.stats()[root]["files"], 6)
+
+    def test_failing_mirror(self):
+        os.makedirs(self.mirrors[1][1])  # exists already
+        tee = Tee(self.session_folder, self.mirrors)
+        tee.start()
+        with tee.open(os.path.join(self.session_folder, "MR.1.IMA")) as f:
+            f.write(b"data")
+        tee.finish()
+        tee.publish()
+        self.assertIsNone(tee.mirrors[0].error)
+        self.assertIsNotNone(tee.mirrors[1].error)
+        self.assertTrue(os.path.isfile(os.path.join(self.mirrors[0][1],
+                                                    "MR.1.IMA")))
+        self.assertEqual(os.listdir(self.mirrors[1][1]), [])
+
+    def test_rollback(self):
+        tee = Tee(self.session_folder, self.mirrors)
+        tee.start()
+        with tee.open(os.path.join(self.session_folder, "MR.1.IMA")) as f:
+            f.write(b"data")
+        tee.rollback()
+        for root, session_folder in self.mirrors:
+            self.assertFalse(os.path.exists(session_folder))
+            self.assertEqual(os.listdir(os.path.join(root, INCOMING_FOLDER)),
+                             [])
+
+
+class TestStaging(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.spool = os.path.join(self.folder.name, "spool")
+        self.staged = os.path.join(self.spool, "Project", "sub-001", "ses-001")
+        self.target = os.path.join(self.folder.name, "archive", "Project",
+                                   "sub-001", "ses-001")
+        os.makedirs(os.path.join(self.staged, "DICOM"))
+        for x in range(1, 4):
+            with open(os.path.join(self.staged, "DICOM",
+                                   "MR.{0}.IMA".format(x)), 'wb') as f:
+                f.write(os.urandom(1000 * x))
+        os.link(os.path.join(self.staged, "DICOM", "MR.1.IMA"),
+                os.path.join(self.staged, "MR.1.IMA"))
+        self.copy = os.path.join(self.folder.name, "copy")
+        shutil.copytree(self.staged, self.copy)
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_flush(self):
+        FlushQueue(self.spool).put(self.staged, self.target)
+        flusher = Flusher(self.spool)  # e.g. after a restart
+        self.assertEqual(flusher.status(), "1 queued")
+        self.assertEqual(flusher.flush_all(), 1)
+        comparison = filecmp.dircmp(self.copy, self.target)
+        self.assertEqual(comparison.left_only + comparison.right_only +
+                         comparison.diff_files, [])
+        self.assertEqual(filecmp.dircmp(
+            os.path.join(self.copy, "DICOM"),
+            os.path.join(self.target, "DICOM")).diff_files, [])
+        self.assertEqual(os.stat(os.path.join(self.target,
+                                              "MR.1.IMA")).st_nlink, 2)
+        self.assertFalse(os.path.exists(os.path.join(self.spool, "Project")))
+        self.assertEqual(flusher.queue.jobs(), [])
+        self.assertEqual(flusher.status(), "")
+
+    def test_failed_flush(self):
+        os.makedirs(self.target)  # not to be overwritten
+        FlushQueue(self.spool).put(self.staged, self.target)
+        flusher = Flusher(self.spool)
+        self.assertEqual(flusher.flush_all(), 0)
+        self.assertEqual(flusher.status(), "1 failed")
+        self.assertEqual(os.listdir(self.target), [])
+        self.assertTrue(os.path.isdir(self.staged))
+        os.rmdir(self.target)
+        self.assertEqual(flusher.flush_all(), 0)  # retried later
+        self.assertEqual(flusher.flush_all(retry_failed=True), 1)
+        self.assertFalse(os.path.exists(self.staged))
+
+    def test_locked(self):
+        queue = FlushQueue(self.spool)
+        job = queue.put(self.staged, self.target)
+        lock = queue.lock(job)  # e.g. flushed by another process
+        flusher = Flusher(self.spool)
+        self.assertEqual(flusher.flush_all(retry_failed=True), 0)
+        self.assertEqual(flusher.queue.jobs(), [job])
+        self.assertFalse(os.path.exists(self.target))
+        queue.unlock(job, lock)
+        self.assertEqual(flusher.flush_all(), 1)
+        self.assertTrue(os.path.isdir(self.target))
+
+    def test_concurrent_put(self):
+        with multiprocessing.Pool(2) as pool:
+            pool.starmap(queue_sessions,
+                         [(self.spool, "a"), (self.spool, "b")])
+        queue = FlushQueue(self.spool)
+        jobs = queue.jobs()
+        self.assertEqual(len(jobs), 40)
+        self.assertEqual(len({x["id"] for x in jobs}), 40)
+        for job in jobs:
+            self.assertEqual(queue.get_catalog(job)["staged"], job["staged"])
+        self.assertFalse([x for x in os.listdir(queue.folder)
+                          if x.endswith(".tmp")])
+
+    def test_catalog(self):
+        filename = os.path.join(self.folder.name, "catalog.sqlite")
+        target = os.path.join(self.target, "DICOM", "MR.2.IMA")
+        catalog = {"filename": filename, "path": self.target,
+                   "source": self.copy,
+                   "protocol": {"project": "Project", "subject": ["1", ""],
+                                "session": ["1", ""], "date": "20240101"},
+                   "files": [{"phase": "Copying DICOM files",
+                              "target": target, "size": 2000}]}
+        os.makedirs(self.target)  # not to be overwritten
+        FlushQueue(self.spool).put(self.staged, self.target, catalog=catalog)
+        flusher = Flusher(self.spool)
+        self.assertEqual(flusher.flush_all(), 0)
+        self.assertFalse(os.path.exists(filename))  # only once flushed
+        os.rmdir(self.target)
+        self.assertEqual(flusher.flush_all(retry_failed=True), 1)
+        with ArchiveCatalog(filename) as archive_catalog:
+            files = archive_catalog.files()
+        self.assertEqual([x["target"] for x in files], [target])
+        self.assertEqual(os.listdir(flusher.queue.folder), [])
+
+
+class TestDurability(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.session = os.path.join(self.folder.name, "Project", "sub-001",
+                                    "ses-001")
+        self.measurement = os.path.join(self.session, "func", "001-run1")
+        os.makedirs(os.path.join(self.measurement, "DICOM"))
+        self.files = []
+        for x in range(1, 4):
+            self.files.append(os.path.join(self.measurement, "DICOM",
+                                           "MR.{0}.IMA".format(x)))
+            with open(self.files[-1], 'wb') as f:
+                f.write(os.urandom(1000))
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_modes(self):
+        durability = Durability("file")
+        for filename in self.files:
+            durability.written(filename)
+        self.assertEqual(durability.files, 3)
+        durability.finish(self.session, self.folder.name)
+        self.assertEqual(durability.files, 3)  # only folders left to sync
+
+        durability = Durability("directory")
+        durability.written(self.files[0])
+        self.assertEqual(durability.files, 0)
+        durability.folder_complete(self.measurement)
+        self.assertEqual(durability.files, 3)
+        durability.finish(self.session, self.folder.name)
+        self.assertEqual(durability.files, 3)  # not synced twice
+
+        durability = Durability(None)
+        durability.folder_complete(self.measurement)
+        durability.finish(self.session, self.folder.name)
+        self.assertEqual(durability.stats()["mode"], "none")
+        self.assertEqual(durability.files, 0)
+
+        durability = Durability()
+        durability.finish(self.session, self.folder.name)
+        self.assertEqual(durability.stats()["mode"], "directory")
+        self.assertEqual(Durability.from_config({}).mode, "directory")
+
+        self.assertRaises(ValueError, Durability, "always")
+
+    def test_mirror(self):
+        # Written by the tee, without syncing
+        for mode in ("file", "directory"):
+            durability = Durability(mode)
+            durability.finish_mirror(self.session, self.folder.name)
+            self.assertEqual(durability.files, 3)
+        durability = Durability("none")
+        durability.finish_mirror(self.session, self.folder.name)
+        self.assertEqual(durability.files, 0)
+
+
+class TestPublishing(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.TemporaryDirectory()
+        self.target = os.path.join(self.root.name, "Project", "sub-001",
+                                   "ses-001")
+
+    def tearDown(self):
+        self.root.cleanup()
+
+    def test_publish(self):
+        folder = create_work_folder(self.root.name, self.target)
+        self.assertEqual(os.path.dirname(folder),
+                         os.path.join(self.root.name, INCOMING_FOLDER))
+        with open(os.path.join(folder, "MR.1.IMA"), 'wb') as f:
+            f.write(os.urandom(1000))
+        self.assertFalse(os.path.exists(self.target))
+        publish(folder, self.target)
+        self.assertEqual(os.listdir(self.target), ["MR.1.IMA"])
+        self.assertFalse(os.path.exists(folder))
+
+    def test_existing_target(self):
+        os.makedirs(self.target)  # even if empty
+        folder = create_work_folder(self.root.name, self.target)
+        self.assertRaises(OSError, publish, folder, self.target)
+        self.assertTrue(os.path.isdir(folder))
+
+    def test_rollback(self):
+        folder = create_work_folder(self.root.name, self.target)
+        os.makedirs(os.path.join(folder, "func", "DICOM"))
+        trashed = move_to_trash(folder, self.root.name)
+        self.assertFalse(os.path.exists(folder))
+        self.assertEqual(os.path.dirname(trashed),
+                         os.path.join(self.root.name, TRASH_FOLDER))
+        for x in range(50):  # emptied in the background
+            if not os.listdir(os.path.dirname(trashed)):
+                break
+            time.sleep(0.1)
+        self.assertEqual(os.listdir(os.path.dirname(trashed)), [])
+
+    def test_trash_file(self):
+        folder = create_work_folder(self.root.name, self.target)
+        filename = os.path.join(folder, "DICOM.tar")
+        with open(filename, 'wb') as f:
+            f.write(os.urandom(1000))
+        trashed = move_to_trash(filename, self.root.name)
+        for x in range(50):  # emptied in the background
+            if not os.path.exists(trashed):
+                break
+            time.sleep(0.1)
+        self.assertFalse(os.path.exists(trashed))
+
+    def test_not_indexed(self):
+        name = "ScanProtocol_Project_sub-001_ses-001_20240101.txt"
+        folder = create_work_folder(self.root.name, self.target)
+        for path in (folder, os.path.join(self.root.name, TRASH_FOLDER,
+                                          "ses-001"), self.target):
+            os.makedirs(path, exist_ok=True)
+            with open(os.path.join(path, name), 'w') as f:
+                f.write("")
+        self.assertEqual([x[0] for x in find_protocols(self.root.name)],
+                         [os.path.join(self.target, name)])
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.prometheus = os.path.join(self.folder.name, "sst.prom")
+        self.event_log = os.path.join(self.folder.name, "logs",
+                                      "events.jsonl")
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_config(self):
+        self.assertFalse(MetricsSink.from_config({}).enabled)
+        self.assertFalse(MetricsSink.from_config({"Metrics": None}).enabled)
+        sink = MetricsSink.from_config({"Metrics": {
+            "Prometheus": self.prometheus, "FileEvents": "yes",
+            "Buckets": [0.1, 1], "Labels": {"site": 1}}})
+        self.assertTrue(sink.enabled)
+        self.assertEqual(sink.prometheus, self.prometheus)
+        self.assertIsNone(sink.event_log)
+        self.assertTrue(sink.file_events)
+        self.assertEqual(sink.buckets, [0.1, 1])
+        self.assertEqual(sink.labels["site"], "1")
+        self.assertIn("host", sink.labels)
+
+    def test_phase(self):
+        sink = MetricsSink.from_config({"Metrics": {
+            "Prometheus": self.prometheus, "EventLog": self.event_log,
+            "Buckets": [0.1, 1], "Labels": {"site": "console1"}}})
+        report = ArchiveReport(metrics=sink)
+        sink.start("sub-001/ses-001")
+        report.start("Reading DICOM images")
+        report.add("Reading DICOM images", 1, 100, latency=0.05)
+        report.stop("Reading DICOM images")
+        report.start("Copying DICOM files")
+        report.add("Copying DICOM files", 1, 1000, latency=0.5)
+        report.add("Copying DICOM files", 1, 1000, latency=2)
+        report.queue("Copying DICOM files", 3)
+        report.error("Copying DICOM files")
+        report.stop("Copying DICOM files")
+        report.finish()
+
+        with open(self.event_log) as f:
+            events = [json.loads(x) for x in f]
+        self.assertEqual([x["event"] for x in events],
+                         ["archive_start", "error", "phase", "phase",
+                          "archive_end"])
+        self.assertTrue(all(x["site"] == "console1" for x in events))
+        self.assertEqual(events[0]["session"], "sub-001/ses-001")
+        phases = {x["stage"]: x for x in events if x["event"] == "phase"}
+        self.assertEqual(phases["Copying DICOM files"]["files"], 2)
+        self.assertEqual(phases["Copying DICOM files"]["bytes"], 2000)
+        self.assertEqual(events[-1]["files"], 2)
+        self.assertEqual(events[-1]["errors"], 1)
+
+        with open(self.prometheus) as f:
+            lines = f.read().splitlines()
+        values = {x.rsplit(" ", 1)[0]: x.rsplit(" ", 1)[1] for x in lines
+                  if not x.startswith("#")}
+        host = sink.labels["host"]
+        labels = 'host="{0}",site="console1"'.format(host)
+        copy = labels + ',stage="Copying DICOM files"'
+        self.assertEqual(values["sst_archive_files{" + labels + "}"], "2")
+        self.assertEqual(values["sst_archive_bytes{" + labels + "}"], "2000")
+        self.assertEqual(values["sst_archive_header_parse_seconds_count{" +
+                                labels + "}"], "1")
+        bucket = 'host="{0}",le="1.0",site="console1",' \
+            'stage="Copying DICOM files"'.format(host)
+        self.assertEqual(values["sst_archive_file_copy_seconds_bucket{" +
+                                bucket + "}"], "1")
+        self.assertEqual(values["sst_archive_file_copy_seconds_count{" +
+                                copy + "}"], "2")
+        self.assertEqual(values["sst_archive_queue_depth_max{" + copy + "}"],
+                         "3")
+        self.assertEqual(values["sst_archive_errors{" + copy + "}"], "1")
+        self.assertEqual(os.listdir(self.folder.name).count("sst.prom"), 1)
+        self.assertEqual(len(os.listdir(self.folder.name)), 2)  # no tmp
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.folder.cleanup()
+
+    def test_bundle(self):
+        profiler = Profiler(self.folder.name)
+        archive = profiler.wrap("archive", lambda x: sorted(range(x)))
+        original = tkinter.CallWrapper.__call__
+        self.assertEqual(archive(3), [0, 1, 2])  # not profiled yet
+        profiler.start()
+        self.assertIsNot(tkinter.CallWrapper.__call__, original)
+        self.assertEqual(archive(1000)[-1], 999)
+        tkinter.CallWrapper(lambda: None, None, None)()  # a Tk callback
+        filename = profiler.stop()
+        self.assertIs(tkinter.CallWrapper.__call__, original)
+        self.assertFalse(profiler.active)
+        with zipfile.ZipFile(filename) as bundle:
+            names = bundle.namelist()
+            for name in ("summary.txt", "callbacks.txt", "archive.prof",
+                         "memory.txt"):
+                self.assertIn(name, names)
+            self.assertIn("archive: 1,",
+                          bundle.read("summary.txt").decode())
+            self.assertIn("<lambda>", bundle.read("callbacks.txt").decode())
+        self.assertEqual(os.listdir(self.folder.name),
+                         [os.path.basename(filename)])
+
+
+class TestConfig(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        os.environ["SST_CACHE_DIR"] = self.cache_dir.name
+        self.config_file = os.path.join(os.path.split(__file__)[0],
+                                        os.pardir, "scansessiontool",
+                                        "sst.yaml")
+
+    def tearDown(self):
+        del os.environ["SST_CACHE_DIR"]
+        self.cache_dir.cleanup()
+
+    def test_compiled_config(self):
+        config = load_config(self.config_file)
+        self.assertEqual(config.projects, ["Project 1", "Project 2"])
+        project = config.get("Project 1")
+        self.assertEqual(project.get_completions("func"),
+                         ["Run1", "Run2", "Run3"])
+        self.assertEqual(project.get_measurement("func", "Run2")["Vols"], 400)
+        self.assertIsNone(project.get_measurement("anat", "Run2"))
+        self.assertIsNone(config.get("Project 3"))
+
+    def test_cached_config(self):
+        config = load_config(self.config_file)
+        self.assertEqual(len(os.listdir(self.cache_dir.name)), 1)
+        cached = load_config(self.config_file)
+        self.assertEqual(cached.projects, config.projects)
+        self.assertEqual(
+            cached.get("Project 2").get_completions("anat"),
+            config.get("Project 2").get_completions("anat"))
+
+    def test_config_directory(self):
+        import yaml
+        with open(self.config_file) as f:
+            projects = yaml.safe_load(f)
+        with tempfile.TemporaryDirectory() as config_dir:
+            for name, project in projects.items():
+                with open(os.path.join(config_dir, name + ".yaml"), 'w') as f:
+                    yaml.safe_dump(project, f)
+            config = load_config(config_dir)
+            self.assertEqual(config.projects, ["Project 1", "Project 2"])
+            config.cache_size = 1
+            project = config.get("Project 1")
+            self.assertEqual(project.get_completions("func"),
+                             ["Run1", "Run2", "Run3"])
+            self.assertIs(config.get("Project 1"), project)
+            self.assertEqual(config.get("Project 2").get_completions("anat"),
+                             ["Localizer", "MPRAGE"])
+            self.assertIsNot(config.get("Project 1"), project)
+            self.assertIsNone(config.get("Project 3"))
+
+    def test_broken_project(self):
+        import warnings
+        with tempfile.TemporaryDirectory() as config_dir:
+            with open(os.path.join(config_dir, "Broken.yaml"), 'w') as f:
+                f.write("Measurements: [\n")
+            config = load_config(config_dir)
+            with warnings.catch_warnings(record=True):
+                warnings.simplefilter("always")
+                self.assertIsNone(config.get("Broken"))
+            self.assertIn("Broken", config.errors)
+            os.remove(os.path.join(config_dir, "Broken.yaml"))
+            with warnings.catch_warnings(record=True):
+                warnings.simplefilter("always")
+                self.assertIsNone(config.get("Broken"))  # missing file
+
 
 if __name__ == "__main__":
     unittest.main()